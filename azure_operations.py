@@ -1,18 +1,22 @@
-import sys, os, argparse, json, re, logging
-from azure.common.credentials import ServicePrincipalCredentials
-from azure.mgmt.resource.resources import ResourceManagementClient
-from azure.mgmt.resource import SubscriptionClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.mgmt.compute.models import Plan, HardwareProfile, SshConfiguration, VirtualMachineSize
-from azure.mgmt.compute.models import SshPublicKey, LinuxConfiguration, OSProfile, ImageReference 
-from azure.mgmt.compute.models import VirtualHardDisk, OSDisk, DataDisk, StorageProfile, ManagedDiskParameters 
-from azure.mgmt.compute.models import DiskCreateOption, NetworkInterfaceReference, NetworkProfile
-from azure.mgmt.compute.models import BootDiagnostics, DiagnosticsProfile, VirtualMachine 
-from azure.mgmt.network.models import PublicIPAddress 
-from azure.mgmt.storage.models import Kind, Sku, StorageAccountCreateParameters
-from azure.storage.blob.baseblobservice import BaseBlobService
+import sys, os, argparse, json, re, logging, importlib, time, threading, fnmatch, uuid, math, random, copy
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The Azure SDK packages are slow to import, so model classes are imported
+# inside the methods that use them and management clients are only built
+# on first attribute access (see azure_operations.__getattr__).
+# attribute name -> (module, client class)
+lazy_clients = {
+    'subscription_client' : ('azure.mgmt.resource', 'SubscriptionClient'),
+    'resource_client' : ('azure.mgmt.resource.resources', 'ResourceManagementClient'),
+    'storage_client' : ('azure.mgmt.storage', 'StorageManagementClient'),
+    'compute_client' : ('azure.mgmt.compute', 'ComputeManagementClient'),
+    'network_client' : ('azure.mgmt.network', 'NetworkManagementClient')
+}
 
 # set logging level
 logger = logging.getLogger('Logging')
@@ -32,14 +36,507 @@ supported_vm_sizes = {
     '96T' : 'Standard_D14_v2'
 }
 
+# power operations: cli command -> virtual_machines operation
+power_operations = {
+    'start' : 'start',
+    'stop' : 'deallocate',
+    'restart' : 'restart'
+}
+
 # storage account types
 account_types = ['Storage', 'BlobStorage']
 replication_types = ['Standard_LRS', 'Standard_GRS', 'Standard_RAGRS', 
         'Standard_ZRS', 'Premium_LRS']
 access_tiers = ['Hot', 'Cool']
 
+# compact VM size record, also the format of the on-disk size catalog
+vm_size_info = namedtuple('vm_size_info', ['name', 'number_of_cores', 'memory_in_mb', 
+        'os_disk_size_in_mb', 'resource_disk_size_in_mb', 'max_data_disk_count'])
+
+# compact records of listed resources, printed as text or written as json lines
+vm_info = namedtuple('vm_info', ['name', 'vm_id', 'location', 'vm_size', 'number_of_cores', 'memory_in_mb', 
+        'state', 'public_ips', 'private_ips', 'os_disk', 'data_disks'])
+vm_disk_info = namedtuple('vm_disk_info', ['lun', 'name', 'uri', 'size_gb'])
+vm_state_info = namedtuple('vm_state_info', ['name', 'state'])
+vm_ip_info = namedtuple('vm_ip_info', ['name', 'public_ips', 'private_ips'])
+private_ip_info = namedtuple('private_ip_info', ['vnet', 'subnet', 'ip_address'])
+subscription_info = namedtuple('subscription_info', ['subscription_id', 'name'])
+resource_group_info = namedtuple('resource_group_info', ['name', 'location'])
+storage_account_info = namedtuple('storage_account_info', ['name', 'kind', 'replication', 'location'])
+container_info = namedtuple('container_info', ['storage_account', 'name'])
+vhd_info = namedtuple('vhd_info', ['storage_account', 'container', 'name', 'lease_status', 'lease_state'])
+managed_disk_info = namedtuple('managed_disk_info', ['name', 'vm'])
+vnet_info = namedtuple('vnet_info', ['name', 'location', 'address_prefixes'])
+subnet_info = namedtuple('subnet_info', ['name', 'vnet', 'address_prefix'])
+nic_info = namedtuple('nic_info', ['name', 'vnet', 'subnet', 'private_ip', 'vm'])
+public_ip_info = namedtuple('public_ip_info', ['name', 'ip_address'])
+# outcome of a long running operation on a vm
+vm_operation_info = namedtuple('vm_operation_info', ['name', 'operation', 'succeeded', 'seconds', 'error'])
+# state of a long running operation saved by --no-wait
+operation_info = namedtuple('operation_info', ['id', 'operation', 'resource', 'status', 'seconds', 'error'])
+# time spent in one phase of a vm creation
+vm_phase_info = namedtuple('vm_phase_info', ['name', 'phase', 'seconds'])
+# requests seen by the throttle of this process
+throttle_info = namedtuple('throttle_info', ['requests', 'throttled', 'retries', 'waited_seconds'])
+# outcome of a fleet creation
+fleet_info = namedtuple('fleet_info', ['count', 'succeeded', 'seconds', 'vms_per_minute', 'p50_seconds', 'p95_seconds'])
+
+def record_to_dict(record):
+    if hasattr(record, '_asdict'):
+        return dict((field, record_to_dict(value)) for field, value in zip(record._fields, record))
+    if isinstance(record, list):
+        return [record_to_dict(value) for value in record]
+    return record
+
+output_lock = threading.Lock()
+
+def write_record(record):
+    # one json object per line, flushed so that consumers see it right away
+    line = record_to_dict(record)
+    line['type'] = type(record).__name__
+    with output_lock:
+        sys.stdout.write(json.dumps(line, sort_keys = True) + '\n')
+        sys.stdout.flush()
+
+def version_key(version):
+    # image versions such as 1.0.10 compare by their numbers
+    return [int(part) if part.isdigit() else part for part in version.split('.')]
+
+def percentile(values, percent):
+    # nearest-rank percentile of sorted values, None if there are none
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(percent * len(values) / 100.0)) - 1)]
+
+def run_concurrently(func, items, workers, context = None):
+    # yields (item, result, error) in the order of items while running at most
+    # workers calls at a time; an exception only fails its own item. context,
+    # if given, is called in the calling thread and returns a function
+    # run(func, item) the calls are made through, so that thread state such
+    # as buffered logs carries over to the workers
+    run = context() if context else (lambda func, item: func(item))
+
+    def call(item):
+        try:
+            return item, run(func, item), None
+        except Exception as e:
+            return item, None, e
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield call(item)
+        return
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap(call, items):
+            yield result
+    finally:
+        pool.terminate()
+
+# on-disk caches shared across cli invocations live under this directory
+def cache_dir():
+    path = os.environ.get('AZURE_OPS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.azure_operations'))
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            # created by a concurrent process
+            pass
+    return path
+
+def load_json_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def dump_json_file(path, data):
+    # write to a private temp file first so readers never see a partial file
+    tmp_path = '{}.{}.{}'.format(path, os.getpid(), threading.current_thread().ident)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+class file_lock:
+    # exclusive advisory lock shared by all processes using the same path
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+class token_cache:
+    # tokens are refreshed this many seconds before they expire
+    refresh_margin = 300
+
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(cache_dir(), 'tokens.json')
+        self.path = path
+
+    def cache_key(self, tenant_id, client_id, cloud):
+        return '{}/{}/{}'.format(tenant_id, client_id, cloud)
+
+    def lookup(self, tenant_id, client_id):
+        entries = load_json_file(self.path)
+        for cloud in ['azure', 'china']:
+            entry = entries.get(self.cache_key(tenant_id, client_id, cloud))
+            if entry and entry['expires_at'] - self.refresh_margin > time.time():
+                return cloud, entry['token'], entry['expires_at']
+        return None, None, None
+
+    def fetch(self, tenant_id, client_id, login):
+        # (cloud, token, expires_at) from the cache, or from login() which does
+        # the actual token request and returns (cloud, credentials)
+        cloud, token, expires_at = self.lookup(tenant_id, client_id)
+        if token is None:
+            with file_lock(self.path + '.lock'):
+                # another process may have refreshed the token while we waited
+                cloud, token, expires_at = self.lookup(tenant_id, client_id)
+                if token is None:
+                    cloud, credentials = login()
+                    entries = load_json_file(self.path)
+                    for key in list(entries.keys()):
+                        if entries[key]['expires_at'] < time.time():
+                            del entries[key]
+                    token = {
+                        'access_token' : credentials.token['access_token'],
+                        'token_type' : credentials.token.get('token_type', 'Bearer')
+                    }
+                    expires_at = time.time() + int(credentials.token.get('expires_in', 3600))
+                    entries[self.cache_key(tenant_id, client_id, cloud)] = {'token' : token, 'expires_at' : expires_at}
+                    dump_json_file(self.path, entries)
+        return cloud, token, expires_at
+
+    def get_credentials(self, tenant_id, client_id, login):
+        cloud, token, expires_at = self.fetch(tenant_id, client_id, login)
+        return cloud, cached_token_credentials(self, tenant_id, client_id, login, token, expires_at)
+
+class cached_token_credentials:
+    # credentials of a cached token; once the token is about to expire the
+    # next request takes a fresh one from the cache, logging in if needed,
+    # so long jobs outlive the token they started with
+    def __init__(self, cache, tenant_id, client_id, login, token, expires_at):
+        self.cache = cache
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.login = login
+        self.token = token
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+
+    def signed_session(self, session = None):
+        from msrest.authentication import BasicTokenAuthentication
+
+        with self.lock:
+            if self.expires_at - self.cache.refresh_margin <= time.time():
+                cloud, self.token, self.expires_at = self.cache.fetch(self.tenant_id, self.client_id, self.login)
+            credentials = BasicTokenAuthentication(self.token)
+        if session is None:
+            return credentials.signed_session()
+        return credentials.signed_session(session)
+
+class token_bucket:
+    # rate requests per second with bursts of up to capacity requests
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # takes a token, sleeping until it is due; returns the seconds slept
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        # the server asked to back off: no token is handed out for seconds;
+        # pauses of concurrent requests overlap rather than add up
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+class request_throttle:
+    # client side rate limit and retry of throttled requests, shared by all
+    # management clients and blob services of the process: one token bucket
+    # per subscription (per account for storage), Retry-After is honoured and
+    # otherwise the backoff is exponential with full jitter
+    throttled_statuses = [429, 503]
+
+    def __init__(self):
+        self.rate = float(os.environ.get('AZURE_OPS_RATE_LIMIT', 25))
+        self.burst = int(os.environ.get('AZURE_OPS_BURST', 250))
+        self.max_retries = int(os.environ.get('AZURE_OPS_MAX_RETRIES', 6))
+        self.backoff = 2
+        self.max_backoff = 60
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.counters = throttle_info(0, 0, 0, 0.0)
+
+    def count(self, requests = 0, throttled = 0, retries = 0, waited_seconds = 0):
+        with self.lock:
+            self.counters = throttle_info(self.counters.requests + requests, self.counters.throttled + throttled, 
+                    self.counters.retries + retries, self.counters.waited_seconds + waited_seconds)
+
+    def bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = token_bucket(self.rate, self.burst)
+            return self.buckets[key]
+
+    def acquire(self, key):
+        self.count(requests = 1, waited_seconds = self.bucket(key).acquire())
+
+    def retry_delay(self, headers, attempt):
+        retry_after = None
+        for name in ['Retry-After', 'retry-after', 'x-ms-retry-after-ms']:
+            if headers and headers.get(name):
+                try:
+                    retry_after = float(headers[name])
+                except ValueError:
+                    continue
+                if name == 'x-ms-retry-after-ms':
+                    retry_after /= 1000.0
+                break
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 1)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def response_hook(self, key):
+        # requests response hook of the management clients' sessions; a
+        # throttled request is sent again through the same adapter
+        def hook(response, **kwargs):
+            attempt = 0
+            while response.status_code in self.throttled_statuses and attempt < self.max_retries:
+                # the wait happens in acquire, which counts it
+                self.bucket(key).pause(self.retry_delay(response.headers, attempt))
+                self.count(throttled = 1, retries = 1)
+                response.close()
+                self.acquire(key)
+                response = response.connection.send(response.request, **kwargs)
+                attempt += 1
+            if response.status_code in self.throttled_statuses:
+                self.count(throttled = 1)
+            return response
+        return hook
+
+    def storage_retry(self, key, default_retry):
+        # retry policy of a blob service: the storage sdk's own retry decides
+        # whether to retry; a throttled response pauses the account's bucket
+        # for at least Retry-After and the retry waits for it in
+        # request_callback, not in the sdk as well
+        def retry(retry_context):
+            delay = default_retry(retry_context)
+            response = retry_context.response
+            if delay is not None and response is not None and response.status in self.throttled_statuses:
+                self.bucket(key).pause(max(delay, self.retry_delay(response.headers, retry_context.count)))
+                self.count(throttled = 1, retries = 1)
+                return 0
+            if delay is not None:
+                self.count(retries = 1, waited_seconds = delay)
+            return delay
+        return retry
+
+    def throttle_blob_service(self, blob_service, key):
+        try:
+            from azure.storage.common.retry import ExponentialRetry
+        except ImportError:
+            # azure-storage before the split into azure-storage-common
+            from azure.storage.retry import ExponentialRetry
+        blob_service.retry = self.storage_retry(key, ExponentialRetry(max_attempts = self.max_retries).retry)
+        blob_service.request_callback = lambda request: self.acquire(key)
+
+throttle = request_throttle()
+
+class throttled_credentials:
+    # credentials handed to the management clients: every request they sign
+    # takes a token of the subscription's bucket and is retried when throttled
+    def __init__(self, credentials, key):
+        self.credentials = credentials
+        self.key = key
+
+    def signed_session(self, session = None):
+        if session is None:
+            session = self.credentials.signed_session()
+        else:
+            session = self.credentials.signed_session(session)
+        throttle.acquire(self.key)
+        # sessions may be reused for many requests, add the hook once
+        if not getattr(session, 'throttled', False):
+            session.hooks['response'].append(throttle.response_hook(self.key))
+            session.throttled = True
+        return session
+
+    def __getattr__(self, name):
+        return getattr(self.credentials, name)
+
+class marketplace_plan_cache:
+    # publisher/offer/sku -> whether a vm of that image must be deployed with a Plan
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(cache_dir(), 'marketplace_plans.json')
+        self.path = path
+
+    def cache_key(self, publisher, offer, sku):
+        return '{}/{}/{}'.format(publisher, offer, sku).lower()
+
+    def lookup(self, publisher, offer, sku):
+        # None when not known yet
+        return load_json_file(self.path).get(self.cache_key(publisher, offer, sku))
+
+    def save(self, publisher, offer, sku, needs_plan):
+        with file_lock(self.path + '.lock'):
+            entries = load_json_file(self.path)
+            entries[self.cache_key(publisher, offer, sku)] = needs_plan
+            dump_json_file(self.path, entries)
+
+    def remove(self, publisher, offer, sku):
+        with file_lock(self.path + '.lock'):
+            entries = load_json_file(self.path)
+            entries.pop(self.cache_key(publisher, offer, sku), None)
+            dump_json_file(self.path, entries)
+
+class resize_timings:
+    # seconds the last resize of a running vm with a deallocation took per
+    # location, the downtime an in-place resize is compared with
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(cache_dir(), 'resize_timings.json')
+        self.path = path
+
+    def lookup(self, location):
+        # None when no such resize was made in the location yet
+        return load_json_file(self.path).get(location.lower())
+
+    def save(self, location, seconds):
+        with file_lock(self.path + '.lock'):
+            entries = load_json_file(self.path)
+            entries[location.lower()] = round(seconds, 1)
+            dump_json_file(self.path, entries)
+
+class operation_store:
+    # long running operations started with --no-wait, keyed by a short id;
+    # each entry keeps the url to poll and what it was started for
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(cache_dir(), 'operations.json')
+        self.path = path
+
+    def load(self, ids = None):
+        entries = load_json_file(self.path)
+        if ids:
+            missing = [op_id for op_id in ids if op_id not in entries]
+            if missing:
+                raise ValueError('Unknown operation {}'.format(', '.join(missing)))
+            return [entries[op_id] for op_id in ids]
+        return sorted(entries.values(), key = lambda entry: entry['started_at'])
+
+    def add(self, entry):
+        with file_lock(self.path + '.lock'):
+            entries = load_json_file(self.path)
+            entry['id'] = uuid.uuid4().hex[:8]
+            entries[entry['id']] = entry
+            dump_json_file(self.path, entries)
+        return entry['id']
+
+    def remove(self, ids):
+        with file_lock(self.path + '.lock'):
+            entries = load_json_file(self.path)
+            for op_id in ids:
+                entries.pop(op_id, None)
+            dump_json_file(self.path, entries)
+
+def operation_handle(poller):
+    # (kind, url, method) to poll a started operation with, or None; msrestazure
+    # has no public accessor for them, they are read from the private
+    # LongRunningOperation of both AzureOperationPoller and LROPoller, and an
+    # sdk without it makes wait_for block instead
+    polling = poller.polling_method() if hasattr(poller, 'polling_method') else poller
+    operation = getattr(polling, '_operation', None)
+    if operation is None:
+        return None
+    method = getattr(operation, 'method', None) or 'PUT'
+    if getattr(operation, 'async_url', None):
+        return 'async', operation.async_url, method
+    if getattr(operation, 'location_url', None):
+        return 'location', operation.location_url, method
+    initial_response = getattr(operation, 'initial_response', None) or getattr(polling, '_response', None)
+    if initial_response is None:
+        return None
+    return 'resource', initial_response.request.url, method
+
+# terminal states of a long running operation
+finished_states = ['Succeeded', 'Failed', 'Canceled']
+
+# seconds a single poll of an operation may take
+poll_timeout = 60
+
+# server errors in a row after which a polled operation counts as failed
+max_poll_server_errors = 5
+
+class resource_group_snapshot:
+    # VMs, NICs, public IPs and managed disks of a resource group, each listed
+    # once and joined locally by resource id (ids are compared lower-cased as
+    # ARM does not preserve their case consistently)
+    def __init__(self, azure_ops, resource_group):
+        self.resource_group = resource_group
+        self.vms = azure_ops.list_group_vms(resource_group)
+        self.nics = self.index_by_id(azure_ops.network_client.network_interfaces.list(resource_group))
+        self.public_ips = self.index_by_id(azure_ops.network_client.public_ip_addresses.list(resource_group))
+        self.disks = self.index_by_id(azure_ops.compute_client.disks.list_by_resource_group(resource_group))
+        # vm name -> state, from the instance views of the same listing
+        self.states = dict((name, state) for (rg, name), state in azure_ops.get_vm_states(resource_group, 
+                vms = self.vms).items())
+        # (storage account, container) -> {blob name: content length}, filled
+        # by one listing the first time a vhd of that container is sized
+        self.blob_sizes = {}
+        self.container_locks = {}
+        self.lock = threading.Lock()
+
+    def index_by_id(self, resources):
+        return dict((resource.id.lower(), resource) for resource in resources)
+
+    def container_lock(self, storage_account, container):
+        with self.lock:
+            return self.container_locks.setdefault((storage_account, container), threading.Lock())
+
 class azure_operations:
-    def __init__(self, client_id, secret_key, tenant_id, subscription_id = None):
+    def __init__(self, client_id, secret_key, tenant_id, subscription_id = None, use_token_cache = None):
+        # guards the lazily built clients and the lookup caches below, which
+        # are shared by worker threads
+        self.lock = threading.RLock()
+        # 'text' or 'jsonl'
+        self.output = 'text'
+        # save long running operations for the 'wait' command instead of blocking
+        self.no_wait = False
+        # context of the workers of run_concurrently, see there
+        self.worker_context = None
+
         if client_id and secret_key and tenant_id:
             self.client_id = client_id
             self.secret_key = secret_key
@@ -58,53 +555,242 @@ class azure_operations:
             except Exception:
                 self.subscription_id = None 
 
+        # the token cache is opt-in, either by argument or by AZURE_TOKEN_CACHE=1
+        if use_token_cache is None:
+            use_token_cache = os.environ.get('AZURE_TOKEN_CACHE', '0').lower() in ['1', 'true', 'yes']
+
         # initialize resouce and storage management object
+        if use_token_cache:
+            cloud, self.credentials = token_cache().get_credentials(self.tenant_id, self.client_id, self.login)
+        else:
+            cloud, self.credentials = self.login()
+        if cloud == 'china':
+            self.inChina = True
+
+        # VM size catalog per subscription/location, kept on disk for
+        # AZURE_VM_SIZE_CACHE_TTL seconds if set
+        self.vm_size_catalog = {}
+        self.vm_size_cache_ttl = int(os.environ.get('AZURE_VM_SIZE_CACHE_TTL', 0))
+        # (location, vnet name) -> vnet, built from one list_all on first lookup
+        self.vnet_index = None
+        # storage account name -> account, built from one listing on first lookup
+        self.storage_account_index = None
+        # storage account name -> primary key / BaseBlobService, reused for the session
+        self.storage_account_keys = {}
+        self.blob_services = {}
+
+    def login(self):
+        from azure.common.credentials import ServicePrincipalCredentials
         try:
-            self.credentials = ServicePrincipalCredentials(
+            credentials = ServicePrincipalCredentials(
                     client_id = self.client_id, 
                     secret = self.secret_key, 
                     tenant = self.tenant_id
                     )
+            cloud = 'azure'
         except Exception as e:
-            self.credentials = ServicePrincipalCredentials(
+            credentials = ServicePrincipalCredentials(
                     client_id = self.client_id, 
                     secret = self.secret_key, 
                     tenant = self.tenant_id,
                     china = True
                     )
-            self.inChina = True
-
-        self.subscription_client = SubscriptionClient(self.credentials)
-        if self.subscription_id:
-            self.init_clients(self.subscription_id)
+            cloud = 'china'
+
+        return cloud, credentials
+
+    def __getattr__(self, name):
+        # build a management client the first time it is used
+        if name not in lazy_clients:
+            raise AttributeError(name)
+        with self.lock:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            module_name, class_name = lazy_clients[name]
+            client_class = getattr(importlib.import_module(module_name), class_name)
+            if name == 'subscription_client':
+                client = client_class(throttled_credentials(self.credentials, self.tenant_id))
+            elif self.subscription_id:
+                client = client_class(throttled_credentials(self.credentials, self.subscription_id), self.subscription_id)
+            else:
+                # AttributeError keeps hasattr() and getattr() with a default working
+                raise AttributeError('No subscription specified, please check or create a new one') 
+            setattr(self, name, client)
+            return client
 
     def init_clients(self, subscription_id):
         if subscription_id:
-            self.resource_client = ResourceManagementClient(self.credentials, subscription_id)
-            self.storage_client = StorageManagementClient(self.credentials, subscription_id)
-            self.compute_client = ComputeManagementClient(self.credentials, subscription_id)
-            self.network_client = NetworkManagementClient(self.credentials, subscription_id)
+            self.subscription_id = subscription_id
+            # drop clients of the previous subscription, they are rebuilt on next use
+            for name in lazy_clients:
+                if name != 'subscription_client':
+                    self.__dict__.pop(name, None)
+            self.invalidate_vnet_index()
+            self.invalidate_storage_account_index()
         else:
             raise ValueError('No subscription specified, please check or create a new one') 
 
+    def for_subscription(self, subscription_id):
+        # a copy sharing the credentials but with its own clients and caches,
+        # so that several subscriptions can be worked on at once
+        azure_ops = copy.copy(self)
+        azure_ops.lock = threading.RLock()
+        azure_ops.vm_size_catalog = {}
+        azure_ops.storage_account_keys = {}
+        azure_ops.blob_services = {}
+        azure_ops.init_clients(subscription_id)
+        return azure_ops
+
+    def wait_for(self, poller, operation, resource):
+        # block on a long running operation, or in no-wait mode save it and return None
+        if not self.no_wait:
+            return poller.result()
+        handle = operation_handle(poller)
+        if handle is None:
+            logger.info('Cannot save operation {} {} for later, waiting for it.'.format(operation, resource))
+            return poller.result()
+        kind, url, method = handle
+        op_id = operation_store().add({
+            'operation' : operation,
+            'resource' : resource,
+            'kind' : kind,
+            'url' : url,
+            'method' : method,
+            'subscription_id' : self.subscription_id,
+            'started_at' : time.time()
+        })
+        logger.info('{} {} started as operation {}'.format(operation, resource, op_id))
+        return None
+
+    def poll_operation(self, entry):
+        # one GET of the saved url, returns (status, error, retry_after); an
+        # url that cannot be polled raises ValueError, as that says nothing
+        # about the operation itself. Server errors in a row are counted in
+        # the entry, so that repeated polls of it give up on them
+        credentials = throttled_credentials(self.credentials, entry.get('subscription_id') or self.subscription_id)
+        response = credentials.signed_session().get(entry['url'], timeout = poll_timeout)
+        try:
+            retry_after = float(response.headers.get('Retry-After') or 0)
+        except ValueError:
+            retry_after = 0
+        try:
+            body = response.json() if response.content else {}
+        except ValueError:
+            body = {}
+        error = None
+        if isinstance(body.get('error'), dict):
+            error = body['error'].get('message')
+
+        if response.status_code >= 500:
+            entry['server_errors'] = entry.get('server_errors', 0) + 1
+        else:
+            entry['server_errors'] = 0
+
+        if response.status_code == 404 and entry['method'] == 'DELETE':
+            status = 'Succeeded'
+        elif response.status_code >= 500 and entry['server_errors'] >= max_poll_server_errors:
+            status = 'Failed'
+            error = error or 'HTTP {}'.format(response.status_code)
+        elif response.status_code == 429 or response.status_code >= 500:
+            # throttled or a transient server error, the operation goes on
+            status, error = 'InProgress', None
+        elif response.status_code >= 400 and entry['kind'] == 'location':
+            # the location url answers with the operation's own error
+            status = 'Failed'
+            error = error or 'HTTP {}'.format(response.status_code)
+        elif response.status_code >= 300:
+            raise ValueError('Failed to poll operation {}: HTTP {}{}'.format(entry['id'], response.status_code, 
+                    ': {}'.format(error) if error else ''))
+        elif entry['kind'] == 'async':
+            status = body.get('status', 'InProgress')
+        elif entry['kind'] == 'location':
+            status = 'InProgress' if response.status_code == 202 else 'Succeeded'
+        else:
+            status = body.get('properties', {}).get('provisioningState', 'Succeeded')
+        return status, error, retry_after
+
+    def wait_operation(self, entry, timeout = None, interval = 10):
+        # poll until the operation finishes or timeout seconds have passed
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            status, error, retry_after = self.poll_operation(entry)
+            if status in finished_states:
+                return status, error
+            if deadline and time.time() >= deadline:
+                return status, error
+            delay = retry_after or interval
+            if deadline:
+                delay = max(0, min(delay, deadline - time.time()))
+            time.sleep(delay)
+
+    def print_operation(self, record):
+        if self.output == 'jsonl':
+            write_record(record)
+        elif record.error:
+            logger.error('{} {} {} ({}): {}'.format(record.id, record.operation, record.resource, record.status, record.error))
+        else:
+            logger.info('{} {} {}: {}'.format(record.id, record.operation, record.resource, record.status))
+
+    def operation_status(self, ids = None, parallel = 10):
+        # show the saved operations, returns False if any of them failed
+        entries = operation_store().load(ids)
+        failed = 0
+        for entry, result, error in run_concurrently(self.poll_operation, entries, parallel,
+                context = self.worker_context):
+            status, op_error = (result[0], result[1]) if result else ('Unknown', str(error))
+            if not result or (status in finished_states and status != 'Succeeded'):
+                failed += 1
+            self.print_operation(operation_info(entry['id'], entry['operation'], entry['resource'], status, 
+                    round(time.time() - entry['started_at'], 1), op_error))
+        return failed == 0
+
+    def wait_operations(self, ids = None, timeout = None, parallel = 10):
+        # wait for the saved operations, finished ones and ones whose url
+        # cannot be polled are removed from the store
+        store = operation_store()
+        entries = store.load(ids)
+        finished = []
+        failed = 0
+        for entry, result, error in run_concurrently(lambda entry: self.wait_operation(entry, timeout), entries, parallel,
+                context = self.worker_context):
+            status, op_error = result if result else ('Unknown', str(error))
+            if status in finished_states or isinstance(error, ValueError):
+                finished.append(entry['id'])
+            if status != 'Succeeded':
+                failed += 1
+            self.print_operation(operation_info(entry['id'], entry['operation'], entry['resource'], status, 
+                    round(time.time() - entry['started_at'], 1), op_error))
+        store.remove(finished)
+        logger.info('{} of {} operations succeeded'.format(len(entries) - failed, len(entries)))
+        return failed == 0
+
     def print_storage_account_info(self, sa):
-        logger.info('')
-        logger.info('\tName: {}'.format(sa.name))
         kind = str(sa.kind)
         kind = kind.split('.')[1]
-        logger.info('\tKind: {}'.format(kind))
         replication = str(sa.sku.name).split('.')[1] 
+        if self.output == 'jsonl':
+            write_record(storage_account_info(sa.name, kind, replication, sa.location))
+            return
+        logger.info('')
+        logger.info('\tName: {}'.format(sa.name))
+        logger.info('\tKind: {}'.format(kind))
         logger.info('\tReplication: {}'.format(replication))
         logger.info('\tLocation: {}'.format(sa.location))
 
     def list_resource_groups(self):
         for rg in self.resource_client.resource_groups.list():
+            if self.output == 'jsonl':
+                write_record(resource_group_info(rg.name, rg.location))
+                continue
             logger.info('') 
             logger.info('\tName: {}'.format(rg.name))
             logger.info('\tLocation: {}'.format(rg.location))
     
     def list_subscriptions(self):
         for subscription in self.subscription_client.subscriptions.list():
+            if self.output == 'jsonl':
+                write_record(subscription_info(subscription.subscription_id, subscription.display_name))
+                continue
             logger.info('\tName: {}'.format(subscription.display_name))
             logger.info('\tID: {}'.format(subscription.subscription_id))
 
@@ -118,7 +804,7 @@ class azure_operations:
 
     def delete_resource_group(self, resource_group):
         delete_rg = self.resource_client.resource_groups.delete(resource_group)
-        delete_rg.wait()
+        self.wait_for(delete_rg, 'delete', resource_group)
 
     def list_storage_accounts(self, resource_group = None):
         if resource_group:
@@ -135,6 +821,8 @@ class azure_operations:
         return False
 
     def create_storage_account(self, resource_group, sa_name, account_kind = None, replication_type = None, access_tier = None):
+        from azure.mgmt.storage.models import Sku, StorageAccountCreateParameters
+
         if account_kind is None:
             account_kind = 'Storage'
         elif account_kind not in account_types:
@@ -167,73 +855,128 @@ class azure_operations:
 
         param = StorageAccountCreateParameters(sku = Sku(replication_type), kind = account_kind, location = location, access_tier = access_tier)  
         async_sa_create = self.storage_client.storage_accounts.create(resource_group, sa_name, param)
-        async_sa_create.wait()
+        self.wait_for(async_sa_create, 'create', sa_name)
+        self.invalidate_storage_account_index()
 
     def delete_storage_account(self, resource_group, sa_name):
         async_sa_delete = self.storage_client.storage_accounts.delete(
                               resource_group,
                               sa_name
                           )
+        self.invalidate_storage_account_index()
+
+    def invalidate_storage_account_index(self):
+        self.storage_account_index = None
+        self.storage_account_keys = {}
+        self.blob_services = {}
+
+    def get_storage_account(self, storage_account):
+        with self.lock:
+            if self.storage_account_index is None:
+                storage_account_index = {}
+                for sa in self.storage_client.storage_accounts.list():
+                    storage_account_index[sa.name] = sa
+                self.storage_account_index = storage_account_index
+            return self.storage_account_index.get(storage_account)
 
     def get_resource_group_by_storage_account(self, storage_account):
-        for sa in self.storage_client.storage_accounts.list():
-            if sa.name == storage_account:
-                return sa.id.split('/')[4]
+        sa = self.get_storage_account(storage_account)
+        if sa:
+            return sa.id.split('/')[4]
 
     def list_storage_account_primary_key(self, storage_account, resource_group = None):
+        # keys of different accounts are fetched without holding the lock, so
+        # workers scanning several accounts do not queue behind each other
+        storage_account_primary_key = self.storage_account_keys.get(storage_account)
+        if storage_account_primary_key:
+            return storage_account_primary_key
+
         if not resource_group:
             resource_group = self.get_resource_group_by_storage_account(storage_account)
         storage_account_keys = self.storage_client.storage_accounts.list_keys(resource_group, storage_account)
         storage_account_keys_map = {v.key_name: v.value for v in storage_account_keys.keys}
         storage_account_primary_key = storage_account_keys_map['key1']
+        with self.lock:
+            self.storage_account_keys[storage_account] = storage_account_primary_key
         
         return storage_account_primary_key
 
+    def get_blob_service(self, storage_account, resource_group = None):
+        from azure.storage.blob.baseblobservice import BaseBlobService
+
+        blob_service = self.blob_services.get(storage_account)
+        if blob_service is None:
+            account_key = self.list_storage_account_primary_key(storage_account, resource_group)
+            with self.lock:
+                blob_service = self.blob_services.get(storage_account)
+                if blob_service is None:
+                    blob_service = BaseBlobService(account_name = storage_account ,account_key = account_key)
+                    throttle.throttle_blob_service(blob_service, storage_account)
+                    self.blob_services[storage_account] = blob_service
+
+        return blob_service
+
     def create_storage_container(self, storage_account, container, resource_group = None):
         if re.search(r'[^-0-9a-z]', container) is not None: 
             raise ValueError('Invalid container name. Only '-', small letters and digits are allowed.')
 
-        account_key = self.list_storage_account_primary_key(storage_account, resource_group)
-
-        blob_service = BaseBlobService(account_name = storage_account ,account_key = account_key)
+        blob_service = self.get_blob_service(storage_account, resource_group)
         create_container = blob_service.create_container(container_name = container)
 
     def list_storage_container(self, storage_account):
-        account_key = self.list_storage_account_primary_key(storage_account)
-
-        blob_service = BaseBlobService(account_name = storage_account ,account_key = account_key)
+        blob_service = self.get_blob_service(storage_account)
         containers = blob_service.list_containers()
         for container in containers:
-            logger.info(container.name)
+            if self.output == 'jsonl':
+                write_record(container_info(storage_account, container.name))
+            else:
+                logger.info(container.name)
+
+    def list_blob_pages(self, blob_service, container, marker = None, page_size = 1000):
+        # yields one page of blobs at a time, following the continuation
+        # marker, so only a page of a large container is held in memory;
+        # the marker of the following page is the page's next_marker
+        while True:
+            blobs = blob_service.list_blobs(container_name = container, marker = marker, num_results = page_size)
+            yield blobs
+            marker = blobs.next_marker
+            if not marker:
+                break
 
     def list_vhd_per_container(self, blob_service, storage_account, container):
-        blobs = blob_service.list_blobs(container_name = container)
-        for blob in blobs:
-            if re.search(r'\.vhd', blob.name):
-                logger.info('{}/{}/{}: {}/{}'.format(storage_account, container, blob.name, 
-                       blob.properties.lease.status, blob.properties.lease.state))
+        for blobs in self.list_blob_pages(blob_service, container):
+            for blob in blobs:
+                if '.vhd' not in blob.name:
+                    continue
+                if self.output == 'jsonl':
+                    write_record(vhd_info(storage_account, container, blob.name, 
+                        blob.properties.lease.status, blob.properties.lease.state))
+                else:
+                    logger.info('{}/{}/{}: {}/{}'.format(storage_account, container, blob.name, 
+                           blob.properties.lease.status, blob.properties.lease.state))
 
-    def list_vhd_per_storage_account(self, resource_group, sa_ref, container):
-        if sa_ref.kind == Kind.blob_storage:
-            logger.debug('Listing VHD operations will neglect Blob storage account {}.',format(sa_ref.name))
-            return
+    def list_vhd_containers(self, resource_group, sa_ref, container):
+        # returns the (blob service, storage account, container) to scan for vhds
+        from azure.mgmt.storage.models import Kind
 
-        account_key = self.list_storage_account_primary_key(sa_ref.name, resource_group)
+        if sa_ref.kind == Kind.blob_storage:
+            logger.debug('Listing VHD operations will neglect Blob storage account {}.'.format(sa_ref.name))
+            return []
 
-        blob_service = BaseBlobService(account_name = sa_ref.name ,account_key = account_key)
+        blob_service = self.get_blob_service(sa_ref.name, resource_group)
         if container:
-            self.list_vhd_per_container(blob_service, sa_ref.name, container)
-        else:
-            containers = blob_service.list_containers()
-            for container in containers:
-                self.list_vhd_per_container(blob_service, sa_ref.name, container.name)
+            return [(blob_service, sa_ref.name, container)]
+        return [(blob_service, sa_ref.name, container_ref.name) for container_ref in blob_service.list_containers()]
 
-    def list_vhds(self, resource_group, storage_account, container, managed = False):
+    def list_vhds(self, resource_group, storage_account, container, managed = False, parallel = 1):
         if resource_group:
             # list all managed disks under this resource group
             managed_disk_refs = self.compute_client.disks.list_by_resource_group(resource_group)
             for managed_disk_ref in managed_disk_refs:
-                if managed_disk_ref.managed_by:
+                if self.output == 'jsonl':
+                    attached_vm = managed_disk_ref.managed_by.split('/')[-1] if managed_disk_ref.managed_by else None
+                    write_record(managed_disk_info(managed_disk_ref.name, attached_vm))
+                elif managed_disk_ref.managed_by:
                     logger.info('{}: Attached to VM {}'.format(managed_disk_ref.name, 
                           managed_disk_ref.managed_by.split('/')[-1]))
                 else:
@@ -245,88 +988,223 @@ class azure_operations:
         
         if not managed:
             if storage_account:
-                for sa_ref in storage_accounts:
-                    if storage_account == sa_ref.name:
-                        resource_group = sa_ref.id.split('/')[4]
-                        self.list_vhd_per_storage_account(resource_group, sa_ref, container)
+                sa_refs = [sa_ref for sa_ref in storage_accounts if storage_account == sa_ref.name]
             else:
                 # list unmanaged disks under all storage accounts
-                for sa_ref in storage_accounts:
-                    resource_group = sa_ref.id.split('/')[4]
-                    self.list_vhd_per_storage_account(resource_group, sa_ref, container)
-
-    def print_vm_info(self, resource_group, vm_obj):
-        logger.info('')
-        logger.info('VM UUID : {}'.format(vm_obj.vm_id))
-        logger.info('VM Name : {}'.format(vm_obj.name))
-        logger.info('VM Location : {}'.format(vm_obj.location))
-        logger.info('VM Size : {}'.format(vm_obj.hardware_profile.vm_size))
-        
-        vm_size_obj = self.get_vm_size(vm_obj.location, vm_obj.hardware_profile.vm_size)
-        logger.info('CPU cores : {}'.format(vm_size_obj.number_of_cores))
-        logger.info('Memory size : {} GB'.format(vm_size_obj.memory_in_mb/1024))
-
-        state = self.list_vm_state(resource_group, vm_obj.name)
+                sa_refs = list(storage_accounts)
+
+            # first list the containers of every account, then scan all
+            # containers, each step with up to parallel workers
+            list_containers = lambda sa_ref: self.list_vhd_containers(sa_ref.id.split('/')[4], sa_ref, container)
+            containers = []
+            for sa_ref, sa_containers, error in run_concurrently(list_containers, sa_refs, parallel,
+                    context = self.worker_context):
+                if error:
+                    logger.error('Failed to list containers of {}: {}'.format(sa_ref.name, error))
+                else:
+                    containers.extend(sa_containers)
+
+            list_vhds = lambda args: self.list_vhd_per_container(*args)
+            for (blob_service, sa_name, container_name), result, error in run_concurrently(list_vhds, containers, parallel,
+                    context = self.worker_context):
+                if error:
+                    logger.error('Failed to list VHDs of {}/{}: {}'.format(sa_name, container_name, error))
+
+    def print_vm_info(self, resource_group, vm_obj, snapshot = None):
+        self.print_vm_record(self.get_vm_info(resource_group, vm_obj, snapshot))
+
+    def get_vm_info(self, resource_group, vm_obj, snapshot = None):
+        # fetch everything listed for a vm without printing, so that several
+        # vms can be fetched concurrently
+        vm_size = vm_obj.hardware_profile.vm_size
+        vm_size_obj = self.get_vm_size(vm_obj.location, vm_size)
+        number_of_cores = vm_size_obj.number_of_cores if vm_size_obj else None
+        memory_in_mb = vm_size_obj.memory_in_mb if vm_size_obj else None
+
+        if vm_obj.instance_view:
+            state = self.get_instance_view_state(vm_obj.instance_view)
+        elif snapshot and vm_obj.name in snapshot.states:
+            state = snapshot.states[vm_obj.name]
+        else:
+            state = self.get_vm_state(resource_group, vm_obj.name)
         # For a failed VM, we do not scan its resources as they may not exist 
         if 'failed' in state:
-            return
+            return vm_info(vm_obj.name, vm_obj.vm_id, vm_obj.location, vm_size, number_of_cores, memory_in_mb,
+                       state, None, None, None, None)
 
-        self.list_vm_public_ip(resource_group, vm_obj.name)
-        self.list_vm_private_ip(resource_group, vm_obj.name)
-        # list disks
+        nics = self.get_vm_nics(resource_group, vm_obj, snapshot)
+        public_ips = self.get_vm_public_ips(nics, snapshot)
+        private_ips = self.get_vm_private_ips(nics)
+
+        os_disk = None
         os_disk_ref = vm_obj.storage_profile.os_disk
         if os_disk_ref:
+            os_disk = vm_disk_info(None, os_disk_ref.name, os_disk_ref.vhd.uri if os_disk_ref.vhd else None, 
+                          self.get_vm_disk_size(os_disk_ref, snapshot))
+
+        data_disks = []
+        for data_disk_ref in vm_obj.storage_profile.data_disks or []:
+            data_disks.append(vm_disk_info(data_disk_ref.lun, data_disk_ref.name, 
+                                  data_disk_ref.vhd.uri if data_disk_ref.vhd else None, 
+                                  self.get_vm_disk_size(data_disk_ref, snapshot)))
+
+        return vm_info(vm_obj.name, vm_obj.vm_id, vm_obj.location, vm_size, number_of_cores, memory_in_mb,
+                   state, public_ips, private_ips, os_disk, data_disks)
+
+    def print_vm_record(self, record):
+        if self.output == 'jsonl':
+            write_record(record)
+            return
+        logger.info('')
+        logger.info('VM UUID : {}'.format(record.vm_id))
+        logger.info('VM Name : {}'.format(record.name))
+        logger.info('VM Location : {}'.format(record.location))
+        logger.info('VM Size : {}'.format(record.vm_size))
+        logger.info('CPU cores : {}'.format(record.number_of_cores))
+        logger.info('Memory size : {} GB'.format(record.memory_in_mb/1024 if record.memory_in_mb else None))
+        logger.info('VM Status : {}'.format(record.state))
+        # a failed vm is listed without its resources
+        if record.public_ips is None:
+            return
+
+        logger.info('VM Public IP : {}'.format(','.join(record.public_ips)))
+        logger.info('VM Private IP :\n {}'.format(self.format_private_ips(record.private_ips)))
+        # list disks
+        if record.os_disk:
             logger.info('VM OS Disk : ')
-            if os_disk_ref.vhd:
-                logger.info('  {}'.format(os_disk_ref.vhd.uri))
-            if os_disk_ref.disk_size_gb:
-                logger.info('  size : {} GiB'.format(os_disk_ref.disk_size_gb))
-            elif os_disk_ref.vhd:
-                disk_size_gb = self.get_disk_size(os_disk_ref.vhd.uri)
-                logger.info('  size : {} GiB'.format(disk_size_gb))
-            else:
-                logger.info('  size : None')
+            if record.os_disk.uri:
+                logger.info('  {}'.format(record.os_disk.uri))
+            logger.info('  size : {}'.format('{} GiB'.format(record.os_disk.size_gb) if record.os_disk.size_gb else 'unknown'))
 
-        data_disk_refs = vm_obj.storage_profile.data_disks
-        if data_disk_refs:
+        if record.data_disks:
             logger.info('VM Data Disk : ')
-            for data_disk_ref in data_disk_refs:
-                logger.info('  lun : {}'.format(data_disk_ref.lun))
-                if data_disk_ref.vhd:
-                    logger.info('  {}'.format(data_disk_ref.vhd.uri))
-                if data_disk_ref.disk_size_gb:
-                    logger.info('  size : {} GiB'.format(data_disk_ref.disk_size_gb))
-                elif data_disk_ref.vhd:
-                    disk_size_gb = self.get_disk_size(data_disk_ref.vhd.uri)
-                    logger.info('  size : {} GiB'.format(disk_size_gb))
-                else:
-                    logger.info('  size : None')
-
-    def list_virtual_machines(self, resource_group, vmname = None, status = None):
+            for data_disk in record.data_disks:
+                logger.info('  lun : {}'.format(data_disk.lun))
+                if data_disk.uri:
+                    logger.info('  {}'.format(data_disk.uri))
+                logger.info('  size : {}'.format('{} GiB'.format(data_disk.size_gb) if data_disk.size_gb else 'unknown'))
+
+    def get_vm_disk_size(self, disk_ref, snapshot = None):
+        disk_size_gb = disk_ref.disk_size_gb
+        if not disk_size_gb:
+            if disk_ref.vhd:
+                disk_size_gb = self.get_disk_size(disk_ref.vhd.uri, snapshot)
+            elif disk_ref.managed_disk and snapshot:
+                managed_disk_ref = snapshot.disks.get(disk_ref.managed_disk.id.lower())
+                if managed_disk_ref:
+                    disk_size_gb = managed_disk_ref.disk_size_gb
+        return disk_size_gb
+
+    def list_virtual_machines(self, resource_group, vmname = None, status = None, parallel = 1):
         if vmname is None:
-            for vm in self.compute_client.virtual_machines.list(resource_group):
-                self.print_vm_info(resource_group, vm)
+            # list the group's vms, nics, public ips and disks once instead of per vm
+            snapshot = resource_group_snapshot(self, resource_group)
+            vms = sorted(snapshot.vms, key = lambda vm: vm.name)
+            # details are fetched by up to parallel workers, but printed in name order
+            get_vm_info = lambda vm: self.get_vm_info(resource_group, vm, snapshot)
+            for vm, record, error in run_concurrently(get_vm_info, vms, parallel, context = self.worker_context):
+                if error:
+                    logger.error('Failed to list VM {}: {}'.format(vm.name, error))
+                else:
+                    self.print_vm_record(record)
         else:
             vm = self.get_vm(resource_group, vmname)
             self.print_vm_info(resource_group, vm)
     
     def list_vm_size(self, resource_group, vmname):
         vm = self.get_vm(resource_group, vmname)
+        if not vm:
+            raise ValueError('VM {} does not exist.'.format(vmname))
         vm_size = vm.hardware_profile.vm_size
         vm_size_ref = self.get_vm_size(vm.location, vm_size)
+        if self.output == 'jsonl':
+            # a size missing from the location's catalog keeps only its name
+            write_record(vm_size_ref or vm_size_info(vm_size, None, None, None, None, None))
+            return
         logger.info('VM Size : {}'.format(vm_size))
+        if not vm_size_ref:
+            logger.info('Size {} not found in {}'.format(vm_size, vm.location))
+            return
         logger.info('CPU cores : {}'.format(vm_size_ref.number_of_cores))
         logger.info('Memory size : {} GB'.format(vm_size_ref.memory_in_mb/1024))
 
-    def list_vm_state(self, resource_group, vmname):
+    def list_vm_state(self, resource_group, vmname = None):
+        # vmname may be a ',' separated list, all vms of the group if not given;
+        # several vms are served by one status-only listing
+        vmnames = [name.strip() for name in vmname.split(',')] if vmname else None
+        if vmnames and len(vmnames) == 1:
+            states = {vmnames[0] : self.get_vm_state(resource_group, vmnames[0])}
+        else:
+            failed = []
+            states = dict((name, state) for (rg, name), state in self.get_vm_states(resource_group, failed = failed).items())
+            if vmnames:
+                for name in vmnames:
+                    if name in [failed_name for rg, failed_name in failed]:
+                        raise ValueError('Failed to get the state of VM {}.'.format(name))
+                    if name not in states:
+                        raise ValueError('VM {} does not exist.'.format(name))
+                states = dict((name, states[name]) for name in vmnames)
+
+        for name in sorted(states):
+            if self.output == 'jsonl':
+                write_record(vm_state_info(name, states[name]))
+            elif vmnames and len(vmnames) == 1:
+                logger.info('VM Status : {}'.format(states[name]))
+            else:
+                logger.info('VM {} Status : {}'.format(name, states[name]))
+        return states
+
+    def get_vm_state(self, resource_group, vmname):
         vm = self.get_vm(resource_group, vmname)
-        state = vm.instance_view.statuses[0].display_status
+        return self.get_instance_view_state(vm.instance_view)
+
+    def get_instance_view_state(self, instance_view):
+        state = instance_view.statuses[0].display_status
         # VM may not be successfully deployed in below case
         if state == 'Provisioning succeeded':
-            state = vm.instance_view.statuses[1].display_status
-        logger.info('VM Status : {}'.format(state))
+            state = instance_view.statuses[1].display_status
         return state
 
+    def list_group_vms(self, resource_group):
+        # the vms of a group, with their instance views where the sdk can expand them
+        try:
+            return list(self.compute_client.virtual_machines.list(resource_group, expand = 'instanceView'))
+        except TypeError:
+            # sdks before expand on the group listing
+            return list(self.compute_client.virtual_machines.list(resource_group))
+
+    def get_vm_states(self, resource_group = None, parallel = 10, failed = None, vms = None):
+        # (lower-cased resource group, vm name) -> state of the vms of the
+        # subscription from one status-only listing, or of one group from a
+        # listing of that group with instance views (vms, if that listing was
+        # already made); vms whose state could not be read are left out and
+        # appended to failed as (group, name)
+        if resource_group:
+            listed = vms if vms is not None else self.list_group_vms(resource_group)
+        else:
+            listed = self.compute_client.virtual_machines.list_all(status_only = 'true')
+        vms = [(vm.id.split('/')[4].lower(), vm) for vm in listed]
+
+        # sdks without status_only or expand list the vms without instance
+        # view, msrest ones even take the argument and drop it silently; then
+        # it is fetched per vm
+        def get_state(item):
+            vm_group, vm = item
+            instance_view = getattr(vm, 'instance_view', None)
+            if instance_view is not None and instance_view.statuses:
+                return self.get_instance_view_state(vm.instance_view)
+            return self.get_vm_state(vm_group, vm.name)
+
+        states = {}
+        for (vm_group, vm), state, error in run_concurrently(get_state, vms, parallel, context = self.worker_context):
+            if error:
+                logger.error('Failed to get the state of VM {}: {}'.format(vm.name, error))
+                if failed is not None:
+                    failed.append((vm_group, vm.name))
+            else:
+                states[(vm_group, vm.name)] = state
+        return states
+
     def get_vm(self, resource_group, vmname, expand = 'instanceview'):
         try:
             virtual_machine = self.compute_client.virtual_machines.get(
@@ -345,31 +1223,103 @@ class azure_operations:
                              resource_group,
                              vmname
                         )
-        async_vm_stop.wait()
+        self.wait_for(async_vm_stop, 'power_off', vmname)
 
     def deallocate_vm(self, resource_group, vmname):
         async_vm_deallocate = self.compute_client.virtual_machines.deallocate(
                                   resource_group, 
                                   vmname
                               )
-        async_vm_deallocate.wait()
+        self.wait_for(async_vm_deallocate, 'deallocate', vmname)
 
     def start_vm(self, resource_group, vmname):
         async_vm_start = self.compute_client.virtual_machines.start(
                              resource_group,
                              vmname
                          )
-        async_vm_start.wait()
+        self.wait_for(async_vm_start, 'start', vmname)
 
     def restart_vm(self, resource_group, vmname):
         async_vm_restart = self.compute_client.virtual_machines.restart(
                                resource_group,
                                vmname
                            )
-        async_vm_restart.wait()
+        self.wait_for(async_vm_restart, 'restart', vmname)
+
+    def select_vms(self, resource_group, names = None, tag = None):
+        # names is a ',' separated list which may contain glob patterns, tag
+        # is 'key' or 'key=value'; plain names are used without a listing
+        patterns = [name.strip() for name in names.split(',') if name.strip()] if names else []
+        if not tag and not any(re.search(r'[*?\[]', pattern) for pattern in patterns):
+            return patterns
+
+        tag_key, tag_value = (tag.split('=', 1) + [None])[:2] if tag else (None, None)
+        selected = []
+        for vm in self.compute_client.virtual_machines.list(resource_group):
+            if patterns and not any(fnmatch.fnmatchcase(vm.name, pattern) for pattern in patterns):
+                continue
+            if tag_key:
+                tags = vm.tags or {}
+                if tag_key not in tags or (tag_value is not None and tags[tag_key] != tag_value):
+                    continue
+            selected.append(vm.name)
+        return sorted(selected)
+
+    def power_vms(self, resource_group, vmnames, command, parallel = 10):
+        # launch the operation on every vm first, then wait for all of them;
+        # both steps run with up to parallel workers
+        operation = getattr(self.compute_client.virtual_machines, power_operations[command])
+        start_time = time.time()
+
+        def launch(vmname):
+            return time.time(), operation(resource_group, vmname)
+
+        def wait(launched):
+            vmname, (launch_time, poller) = launched
+            poller.result()
+            return time.time() - launch_time
+
+        pollers = []
+        started = []
+        results = []
+        for vmname, launched, error in run_concurrently(launch, vmnames, parallel, context = self.worker_context):
+            if error:
+                results.append(vm_operation_info(vmname, command, False, None, str(error)))
+            elif self.no_wait:
+                self.wait_for(launched[1], command, vmname)
+                started.append(vmname)
+            else:
+                pollers.append((vmname, launched))
+
+        for (vmname, launched), seconds, error in run_concurrently(wait, pollers, parallel,
+                context = self.worker_context):
+            if error:
+                results.append(vm_operation_info(vmname, command, False, None, str(error)))
+            else:
+                results.append(vm_operation_info(vmname, command, True, round(seconds, 1), None))
+
+        for result in sorted(results, key = lambda result: result.name):
+            if self.output == 'jsonl':
+                write_record(result)
+            elif result.succeeded:
+                logger.info('VM {}: {} succeeded in {:.0f}s'.format(result.name, command, result.seconds))
+            else:
+                logger.error('VM {}: {} failed: {}'.format(result.name, command, result.error))
+
+        if self.no_wait:
+            logger.info('{} started on {} of {} VMs'.format(command, len(started), len(vmnames)))
+            return results
+        succeeded = len([result for result in results if result.succeeded])
+        logger.info('{} {} of {} VMs in {:.0f}s'.format(command, succeeded, len(results), time.time() - start_time))
+        return results
 
     # for a full delte, even the data disks will be deleted
     def delete_vm(self, resource_group, vmname, keep_data = False):
+        # its nics and disks can only go once the vm is gone, which a saved
+        # operation cannot be chained with
+        if self.no_wait:
+            raise ValueError('A vm cannot be deleted with --no-wait, its nics and disks wait for the vm delete.')
+
         vm = self.get_vm(resource_group, vmname)
         if not vm:
             return
@@ -387,79 +1337,102 @@ class azure_operations:
                           )
         async_vm_delete.wait()
 
-        for nic in nics:
-            nic_name = nic.id.split('/')[8]
-            self.delete_nic(resource_group, nic_name)
-        
-        # Delete the OS disk
-        # unmanaged disks
-        managed_disk = False
-        if os_disk.vhd: 
-            os_disk_uri = os_disk.vhd.uri
-
-            os_disk_container = os_disk_uri.split('/')[3]
-            os_disk_blob_name = os_disk_uri.split('/')[4]
-            os_disk_storage_account_name = os_disk_uri.split('/')[2].split('.')[0]
-            managed_disk = False
-        # managed disks
-        else:
-            os_disk_blob_name = os_disk.name
-            os_disk_container = None
-            os_disk_storage_account_name = None
-            managed_disk = True 
-        
-        self.delete_blob(resource_group, os_disk_storage_account_name, os_disk_container, os_disk_blob_name, managed_disk)
+        # once the vm is gone its nics (each followed by its public ip) and its
+        # disks no longer depend on each other, so every branch runs concurrently
+        branches = [('nic', nic.id.split('/')[8]) for nic in nics]
+        disks = [os_disk] if keep_data else [os_disk] + list(data_disks)
+        for disk in disks:
+            if disk.vhd:
+                # https://<storage account>.blob.core.windows.net/<container>/<blob>
+                disk_uri = disk.vhd.uri.split('/')
+                branches.append(('vhd', (disk_uri[2].split('.')[0], disk_uri[3], disk_uri[4])))
+            else:
+                branches.append(('disk', disk.name))
+
+        def delete_branch(branch):
+            kind, target = branch
+            if kind == 'nic':
+                self.delete_nic(resource_group, target)
+            elif kind == 'vhd':
+                self.delete_blob(resource_group, target[0], target[1], target[2], False, False)
+            else:
+                self.wait_for(self.compute_client.disks.delete(resource_group, target), 'delete', target)
+
+        failures = []
+        touched_containers = set()
+        for (kind, target), result, error in run_concurrently(delete_branch, branches, len(branches),
+                context = self.worker_context):
+            if error:
+                failures.append('{} {}: {}'.format(kind, target if kind != 'vhd' else '/'.join(target), error))
+            elif kind == 'vhd':
+                touched_containers.add(target[:2])
+
+        # containers are checked for emptiness once all disks are gone
+        for storage_account, container in touched_containers:
+            try:
+                self.delete_container_if_empty(storage_account, container)
+            except Exception as e:
+                failures.append('container {}/{}: {}'.format(storage_account, container, e))
 
-        # Delete all the data disks
-        if not keep_data:
-            managed_disk = False
-            for data_disk in data_disks:
-                # unmanaged disk:
-                if data_disk.vhd:
-                    data_disk_uri = data_disk.vhd.uri
-                    data_disk_container = data_disk_uri.split('/')[3]
-                    data_disk_blob_name = data_disk_uri.split('/')[4]
-                    data_disk_storage_account_name = data_disk_uri.split('/')[2].split('.')[0]
-                    managed_disk = False
-                # managed disks
-                else:
-                    data_disk_blob_name = data_disk.name
-                    data_disk_container = None
-                    data_disk_storage_account_name = None
-                    managed_disk = True 
-    
-                self.delete_blob(resource_group, data_disk_storage_account_name, data_disk_container, data_disk_blob_name, managed_disk)
+        if failures:
+            raise ValueError('Failed to delete some resources of VM {}:\n{}'.format(vmname, '\n'.join(failures)))
  
     def delete_container(self, storage_account, container):
-        account_key = self.list_storage_account_primary_key(storage_account)
-        blob_service = BaseBlobService(account_name = storage_account ,account_key = account_key)
+        blob_service = self.get_blob_service(storage_account)
         blob_service.delete_container(container_name = container)
 
-    def delete_blob(self, resource_group, storage_account, container, blob_name, managed_disk = False):
+    def delete_blob(self, resource_group, storage_account, container, blob_name, managed_disk = False, remove_empty_container = True):
+        # callers deleting several blobs of a container pass remove_empty_container = False
+        # and call delete_container_if_empty once afterwards
         if not managed_disk:
-            account_key = self.list_storage_account_primary_key(storage_account)
-            blob_service = BaseBlobService(account_name = storage_account ,account_key = account_key)
+            blob_service = self.get_blob_service(storage_account)
             blob_service.delete_blob(container_name = container, blob_name = blob_name)
-            
-            remaining_blobs = blob_service.list_blobs(container_name = container)
-            if len(list(remaining_blobs)) == 0:
-                delete_container = blob_service.delete_container(container_name = container)
+            if remove_empty_container:
+                self.delete_container_if_empty(storage_account, container)
         else:
             self.compute_client.disks.delete(resource_group, blob_name)
 
-    def get_disk_size(self, disk_uri):
+    def container_is_empty(self, blob_service, container):
+        # fetch at most one entry rather than the whole listing
+        for blob in blob_service.list_blobs(container_name = container, num_results = 1):
+            return False
+        return True
+
+    def delete_container_if_empty(self, storage_account, container):
+        blob_service = self.get_blob_service(storage_account)
+        if self.container_is_empty(blob_service, container):
+            blob_service.delete_container(container_name = container)
+
+    def get_disk_size(self, disk_uri, snapshot = None):
         #https://ddvestg.blob.core.windows.net/aimee-atos-test-cbj3zksbhkgme-vhds/aimee-atos-test-20170809-105218.vhd
         disk_info = disk_uri.split('/')
         storage_account = disk_info[2].split('.')[0]
         container = disk_info[-2]
         disk_name = disk_info[-1]
 
-        account_key = self.list_storage_account_primary_key(storage_account)
-        blob_service = BaseBlobService(account_name = storage_account ,account_key = account_key)
-        disk_size = blob_service.get_blob_properties(container, disk_name).properties.content_length/1024/1024/1024
+        content_length = None
+        if snapshot:
+            # within a listing run, size all vhds of a container from one listing
+            content_length = self.get_container_blob_sizes(storage_account, container, snapshot).get(disk_name)
+        if content_length is None:
+            blob_service = self.get_blob_service(storage_account)
+            content_length = blob_service.get_blob_properties(container, disk_name).properties.content_length
+        disk_size = content_length/1024/1024/1024
 
         return disk_size
 
+    def get_container_blob_sizes(self, storage_account, container, snapshot):
+        with snapshot.container_lock(storage_account, container):
+            blob_sizes = snapshot.blob_sizes.get((storage_account, container))
+            if blob_sizes is None:
+                blob_sizes = {}
+                blob_service = self.get_blob_service(storage_account)
+                for blobs in self.list_blob_pages(blob_service, container):
+                    for blob in blobs:
+                        blob_sizes[blob.name] = blob.properties.content_length
+                snapshot.blob_sizes[(storage_account, container)] = blob_sizes
+        return blob_sizes
+
     def list_data_disks(self, resource_group, vmname):
         virtual_machine = self.get_vm(resource_group, vmname)
         if virtual_machine is None:
@@ -467,31 +1440,39 @@ class azure_operations:
         data_disks = virtual_machine.storage_profile.data_disks
         data_disks[:] = [disk for disk in data_disks if 'nvram' not in disk.name.lower()]
         for disk in data_disks:
+            disk_size_gb = self.get_vm_disk_size(disk)
+            if self.output == 'jsonl':
+                write_record(vm_disk_info(disk.lun, disk.name, disk.vhd.uri if disk.vhd else None, disk_size_gb))
+                continue
             logger.info('')
             logger.info('LUN : {}'.format(disk.lun))
             logger.info('Disk name : {}'.format(disk.name))
             if disk.vhd:
                 logger.info('VHD : {}'.format(disk.vhd.uri))
-            if disk.disk_size_gb:
-                logger.info('Disk size : {} GiB'.format(disk.disk_size_gb))
-            else:
-                disk_size_gb = self.get_disk_size(resource_group, disk.vhd.uri) 
-                logger.info('Disk size : {} GiB'.format(disk_size_gb))
+            logger.info('Disk size : {}'.format('{} GiB'.format(disk_size_gb) if disk_size_gb is not None else 'unknown'))
 
     def detach_data_disk(self, resource_group, vmname, disk_name):
+        # disk_name may be a ',' separated list, all disks are detached with one update
         virtual_machine = self.get_vm(resource_group, vmname)
         if virtual_machine is None:
             return
+        disk_names = [name.strip() for name in disk_name.split(',')]
         data_disks = virtual_machine.storage_profile.data_disks
-        data_disks[:] = [disk for disk in data_disks if disk.name != disk_name]
+        missing = [name for name in disk_names if name not in [disk.name for disk in data_disks]]
+        if missing:
+            raise ValueError('Disk {} is not attached to VM {}.'.format(', '.join(missing), vmname))
+        data_disks[:] = [disk for disk in data_disks if disk.name not in disk_names]
         async_vm_update = self.compute_client.virtual_machines.create_or_update(
                               resource_group,
                               vmname,
                               virtual_machine
                           )
-        async_vm_update.wait()
+        self.wait_for(async_vm_update, 'update', vmname)
 
     def print_vnet_info(self, vnet_obj):
+         if self.output == 'jsonl':
+             write_record(vnet_info(vnet_obj.name, vnet_obj.location, vnet_obj.address_space.address_prefixes))
+             return
          logger.info('')
          logger.info('Name : {}'.format(vnet_obj.name))
          logger.info('Location : {}'.format(vnet_obj.location))
@@ -526,16 +1507,21 @@ class azure_operations:
                                     }
                                 }
                             )
-        async_vnet_create.wait()
+        self.wait_for(async_vnet_create, 'create', vnet_name)
+        self.invalidate_vnet_index()
 
     def delete_vnet(self, resource_group, vnet):
         async_vnet_delete = self.network_client.virtual_networks.delete(
                                 resource_group,
                                 vnet
                             )
-        async_vnet_delete.wait()
+        self.wait_for(async_vnet_delete, 'delete', vnet)
+        self.invalidate_vnet_index()
 
     def print_subnet_info(self, subnet_obj):
+        if self.output == 'jsonl':
+            write_record(subnet_info(subnet_obj.name, str(subnet_obj.id.split('/')[8]), subnet_obj.address_prefix))
+            return
         logger.info('')
         logger.info('Name: {}'.format(subnet_obj.name))
         logger.info('VNet: {}'.format(str(subnet_obj.id.split('/')[8])))
@@ -576,7 +1562,8 @@ class azure_operations:
                                       'address_prefix' : addr_prefix 
                                   }
                               )
-        async_subnet_create.wait()
+        self.wait_for(async_subnet_create, 'create', subnet_name)
+        self.invalidate_vnet_index()
 
     def delete_subnet(self, resource_group, vnet, subnet):
         async_subnet_delete = self.network_client.subnets.delete(
@@ -584,7 +1571,8 @@ class azure_operations:
                                   vnet,
                                   subnet
                               )
-        async_subnet_delete.wait()
+        self.wait_for(async_subnet_delete, 'delete', subnet)
+        self.invalidate_vnet_index()
 
     def list_network_interfaces(self, resource_group):
         for nic in self.network_client.network_interfaces.list(resource_group):
@@ -592,6 +1580,10 @@ class azure_operations:
             attached_vm = nic.virtual_machine
             private_ip_addr = nic.ip_configurations[0].private_ip_address
             subnet_ref = nic.ip_configurations[0].subnet
+            if self.output == 'jsonl':
+                write_record(nic_info(name, subnet_ref.id.split('/')[8], subnet_ref.id.split('/')[10], private_ip_addr,
+                    attached_vm.id.split('/')[8] if attached_vm else None))
+                continue
             subnet_group = '{}/{}/{}: '.format(subnet_ref.id.split('/')[8], subnet_ref.id.split('/')[10], name)
             if attached_vm:
                 private_ip = '{}{} : Attached to VM {}'.format(subnet_group, private_ip_addr, attached_vm.id.split('/')[8])
@@ -603,44 +1595,69 @@ class azure_operations:
             public_ips = self.network_client.public_ip_addresses.list(resource_group)
             for public_ip in public_ips:
                 public_ip_name = public_ip.id.split('/')[-1]
-                logger.info('{} : {}'.format(public_ip_name, public_ip.ip_address))
-
-    def list_vm_public_ip(self, resource_group, vmname, nic_names = None):
+                if self.output == 'jsonl':
+                    write_record(public_ip_info(public_ip_name, public_ip.ip_address))
+                else:
+                    logger.info('{} : {}'.format(public_ip_name, public_ip.ip_address))
+
+    def get_vm_nics(self, resource_group, vm_obj, snapshot = None):
+        nics = []
+        for nic_ref in vm_obj.network_profile.network_interfaces:
+            nic = None
+            if snapshot:
+                nic = snapshot.nics.get(nic_ref.id.lower())
+            if nic is None:
+                nic = self.network_client.network_interfaces.get(nic_ref.id.split('/')[4], nic_ref.id.split('/')[8])
+            nics.append(nic)
+        return nics
+
+    def get_nics_by_name(self, resource_group, vmname, nic_names = None):
         if nic_names is None:
-            nic_names = []
             vm = self.get_vm(resource_group, vmname)
-            for nic_ref in vm.network_profile.network_interfaces:
-                nic_names.append(nic_ref.id.split('/')[8])
+            return self.get_vm_nics(resource_group, vm)
+        return [self.network_client.network_interfaces.get(resource_group, nic_name) for nic_name in nic_names]
+
+    def list_vm_public_ip(self, resource_group, vmname, nic_names = None):
+        self.print_vm_public_ip(self.get_nics_by_name(resource_group, vmname, nic_names))
+
+    def print_vm_public_ip(self, nics, snapshot = None):
+        logger.info('VM Public IP : {}'.format(','.join(self.get_vm_public_ips(nics, snapshot))))
+
+    def get_vm_public_ips(self, nics, snapshot = None):
         public_ips = []
-        for nic_name in nic_names:
-            nic = self.network_client.network_interfaces.get(resource_group, nic_name)
+        for nic in nics:
             ip_ref = nic.ip_configurations[0].public_ip_address
             if ip_ref is None:
                 continue
-            ip_group = ip_ref.id.split('/')[4]
-            ip_name = ip_ref.id.split('/')[8]
-            public_ip = self.network_client.public_ip_addresses.get(ip_group, ip_name)
+            public_ip = None
+            if snapshot:
+                public_ip = snapshot.public_ips.get(ip_ref.id.lower())
+            if public_ip is None:
+                ip_group = ip_ref.id.split('/')[4]
+                ip_name = ip_ref.id.split('/')[8]
+                public_ip = self.network_client.public_ip_addresses.get(ip_group, ip_name)
             if public_ip.ip_address:
                 public_ips.append(public_ip.ip_address)
-        
-        logger.info('VM Public IP : {}'.format(','.join(public_ips)))
+
+        return public_ips
 
     def list_vm_private_ip(self, resource_group, vmname, nic_names = None):
-        if nic_names is None:
-            nic_names = []
-            vm = self.get_vm(resource_group, vmname)
-            for nic_ref in vm.network_profile.network_interfaces:
-                nic_names.append(nic_ref.id.split('/')[8])
+        self.print_vm_private_ip(self.get_nics_by_name(resource_group, vmname, nic_names))
+
+    def print_vm_private_ip(self, nics):
+        logger.info('VM Private IP :\n {}'.format(self.format_private_ips(self.get_vm_private_ips(nics))))
+
+    def get_vm_private_ips(self, nics):
         private_ips = []
-        for nic_name in nic_names:
-            nic = self.network_client.network_interfaces.get(resource_group, nic_name)
+        for nic in nics:
             private_ip_addr = nic.ip_configurations[0].private_ip_address
             subnet_ref = nic.ip_configurations[0].subnet
-            subnet_group = '{}/{}: '.format(subnet_ref.id.split('/')[8], subnet_ref.id.split('/')[10])
-            private_ip = '{}{}'.format(subnet_group, private_ip_addr)
-            private_ips.append(private_ip)
+            private_ips.append(private_ip_info(subnet_ref.id.split('/')[8], subnet_ref.id.split('/')[10], private_ip_addr))
+
+        return private_ips
 
-        logger.info('VM Private IP :\n {}'.format(','.join(private_ips)))
+    def format_private_ips(self, private_ips):
+        return ','.join('{}/{}: {}'.format(*private_ip) for private_ip in private_ips)
 
     def create_nic(self, resource_group, vnet, subnet, location, nic_name):
         subnet_ref = self.get_subnet_by_vnet(location, vnet, subnet)
@@ -681,9 +1698,11 @@ class azure_operations:
 
     def delete_public_ip(self, resource_group, public_ip_name):
          async_nic_delete = self.network_client.public_ip_addresses.delete(resource_group, public_ip_name)
-         async_nic_delete.wait()
+         self.wait_for(async_nic_delete, 'delete', public_ip_name)
 
     def create_public_ip(self, resource_group, vmname, static_ip = False):
+        from azure.mgmt.network.models import PublicIPAddress
+
         if static_ip:
             create_opt = 'Static'
         else:
@@ -714,7 +1733,7 @@ class azure_operations:
                                nic_name,
                                nic
                            )
-        async_nic_create.wait()
+        self.wait_for(async_nic_create, 'update', nic_name)
 
     def get_nic(self, resource_group, nic_name):
         for nic in self.network_client.network_interfaces.list(resource_group):
@@ -730,21 +1749,65 @@ class azure_operations:
 
         return location
 
+    def get_vm_sizes_by_location(self, location):
+        # returns {size name: vm_size_info}, the catalog is fetched once per location
+        with self.lock:
+            return self.load_vm_sizes_by_location(location)
+
+    def load_vm_sizes_by_location(self, location):
+        key = '{}/{}'.format(self.subscription_id, location)
+        vm_sizes = self.vm_size_catalog.get(key)
+        if vm_sizes is not None:
+            return vm_sizes
+
+        catalog_path = None
+        if self.vm_size_cache_ttl > 0:
+            catalog_path = os.path.join(cache_dir(), 'vm_sizes.json')
+            entry = load_json_file(catalog_path).get(key)
+            if entry and entry['fetched_at'] + self.vm_size_cache_ttl > time.time():
+                vm_sizes = dict((name, vm_size_info(*fields)) for name, fields in entry['sizes'].items())
+
+        if vm_sizes is None:
+            vm_sizes = {}
+            for vm_size in self.compute_client.virtual_machine_sizes.list(location):
+                vm_sizes[vm_size.name] = vm_size_info(vm_size.name, vm_size.number_of_cores, vm_size.memory_in_mb,
+                        vm_size.os_disk_size_in_mb, vm_size.resource_disk_size_in_mb, vm_size.max_data_disk_count)
+            if catalog_path:
+                with file_lock(catalog_path + '.lock'):
+                    entries = load_json_file(catalog_path)
+                    entries[key] = {
+                        'fetched_at' : time.time(),
+                        'sizes' : dict((name, list(info)) for name, info in vm_sizes.items())
+                    }
+                    dump_json_file(catalog_path, entries)
+
+        self.vm_size_catalog[key] = vm_sizes
+        return vm_sizes
+
     def get_vm_size(self, location, size):
-        for vm_size in self.compute_client.virtual_machine_sizes.list(location):
-            if vm_size.name == size:
-                return vm_size
-        return None
+        return self.get_vm_sizes_by_location(location).get(size)
+
+    def invalidate_vnet_index(self):
+        # call after any vnet/subnet change, the index is rebuilt on next lookup
+        self.vnet_index = None
 
     def get_vnet_by_location(self, location, vnet_name):
-        for vnet in self.network_client.virtual_networks.list_all():
-            if vnet.location == location and vnet.name == vnet_name:
-                return vnet
-        return None
+        with self.lock:
+            if self.vnet_index is None:
+                vnet_index = {}
+                for vnet in self.network_client.virtual_networks.list_all():
+                    vnet_index[(vnet.location, vnet.name)] = vnet
+                self.vnet_index = vnet_index
+            return self.vnet_index.get((location, vnet_name))
 
     def get_subnet_by_vnet(self, location, vnet_name, subnet_name):
         vnet_obj = self.get_vnet_by_location(location, vnet_name)
         if vnet_obj:
+            # subnets come with the vnet listing
+            for subnet_ref in vnet_obj.subnets or []:
+                if subnet_ref.name == subnet_name:
+                    return subnet_ref
+            # may have been added since the index was built
             resource_group = str(vnet_obj.id.split('/')[4])
             try:
                 subnet_ref = self.network_client.subnets.get(resource_group, vnet_name, subnet_name)
@@ -754,124 +1817,223 @@ class azure_operations:
         return None
 
     def get_storage_account_by_location(self, location, storage_account):
-        for sa in self.storage_client.storage_accounts.list():
-            if sa.name == storage_account and sa.location == location:
-                return sa
+        sa = self.get_storage_account(storage_account)
+        if sa and sa.location == location:
+            return sa
         return None
 
     def create_vm(self, resource_group, storage_account, location, vm_size, vmname, vnet, subnet_list, 
                   ssh_public_key = None, publisher = None, offer = None, sku = None, image = None,
                   username = None, password = None, public_ip = False, static_public_ip = False):
-        # determine location
-        if not location:
-            location = self.get_location(resource_group) 
-
-        # vmname check
-        if re.search(r'[^-0-9A-Za-z]{5,12}', vmname) is not None:
-            raise ValueError('Illegal vm name. Only digits, letters and - can be used. Name length should be 5~12')
-        
-        # vm check
-        vm_obj = self.get_vm(resource_group, vmname)
-        if vm_obj:
-            raise ValueError('Illegal vm name. The specified vm already exists.')
+        vm, phases = self.deploy_vm(resource_group, storage_account, location, vm_size, vmname, vnet, subnet_list,
+                ssh_public_key, publisher, offer, sku, image, username, password, public_ip, static_public_ip)
+        if vm is not None:
+            self.print_vm_info(resource_group, vm)
+        self.print_vm_phases(vmname, phases)
 
+    def resolve_vm_spec(self, vm_size, publisher, offer, image):
+        # default offer and azure size of a vm, no api calls involved;
+        # returns (publisher, offer, vm_size, whether the size must be checked)
         # offer related check
         if not publisher and not offer:
             publisher = 'dellemc'
             offer = 'dell-emc-datadomain-virtual-edition'
 
-        # default username
-        if not username:
-            username = 'sysadmin'
-
-        # authentication check 
-        if not password and not ssh_public_key:
-            raise ValueError('Either Password or SSH Public Key must be specified.')
-        
         # size check
         if not re.search('Standard_', vm_size) and not re.search('\d+T', vm_size):
             raise ValueError('Please use either *T or Standard_* as vm size.')
         if (image and 'ddve' not in image.lower()) or publisher != 'dellemc' or offer != 'dell-emc-datadomain-virtual-edition' or 'Standard_' in vm_size:
+            # checked against the sizes of the location by check_vm_spec
+            return publisher, offer, vm_size, True
+        if supported_vm_sizes.get(vm_size.upper()) is None:
+            raise ValueError('Wrong capacity {} provided.'.format(vm_size))
+        return publisher, offer, supported_vm_sizes[vm_size.upper()], False
+
+    def check_vm_spec(self, location, vm_size, check_size, vnet, subnets, storage_account):
+        # the inputs vms of the same spec share, checked concurrently
+        def check_size_exists():
             # check whether this size of VM exists in this location
-            vm_size_obj = self.get_vm_size(location, vm_size)
-            if not vm_size_obj:
+            if not self.get_vm_size(location, vm_size):
                 raise ValueError('VM size {} does not exist in {}'.format(vm_size, location))
-        else:
-            if supported_vm_sizes.get(vm_size.upper()) is None:
-                raise ValueError('Wrong capacity {} provided.'.format(vm_size))
-            else:
-                vm_size = supported_vm_sizes[vm_size.upper()]
 
-        # vnet check
-        vnet_ref = self.get_vnet_by_location(location, vnet)
-        if not vnet_ref:
-            raise ValueError('Virtual network {} does not exist in location {}.'.format(vnet, location))
-       
-        # subnets check
-        subnets = subnet_list.split(',')
-        for subnet in subnets:
-            subnet_ref = self.get_subnet_by_vnet(location, vnet, subnet.strip())
-            if not subnet_ref:
-                raise ValueError('Subnet {} does not exist.'.format(subnet))
-            
-        # if storage account is not specified, managed disks will be used
-        if storage_account:
+        def check_vnet():
+            if not self.get_vnet_by_location(location, vnet):
+                raise ValueError('Virtual network {} does not exist in location {}.'.format(vnet, location))
+
+        def subnet_check(subnet):
+            def check_subnet():
+                if not self.get_subnet_by_vnet(location, vnet, subnet):
+                    raise ValueError('Subnet {} does not exist.'.format(subnet))
+            return check_subnet
+
+        def check_storage_account():
             if not self.get_storage_account_by_location(location, storage_account):
                 raise ValueError('Storage account {} not in location {}.'.format(storage_account, location))
-            # create storage container 
+
+        checks = [check_vnet] + [subnet_check(subnet) for subnet in subnets]
+        if check_size:
+            checks.append(check_size_exists)
+        # if storage account is not specified, managed disks will be used
+        if storage_account:
+            checks.append(check_storage_account)
+        self.call_concurrently(checks)
+
+    def list_group_nics(self, resource_group):
+        # nic name -> nic of a resource group; nics left over from an earlier
+        # attempt are reused
+        return dict((nic.name, nic) for nic in self.network_client.network_interfaces.list(resource_group))
+
+    def check_nics(self, existing_nics, nic_names):
+        for nic_name in nic_names:
+            if nic_name in existing_nics and existing_nics[nic_name].virtual_machine:
+                raise ValueError('NIC attached to an exsisting VM.')
+
+    def deploy_vm(self, resource_group, storage_account, location, vm_size, vmname, vnet, subnet_list, 
+                  ssh_public_key = None, publisher = None, offer = None, sku = None, image = None,
+                  username = None, password = None, public_ip = False, static_public_ip = False, validated = False, 
+                  existing_nics = None):
+        # creates a vm and returns (vm, [(phase, seconds)]), vm is None in no-wait mode;
+        # validated skips check_vm_spec for a spec the caller has already checked, and
+        # existing_nics (nic name -> nic of the group) the name and nic checks
+        from azure.mgmt.compute.models import Plan
+
+        if self.no_wait and public_ip:
+            raise ValueError('A public ip cannot be added to a vm created with --no-wait.')
+
+        phases = []
+        phase_start = time.time()
+
+        # vmname check
+        if re.search(r'[^-0-9A-Za-z]{5,12}', vmname) is not None:
+            raise ValueError('Illegal vm name. Only digits, letters and - can be used. Name length should be 5~12')
+
+        # default username
+        if not username:
+            username = 'sysadmin'
+
+        # authentication check 
+        if not password and not ssh_public_key:
+            raise ValueError('Either Password or SSH Public Key must be specified.')
+
+        publisher, offer, vm_size, check_size = self.resolve_vm_spec(vm_size, publisher, offer, image)
+        subnets = [subnet.strip() for subnet in subnet_list.split(',')]
+        nic_names = [vmname + '-nic{}'.format(nic_num) for nic_num in range(1, len(subnets) + 1)]
+
+        # the lookups below are independent of each other, so they run concurrently
+        # in two rounds: the second one needs the location
+        def check_vm():
+            if self.get_vm(resource_group, vmname):
+                raise ValueError('Illegal vm name. The specified vm already exists.')
+
+        def list_nics():
+            existing_nics = self.list_group_nics(resource_group)
+            self.check_nics(existing_nics, nic_names)
+            return existing_nics
+
+        checks = []
+        if existing_nics is None:
+            checks += [check_vm, list_nics]
+        if not location:
+            checks.append(lambda: self.get_location(resource_group))
+        results = self.call_concurrently(checks) if checks else []
+        if existing_nics is None:
+            existing_nics = results[1]
+            results = results[2:]
+        if not location:
+            location = results[0]
+
+        if not validated:
+            self.check_vm_spec(location, vm_size, check_size, vnet, subnets, storage_account)
+        phase_start = self.end_vm_phase(phases, 'validate', phase_start)
+
+        # the storage container and the missing nics are created concurrently
+        def create_missing_nic(nic):
+            nic_name, subnet = nic
+            if nic_name in existing_nics:
+                return existing_nics[nic_name]
+            return self.create_nic(resource_group, vnet, subnet, location, nic_name)
+
+        tasks = [lambda nic = nic: create_missing_nic(nic) for nic in zip(nic_names, subnets)]
+        if storage_account:
             container = '{}-vhds'.format(vmname)
-            self.create_storage_container(storage_account, container)
+            tasks.append(lambda: self.create_storage_container(storage_account, container))
         else:
             container = None
-
-        # create nic
-        nic_num = 0 
-        nic_ids = []
-        for subnet in subnets:
-            nic_num += 1
-            nic_name = vmname + '-nic{}'.format(nic_num) 
-            nic_ref = self.get_nic(resource_group, nic_name)
-            if not nic_ref:
-                nic_ref = self.create_nic(resource_group, vnet, subnet.strip(), location, nic_name)
-            else:
-                if nic_ref.virtual_machine:
-                    raise ValueError('NIC attached to an exsisting VM.')
-            nic_ids.append(nic_ref.id)
+        results = list(run_concurrently(lambda task: task(), tasks, len(tasks), context = self.worker_context))
+
+        def clean_up(created_nics, created_container):
+            # remove what this call created before giving up, reused nics stay
+            cleanup = [lambda nic_name = nic_name: self.delete_nic(resource_group, nic_name) 
+                       for nic_name in created_nics if nic_name not in existing_nics]
+            if created_container:
+                cleanup.append(lambda: self.delete_container(storage_account, container))
+            for func in cleanup:
+                try:
+                    func()
+                except Exception as e:
+                    logger.error('Failed to clean up after vm {}: {}'.format(vmname, e))
+
+        errors = [error for task, result, error in results if error]
+        if errors:
+            clean_up([nic_name for nic_name, (task, result, error) in zip(nic_names, results) if result is not None],
+                     storage_account and results[-1][2] is None)
+            raise errors[0]
+        nic_ids = [result.id for task, result, error in results[:len(nic_names)]]
+        phase_start = self.end_vm_phase(phases, 'nics', phase_start)
        
         # template parameters
-        try:
-            parameters = self.create_vm_parameters(resource_group = resource_group, location = location, 
-                             storage_account = storage_account, container = container, vm_size = vm_size, 
-                             vmname = vmname, nic_ids = nic_ids, ssh_public_key = ssh_public_key, 
-                             publisher = publisher, offer = offer, sku = sku, image = image,
-                             username = username, password = password)
-            
-            # try to deploy vm with a Plan
-            if publisher and offer and sku:
-                plan = Plan(name = sku, publisher = publisher, product = offer)
-                parameters.plan = plan 
-            else:
-                parameters.plan = None 
+        parameters = self.create_vm_parameters(resource_group = resource_group, location = location, 
+                         storage_account = storage_account, container = container, vm_size = vm_size, 
+                         vmname = vmname, nic_ids = nic_ids, ssh_public_key = ssh_public_key, 
+                         publisher = publisher, offer = offer, sku = sku, image = image,
+                         username = username, password = password)
+
+        # a marketplace image either needs a Plan or fails with one; if that is
+        # not known yet, try with a Plan first and then without one
+        if publisher and offer and sku:
+            needs_plan = self.image_needs_plan(location, publisher, offer, sku)
+            attempts = [True, False] if needs_plan is None else [needs_plan]
+        else:
+            attempts = [False]
 
-            async_vm_create = self.compute_client.virtual_machines.create_or_update(resource_group, 
-                                  vmname, parameters)
-            vm = async_vm_create.result()
-        except Exception as e:
-            # then try to deploy vm without a Plan
-            parameters.plan = None 
+        first_error = None
+        for with_plan in attempts:
+            if with_plan:
+                parameters.plan = Plan(name = sku, publisher = publisher, product = offer)
+            else:
+                parameters.plan = None
             try:
-                async_vm_create = self.compute_client.virtual_machines.create_or_update(resource_group,
+                async_vm_create = self.compute_client.virtual_machines.create_or_update(resource_group, 
                                       vmname, parameters)
-                vm = async_vm_create.result()
-            except Exception:
-                for subnet in subnets:
-                    nic_name = vmname + '-nic{}'.format(nic_num)
-                    self.delete_nic(resource_group, nic_name)
-                if storage_account:
-                    self.delete_container(storage_account, container)
-                logger.error('Failed to create vm.')
-                logger.error('{}'.format(e))
-                return
+                if len(attempts) > 1:
+                    # a Plan error may only show once the deployment has
+                    # finished, so the first vm of an image is waited for
+                    # even with --no-wait
+                    if self.no_wait:
+                        logger.info('Waiting for vm {} to learn whether its image needs a Plan.'.format(vmname))
+                    vm = async_vm_create.result()
+                else:
+                    vm = self.wait_for(async_vm_create, 'create', vmname)
+            except Exception as e:
+                first_error = first_error or e
+                # a Plan error with a known need means the cached answer is
+                # wrong, e.g. the image got or lost its Plan: try the other way
+                if len(attempts) == 1 and 'plan' in str(e).lower():
+                    marketplace_plan_cache().remove(publisher, offer, sku)
+                    attempts.append(not with_plan)
+                continue
+            if len(attempts) > 1:
+                marketplace_plan_cache().save(publisher, offer, sku, with_plan)
+            break
+        else:
+            clean_up(nic_names, storage_account)
+            raise ValueError('Failed to create vm {}: {}'.format(vmname, first_error))
+
+        phase_start = self.end_vm_phase(phases, 'vm', phase_start)
+
+        # started in no-wait mode, the steps below need the vm
+        if vm is None:
+            return None, phases
                  
         # add a public ip if needed
         if public_ip:
@@ -879,16 +2041,133 @@ class azure_operations:
                 self.create_public_ip(resource_group, vmname, True)
             else:
                 self.create_public_ip(resource_group, vmname, False)
+            phase_start = self.end_vm_phase(phases, 'public_ip', phase_start)
 
         # if a VM is created from a vhd converted manage disk, remove the intermediate os image
         if image and not storage_account:
             os_image = '{}-osImage'.format(vmname)
             self.compute_client.images.delete(resource_group, os_image)
 
-        self.print_vm_info(resource_group, vm)
+        return vm, phases
+
+    def create_fleet(self, resource_group, storage_account, location, vm_size, name_pattern, count, vnet, subnet_list, 
+                     ssh_public_key = None, publisher = None, offer = None, sku = None, image = None,
+                     username = None, password = None, public_ip = False, static_public_ip = False, 
+                     first_index = 1, parallel = 10):
+        # name_pattern is formatted with the index of each vm, e.g. ddve-{:02d}
+        if count < 1:
+            raise ValueError('The vm count must be at least 1.')
+        if '{' not in name_pattern:
+            raise ValueError('The name pattern must contain a {} placeholder for the vm index.')
+        vmnames = [name_pattern.format(index) for index in range(first_index, first_index + count)]
+        if len(set(vmnames)) != len(vmnames):
+            raise ValueError('The name pattern does not give a distinct name to every vm.')
+
+        # the spec, names and nics are checked once for the whole fleet
+        publisher, offer, vm_size, check_size = self.resolve_vm_spec(vm_size, publisher, offer, image)
+        if not location:
+            location = self.get_location(resource_group)
+        subnets = [subnet.strip() for subnet in subnet_list.split(',')]
+        existing_vms, existing_nics = self.call_concurrently([
+                lambda: set(vm.name for vm in self.compute_client.virtual_machines.list(resource_group)),
+                lambda: self.list_group_nics(resource_group),
+                lambda: self.check_vm_spec(location, vm_size, check_size, vnet, subnets, storage_account)])[:2]
+        taken = [vmname for vmname in vmnames if vmname in existing_vms]
+        if taken:
+            raise ValueError('Illegal vm name. VMs {} already exist.'.format(', '.join(taken)))
+        self.check_nics(existing_nics, [vmname + '-nic{}'.format(nic_num) for vmname in vmnames 
+                                        for nic_num in range(1, len(subnets) + 1)])
+
+        start_time = time.time()
+
+        def deploy(vmname):
+            deploy_start = time.time()
+            self.deploy_vm(resource_group, storage_account, location, vm_size, vmname, vnet, subnet_list,
+                    ssh_public_key, publisher, offer, sku, image, username, password, public_ip, static_public_ip, True, 
+                    existing_nics)
+            return time.time() - deploy_start
+
+        results = []
+        for vmname, seconds, error in run_concurrently(deploy, vmnames, parallel, context = self.worker_context):
+            if error:
+                result = vm_operation_info(vmname, 'create', False, None, str(error))
+            else:
+                result = vm_operation_info(vmname, 'create', True, round(seconds, 1), None)
+            results.append(result)
+            if self.output == 'jsonl':
+                write_record(result)
+            elif result.succeeded:
+                logger.info('VM {}: create succeeded in {:.0f}s'.format(vmname, seconds))
+            else:
+                logger.error('VM {}: create failed: {}'.format(vmname, result.error))
+
+        elapsed = time.time() - start_time
+        if self.no_wait:
+            logger.info('Started {} of {} VMs in {:.0f}s'.format(len([result for result in results if result.succeeded]), 
+                    len(results), elapsed))
+            return results
+        latencies = sorted(result.seconds for result in results if result.succeeded)
+        summary = fleet_info(len(results), len(latencies), round(elapsed, 1), round(len(latencies) * 60.0 / elapsed, 2),
+                percentile(latencies, 50), percentile(latencies, 95))
+        if self.output == 'jsonl':
+            write_record(summary)
+        else:
+            logger.info('Created {} of {} VMs in {:.0f}s, {:.2f} VMs/min'.format(summary.succeeded, summary.count, 
+                    summary.seconds, summary.vms_per_minute))
+            if latencies:
+                logger.info('Create latency: p50 {:.0f}s, p95 {:.0f}s'.format(summary.p50_seconds, summary.p95_seconds))
+        return results
+
+    def image_needs_plan(self, location, publisher, offer, sku):
+        # True/False from the plan cache or else from the image metadata, None
+        # if neither tells
+        cache = marketplace_plan_cache()
+        needs_plan = cache.lookup(publisher, offer, sku)
+        if needs_plan is None:
+            try:
+                # the latest version is the one deployed
+                versions = self.compute_client.virtual_machine_images.list(location, publisher, offer, sku)
+                latest = max((version.name for version in versions), key = version_key)
+                image = self.compute_client.virtual_machine_images.get(location, publisher, offer, sku, latest)
+            except Exception:
+                return None
+            needs_plan = image.plan is not None
+            cache.save(publisher, offer, sku, needs_plan)
+        return needs_plan
+
+    def call_concurrently(self, funcs):
+        # call independent functions concurrently and return their results in
+        # order, the first failure is raised once all of them are done
+        results = []
+        errors = []
+        for func, result, error in run_concurrently(lambda func: func(), funcs, len(funcs),
+                context = self.worker_context):
+            results.append(result)
+            if error:
+                errors.append(error)
+        if errors:
+            raise errors[0]
+        return results
+
+    def end_vm_phase(self, phases, phase, phase_start):
+        now = time.time()
+        phases.append((phase, now - phase_start))
+        return now
+
+    def print_vm_phases(self, vmname, phases):
+        if self.output == 'jsonl':
+            for phase, seconds in phases:
+                write_record(vm_phase_info(vmname, phase, round(seconds, 1)))
+            return
+        logger.info('VM {} took {:.1f}s ({})'.format(vmname, sum(seconds for phase, seconds in phases),
+                ', '.join('{} {:.1f}s'.format(phase, seconds) for phase, seconds in phases)))
 
     def create_vm_parameters(self, resource_group, location, storage_account, container, vm_size, vmname, nic_ids, 
                              ssh_public_key, publisher, offer, sku, image, username,  password):
+        from azure.mgmt.compute.models import HardwareProfile, SshConfiguration, SshPublicKey, LinuxConfiguration
+        from azure.mgmt.compute.models import OSProfile, ImageReference, VirtualHardDisk, OSDisk, DataDisk
+        from azure.mgmt.compute.models import StorageProfile, ManagedDiskParameters, NetworkInterfaceReference
+        from azure.mgmt.compute.models import NetworkProfile, BootDiagnostics, DiagnosticsProfile, VirtualMachine
        
         # hardware profile 
         hardware_profile = HardwareProfile(vm_size = vm_size)
@@ -1010,28 +2289,66 @@ class azure_operations:
     def resize_vm(self, resource_group, vmname, vm_size):
         if supported_vm_sizes.get(vm_size.upper()):
             vm_size = supported_vm_sizes[vm_size.upper()]
-        
-        # first stop the vm 
-        self.deallocate_vm(resource_group, vmname)
-        # second change vm size
+
+        # all checks are done before the vm is touched
         vm = self.get_vm(resource_group, vmname)
-        if vm:
-            vm_size_obj = self.get_vm_size(vm.location, vm_size)
-            if not vm_size_obj:
-                raise ValueError('Wrong VM size {}'.format(vm_size))
-        else:
+        if not vm:
             raise ValueError('VM {} does not exist.'.format(vmname))
+        if not self.get_vm_size(vm.location, vm_size):
+            raise ValueError('Wrong VM size {}'.format(vm_size))
+        if vm.hardware_profile.vm_size == vm_size:
+            logger.info('VM {} is already of size {}.'.format(vmname, vm_size))
+            return
+
+        power_states = [status.code for status in vm.instance_view.statuses if status.code.startswith('PowerState/')]
+        # a deallocated vm can take any size of its location, otherwise only the
+        # sizes offered by its current hardware cluster can be set in place
+        if 'PowerState/deallocated' in power_states:
+            in_place = True
+        else:
+            available_sizes = self.compute_client.virtual_machines.list_available_sizes(resource_group, vmname)
+            in_place = vm_size in [size.name for size in available_sizes]
+
         vm.hardware_profile.vm_size = vm_size
-        async_vm_update = self.compute_client.virtual_machines.create_or_update(
-                               resource_group,
-                               vmname,
-                               vm
-                          )
-        async_vm_update.wait()
-        # last start the vm 
+        start_time = time.time()
+        if in_place:
+            async_vm_update = self.compute_client.virtual_machines.create_or_update(resource_group, vmname, vm)
+            self.wait_for(async_vm_update, 'resize', vmname)
+            if not self.no_wait:
+                # azure restarts a running vm to apply the size
+                seconds = time.time() - start_time
+                logger.info('VM {} resized to {} in place in {:.0f}s, no deallocation needed.'.format(vmname, vm_size, 
+                        seconds))
+                deallocating = resize_timings().lookup(vm.location)
+                if 'PowerState/deallocated' not in power_states and deallocating:
+                    logger.info('The last resize with a deallocation in {} took {:.0f}s, {:.0f}s more.'.format(
+                            vm.location, deallocating, deallocating - seconds))
+            return
+
+        # the size needs another hardware cluster: deallocate, resize and bring
+        # the vm back to its power state, even in no-wait mode as the update
+        # needs the vm deallocated; the update is made on the deallocated vm
+        self.compute_client.virtual_machines.deallocate(resource_group, vmname).wait()
+        vm = self.get_vm(resource_group, vmname)
+        vm.hardware_profile.vm_size = vm_size
+        self.compute_client.virtual_machines.create_or_update(resource_group, vmname, vm).wait()
+        if 'PowerState/stopped' in power_states:
+            # a stopped vm keeps its hardware, it has to run to get it back
+            self.compute_client.virtual_machines.start(resource_group, vmname).wait()
+            self.wait_for(self.compute_client.virtual_machines.power_off(resource_group, vmname), 'stop', vmname)
+            if not self.no_wait:
+                logger.info('VM {} resized to {} with a deallocation and stopped again in {:.0f}s.'.format(vmname, vm_size, 
+                        time.time() - start_time))
+            return
         self.start_vm(resource_group, vmname)
+        if not self.no_wait:
+            seconds = time.time() - start_time
+            resize_timings().save(vm.location, seconds)
+            logger.info('VM {} resized to {} with a deallocation, {:.0f}s of downtime.'.format(vmname, vm_size, seconds))
+
+    def unmanaged_data_disk(self, vm_obj, disk_name, disk_size, lun, existing = None):
+        from azure.mgmt.compute.models import DataDisk
 
-    def attach_unmanaged_disk(self, resource_group, vm_obj, disk_name, disk_size, available_lun, existing = None):
         #make sure data disks are put under the same container with the os disk_name
         os_disk = vm_obj.storage_profile.os_disk
         disk_uri = os_disk.vhd.uri
@@ -1044,25 +2361,19 @@ class azure_operations:
             create_opt = 'empty'
             disk_uri = '{}/{}.vhd'.format(disk_uri, disk_name)
        
-        vm_obj.storage_profile.data_disks.append(
-            DataDisk(lun = available_lun, name = disk_name, disk_size_gb = disk_size,
-                vhd = {
-                    'uri': disk_uri 
-                },
-                create_option = create_opt
-            )
-        )
-        async_vm_update = self.compute_client.virtual_machines.create_or_update(
-            resource_group, vm_obj.name, vm_obj)
-        async_vm_update.wait()
+        return DataDisk(lun = lun, name = disk_name, disk_size_gb = disk_size,
+                   vhd = {
+                       'uri': disk_uri 
+                   },
+                   create_option = create_opt
+               )
     
-    def attach_managed_disk(self, resource_group, vm_obj, disk_name, disk_size, available_lun, existing = None):
+    def managed_data_disk(self, resource_group, vm_obj, disk_name, disk_size, lun, existing = None):
         if not existing:
-            create_opt = 'empty'
-
             # use the same location where the vm is 
             location = vm_obj.location
             
+            # needed by the vm update, so waited for even in no-wait mode
             async_create = self.compute_client.disks.create_or_update(
                 resource_group, disk_name, 
                 {
@@ -1074,27 +2385,40 @@ class azure_operations:
                 })
             managed_disk_ref = async_create.result()
         else:
-            create_opt = 'attach'
             managed_disk_ref = self.compute_client.disks.get(resource_group, existing)
             
-        vm_obj.storage_profile.data_disks.append({
-            'lun': available_lun,
+        return {
+            'lun': lun,
             'name': managed_disk_ref.name,
             'create_option': 'attach',
             'managed_disk': {
                 'id': managed_disk_ref.id
             }
-        })
-        async_vm_update = self.compute_client.virtual_machines.create_or_update(
-            resource_group, vm_obj.name, vm_obj)
-        async_vm_update.wait()
-
+        }
 
     def attach_data_disk(self, resource_group, vmname, disk_name, disk_size, existing = None):
-        if (int(disk_size) < 1):
-            disk_size = 1
-        elif (int(disk_size) > 4095):
-            disk_size = 4095
+        # disk_name, disk_size and existing may be ',' separated lists, a
+        # single size applies to all disks
+        disk_names = [name.strip() for name in disk_name.split(',')]
+        disk_sizes = [size.strip() for size in str(disk_size).split(',')]
+        if len(disk_sizes) == 1:
+            disk_sizes = disk_sizes * len(disk_names)
+        existing_disks = [disk.strip() for disk in existing.split(',')] if existing else [None] * len(disk_names)
+        if len(disk_sizes) != len(disk_names) or len(existing_disks) != len(disk_names):
+            raise ValueError('Please give one size and one existing disk per disk name.')
+        self.attach_data_disks(resource_group, vmname, list(zip(disk_names, disk_sizes, existing_disks)))
+
+    def attach_data_disks(self, resource_group, vmname, disks):
+        # disks is a list of (name, size in GiB, existing disk or None); all of
+        # them are attached with a single vm update; sizes and luns are checked
+        # for every disk before any of them is created
+        sized_disks = []
+        for disk_name, disk_size, existing in disks:
+            try:
+                disk_size = min(max(int(disk_size), 1), 4095)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid size {} of disk {}.'.format(disk_size, disk_name))
+            sized_disks.append((disk_name, disk_size, existing))
 
         vm = self.get_vm(resource_group, vmname)
         if not vm:
@@ -1108,26 +2432,48 @@ class azure_operations:
             managed_disk = False
 
         data_disks = vm.storage_profile.data_disks
-        #find an available lun
+        #find available luns
         used_luns = []
         for data_disk in data_disks:
             used_luns.append(data_disk.lun)
-        for i in xrange(100):
-            if i not in used_luns:
-                available_lun = i
-                break
-
-        if managed_disk:
-            self.attach_managed_disk(resource_group, vm, disk_name, disk_size, available_lun, existing)
-        else:
-            self.attach_unmanaged_disk(resource_group, vm, disk_name, disk_size, available_lun, existing)
+        available_luns = [i for i in range(100) if i not in used_luns][:len(disks)]
+        if len(available_luns) < len(disks):
+            raise ValueError('VM {} has no free lun for {} more disks.'.format(vmname, len(disks)))
+
+        def new_data_disk(disk):
+            (disk_name, disk_size, existing), lun = disk
+            if managed_disk:
+                return self.managed_data_disk(resource_group, vm, disk_name, disk_size, lun, existing)
+            return self.unmanaged_data_disk(vm, disk_name, disk_size, lun, existing)
+
+        # empty managed disks are created concurrently
+        results = list(run_concurrently(new_data_disk, list(zip(sized_disks, available_luns)), len(disks),
+                context = self.worker_context))
+        created = [disk_name for ((disk_name, disk_size, existing), lun), result, error in results 
+                   if managed_disk and not existing and error is None]
+        try:
+            errors = [error for disk, result, error in results if error]
+            if errors:
+                raise errors[0]
+            data_disks.extend(result for disk, result, error in results)
+            async_vm_update = self.compute_client.virtual_machines.create_or_update(
+                resource_group, vm.name, vm)
+            self.wait_for(async_vm_update, 'update', vm.name)
+        except Exception as e:
+            # the managed disks created for this update are not left behind
+            for disk_name in created:
+                try:
+                    self.compute_client.disks.delete(resource_group, disk_name).wait()
+                except Exception as cleanup_error:
+                    logger.error('Failed to delete disk {}: {}'.format(disk_name, cleanup_error))
+            raise e
 
 class arg_parse:
     def __init__(self):
         self.parser = argparse.ArgumentParser()
         self.subparsers = self.parser.add_subparsers(title='subcommands', description='valid subcommands', help='additional help')
         self.list_parser = self.subparsers.add_parser('list', description='list a specified resource', help='resource_group | storage_account | container | vm | vnet | subnet | nic | public_ip | vhd | vm_state | vm_size | vm_ip | vm_disk')
-        self.create_parser = self.subparsers.add_parser('create', description='create a specified resource', help='resource_group | storage_account | container | vm | vnet | subnet | nic | public_ip')
+        self.create_parser = self.subparsers.add_parser('create', description='create a specified resource', help='resource_group | storage_account | container | vm | fleet | vnet | subnet | nic | public_ip')
         self.delete_parser = self.subparsers.add_parser('delete', description='delete a specified resource', help='resource_group | storage_account | container | vm | vnet | subnet | nic | public_ip | container | blob')
         self.start_parser = self.subparsers.add_parser('start', description='start a specified vm', help='vm')
         self.restart_parser = self.subparsers.add_parser('restart', description='restart a specified vm', help='vm')
@@ -1135,12 +2481,17 @@ class arg_parse:
         self.resize_parser = self.subparsers.add_parser('resize', description='resize a specified vm', help='vm')
         self.attach_parser = self.subparsers.add_parser('attach', description='attach disks to a specified vm', help='disk')
         self.detach_parser = self.subparsers.add_parser('detach', description='attach disks to a specified vm', help='disk')
+        self.wait_parser = self.subparsers.add_parser('wait', description='wait for operations started with --no-wait', help='operation ids')
+        self.status_parser = self.subparsers.add_parser('status', description='show operations started with --no-wait', help='operation ids')
     
     def add_credentials(self):
         self.parser.add_argument('-C', '--client_id', help='login via this client')
         self.parser.add_argument('-K', '--secret_key', help='login via this key')
         self.parser.add_argument('-T', '--tenant_id', help='login via this tenant')
         self.parser.add_argument('-S', '--subscription_id', help='login via this subscription id')
+        self.parser.add_argument('--token_cache', action='store_true', default=None, help='reuse access tokens across invocations, also enabled by AZURE_TOKEN_CACHE=1')
+        self.parser.add_argument('-o', '--output', choices=['text', 'jsonl'], default='text', help='jsonl writes one json record per listed resource')
+        self.parser.add_argument('--no-wait', dest='no_wait', action='store_true', help="start long running operations and save them for the 'wait' command")
 
     def run_cmd(self):
         self.add_credentials()
@@ -1153,13 +2504,26 @@ class arg_parse:
         self.add_resize_subcommands()
         self.add_attach_subcommands()
         self.add_detach_subcommands()
+        self.add_wait_subcommands()
         
         self.parsed_args = self.parser.parse_args()
 
-        self.azure_ops = azure_operations(self.parsed_args.client_id, self.parsed_args.secret_key, self.parsed_args.tenant_id, self.parsed_args.subscription_id)
+        self.azure_ops = azure_operations(self.parsed_args.client_id, self.parsed_args.secret_key, self.parsed_args.tenant_id, self.parsed_args.subscription_id, 
+                self.parsed_args.token_cache)
+        self.azure_ops.output = self.parsed_args.output
+        self.azure_ops.no_wait = self.parsed_args.no_wait
+        if self.parsed_args.output == 'jsonl':
+            # keep stdout for records only
+            sh.stream = sys.stderr
        
         self.parsed_args.func(self.parsed_args)
 
+        if throttle.counters.throttled:
+            if self.parsed_args.output == 'jsonl':
+                write_record(throttle.counters)
+            else:
+                logger.info('{} requests, {} throttled, {} retried, {:.0f}s spent waiting'.format(*throttle.counters))
+
     def add_list_subcommands(self):
         list_subparser = self.list_parser.add_subparsers(title='list',  help='list related resources')
         # list subscriptions
@@ -1180,6 +2544,7 @@ class arg_parse:
         list_vm = list_subparser.add_parser('vm', help='list vms within a resource group')
         list_vm.add_argument('-r', '--resource_group', required=True, help='list resources wihtin this group')
         list_vm.add_argument('-n', '--name', help='list a specific vm')
+        list_vm.add_argument('--parallel', type=int, default=1, help='fetch vm details with this many workers')
         list_vm.set_defaults(func=self.list_virtual_machines)
         # list vnets
         list_vnet = list_subparser.add_parser('vnet', help='list vnets within a resource group')
@@ -1203,7 +2568,7 @@ class arg_parse:
         # list a vm's state
         list_state = list_subparser.add_parser('vm_state', help="list a vm's state within a resource group")
         list_state.add_argument('-r', '--resource_group', required=True, help='list resources wihtin this group')
-        list_state.add_argument('-n', '--name', required=True, help='list a specific vm')
+        list_state.add_argument('-n', '--name', help="use ',' to separate multiple vms, all vms of the group if not given")
         list_state.set_defaults(func=self.list_vm_state)
         # list a vm's size
         list_size = list_subparser.add_parser('vm_size', help="list a vm's size within a resource group")
@@ -1226,6 +2591,7 @@ class arg_parse:
         list_vhd.add_argument('-s', '--storage_account', help='list vhds within this storage account')
         list_vhd.add_argument('-c', '--container', help='list vhds within this storage container')
         list_vhd.add_argument('--managed', action='store_true', help='only list manage disk')
+        list_vhd.add_argument('--parallel', type=int, default=1, help='scan storage accounts and containers with this many workers')
         list_vhd.set_defaults(func=self.list_vhds)
 
     def add_create_subcommands(self):
@@ -1251,23 +2617,17 @@ class arg_parse:
         create_container.set_defaults(func=self.create_storage_container)
         # create vm
         create_vm = create_subparser.add_parser('vm', help='create a vm within a resource group')
-        create_vm.add_argument('-r', '--resource_group', required=True, help='create a vm wihtin this resource group')
-        create_vm.add_argument('-s', '--storage_account', help='if not specified, managed disks will be used.')
-        create_vm.add_argument('-l', '--location', help='if not specified, resource group location will be used')
-        create_vm.add_argument('-c', '--vm_size', required=True, help='for ddve, please use capacity like 7T/15T; for other linux vms, standard vm size can be used')
         create_vm.add_argument('-n', '--name', required=True, help='create a vm with this name')
-        create_vm.add_argument('-v', '--vnet', required=True, help='create a vm with this vnet')
-        create_vm.add_argument('-e', '--subnet', required=True, help="use ',' to separate multiple subnets")
-        create_vm.add_argument('-k', '--ssh_key', help='create a vm with this public ssh key')
-        create_vm.add_argument('-u', '--username', help='create a vm with this username')
-        create_vm.add_argument('-p', '--password', help='create a vm with login password')
-        create_vm.add_argument('-P', '--publisher', help='create a vm from this publisher')
-        create_vm.add_argument('-O', '--offer', help='create a vm from this offer')
-        create_vm.add_argument('-S', '--sku', help='create a vm from this sku')
-        create_vm.add_argument('-I', '--image', help='create a vm from customized image')
-        create_vm.add_argument('--public_ip', action='store_true', help='create a vm with public ip')
-        create_vm.add_argument('--static_ip', action='store_true', help='create a vm with a static ip')
+        self.add_vm_spec_arguments(create_vm)
         create_vm.set_defaults(func=self.create_virtual_machine)
+        # create fleet
+        create_fleet = create_subparser.add_parser('fleet', help='create several vms of the same spec within a resource group')
+        create_fleet.add_argument('-n', '--name_pattern', required=True, help='vm names, {} is replaced by the vm index, e.g. ddve-{:02d}')
+        create_fleet.add_argument('--count', type=int, required=True, help='number of vms to create')
+        create_fleet.add_argument('--first_index', type=int, default=1, help='index of the first vm')
+        create_fleet.add_argument('--parallel', type=int, default=10, help='number of vms created concurrently')
+        self.add_vm_spec_arguments(create_fleet)
+        create_fleet.set_defaults(func=self.create_fleet)
         # create vnet
         create_vnet = create_subparser.add_parser('vnet', help='create a virtual network within a resource group')
         create_vnet.add_argument('-r', '--resource_group', required=True, help='create a vnet wihtin this group')
@@ -1297,6 +2657,23 @@ class arg_parse:
         create_ip.add_argument('-s', '--static', help='create a static ip', action='store_true')
         create_ip.set_defaults(func=self.create_public_ip)
         
+    def add_vm_spec_arguments(self, parser):
+        parser.add_argument('-r', '--resource_group', required=True, help='create a vm wihtin this resource group')
+        parser.add_argument('-s', '--storage_account', help='if not specified, managed disks will be used.')
+        parser.add_argument('-l', '--location', help='if not specified, resource group location will be used')
+        parser.add_argument('-c', '--vm_size', required=True, help='for ddve, please use capacity like 7T/15T; for other linux vms, standard vm size can be used')
+        parser.add_argument('-v', '--vnet', required=True, help='create a vm with this vnet')
+        parser.add_argument('-e', '--subnet', required=True, help="use ',' to separate multiple subnets")
+        parser.add_argument('-k', '--ssh_key', help='create a vm with this public ssh key')
+        parser.add_argument('-u', '--username', help='create a vm with this username')
+        parser.add_argument('-p', '--password', help='create a vm with login password')
+        parser.add_argument('-P', '--publisher', help='create a vm from this publisher')
+        parser.add_argument('-O', '--offer', help='create a vm from this offer')
+        parser.add_argument('-S', '--sku', help='create a vm from this sku')
+        parser.add_argument('-I', '--image', help='create a vm from customized image')
+        parser.add_argument('--public_ip', action='store_true', help='create a vm with public ip')
+        parser.add_argument('--static_ip', action='store_true', help='create a vm with a static ip')
+
     def add_delete_subcommands(self):
         # delete subcommands
         delete_subparser = self.delete_parser.add_subparsers(title='delete',  help='create related resources')
@@ -1350,28 +2727,31 @@ class arg_parse:
         delete_blob.add_argument('--managed_disk', action='store_true', help='delete a managed disk')
         delete_blob.set_defaults(func=self.delete_blob)
 
+    def add_power_arguments(self, parser, command):
+        parser.add_argument('-r', '--resource_group', required=True, help='{} vms within this group'.format(command))
+        parser.add_argument('-n', '--name', help="{} vms with these names, use ',' to separate names, globs allowed".format(command))
+        parser.add_argument('-t', '--tag', help="{} vms with this tag, as 'key' or 'key=value'".format(command))
+        parser.add_argument('--parallel', type=int, default=10, help='launch and wait for at most this many operations at a time')
+
     def add_start_subcommands(self):
         # start subcommand
         start_subparser = self.start_parser.add_subparsers(title='start', description='start a specified vm', help='vm')
-        start_vm = start_subparser.add_parser('vm', help='start a vm')
-        start_vm.add_argument('-r', '--resource_group', required=True, help='start a vm within this group')
-        start_vm.add_argument('-n', '--name', required=True, help='start a vm with this name')
+        start_vm = start_subparser.add_parser('vm', help='start vms')
+        self.add_power_arguments(start_vm, 'start')
         start_vm.set_defaults(func=self.start_virtual_machine) 
 
     def add_stop_subcommands(self):
         # stop command
         stop_subparser = self.stop_parser.add_subparsers(title='stop', description='stop a specified vm', help='vm')
-        stop_vm = stop_subparser.add_parser('vm', help='stop a vm')
-        stop_vm.add_argument('-r', '--resource_group', required=True, help='stop a vm within this group')
-        stop_vm.add_argument('-n', '--name', required=True, help='stop a vm with this name')
+        stop_vm = stop_subparser.add_parser('vm', help='stop vms')
+        self.add_power_arguments(stop_vm, 'stop')
         stop_vm.set_defaults(func=self.stop_virtual_machine)
 
     def add_restart_subcommands(self):
         # restart subcommand
         restart_subparser = self.restart_parser.add_subparsers(title='restart', description='restart a specified vm', help='vm')
-        restart_vm = restart_subparser.add_parser('vm', help='restart a vm')
-        restart_vm.add_argument('-r', '--resource_group', required=True, help='restart a vm within this group')
-        restart_vm.add_argument('-n', '--name', required=True, help='restart a vm with this name')
+        restart_vm = restart_subparser.add_parser('vm', help='restart vms')
+        self.add_power_arguments(restart_vm, 'restart')
         restart_vm.set_defaults(func=self.restart_virtual_machine)
 
     def add_resize_subcommands(self):
@@ -1386,23 +2766,33 @@ class arg_parse:
     def add_attach_subcommands(self):
         # attach subcommand
         attach_subparser = self.attach_parser.add_subparsers(title='attach', description='attach a specified disk', help='disk')
-        attach_disk = attach_subparser.add_parser('disk', help='attach a disk to a vm')
+        attach_disk = attach_subparser.add_parser('disk', help='attach disks to a vm')
         attach_disk.add_argument('-r', '--resource_group', required=True, help='attach a disk to a vm within this group')
         attach_disk.add_argument('-n', '--name', required=True, help='attach a disk to a vm with this name')
-        attach_disk.add_argument('-d', '--disk_name', required=True, help='attach a disk with this name')
-        attach_disk.add_argument('-g', '--disk_size', required=True, help='attach a disk with this size in GiB')
-        attach_disk.add_argument('-e', '--existing', help='attach an existing disk')
+        attach_disk.add_argument('-d', '--disk_name', required=True, help="use ',' to separate multiple disks")
+        attach_disk.add_argument('-g', '--disk_size', required=True, help="disk size in GiB, one for all disks or ',' separated per disk")
+        attach_disk.add_argument('-e', '--existing', help="attach existing disks, ',' separated per disk")
         attach_disk.set_defaults(func=self.attach_disk_to_vm)
 
     def add_detach_subcommands(self):
         # detach subcommand
         detach_subparser = self.detach_parser.add_subparsers(title='detach', description='detach a specified disk', help='disk')
-        detach_disk = detach_subparser.add_parser('disk', help='detach a disk from a vm')
+        detach_disk = detach_subparser.add_parser('disk', help='detach disks from a vm')
         detach_disk.add_argument('-r', '--resource_group', required=True, help='detach a disk to a vm within this group')
         detach_disk.add_argument('-n', '--name', required=True, help='detach a disk from a vm with this name')
-        detach_disk.add_argument('-d', '--disk_name', required=True, help='detach a disk with this name')
+        detach_disk.add_argument('-d', '--disk_name', required=True, help="use ',' to separate multiple disks")
         detach_disk.set_defaults(func=self.detach_disk_from_vm)
 
+    def add_wait_subcommands(self):
+        self.wait_parser.add_argument('ids', nargs='*', help='operation ids, defaults to all saved operations')
+        self.wait_parser.add_argument('--timeout', type=int, help='stop waiting after this many seconds')
+        self.wait_parser.add_argument('--parallel', type=int, default=10, help='number of operations polled concurrently')
+        self.wait_parser.set_defaults(func=self.wait_operations)
+
+        self.status_parser.add_argument('ids', nargs='*', help='operation ids, defaults to all saved operations')
+        self.status_parser.add_argument('--parallel', type=int, default=10, help='number of operations polled concurrently')
+        self.status_parser.set_defaults(func=self.operation_status)
+
     def list_subscriptions(self, args):
         self.azure_ops.list_subscriptions()
 
@@ -1416,7 +2806,7 @@ class arg_parse:
         self.azure_ops.list_storage_container(args.storage_account)
     
     def list_virtual_machines(self, args):
-        self.azure_ops.list_virtual_machines(args.resource_group, args.name)
+        self.azure_ops.list_virtual_machines(args.resource_group, args.name, parallel = args.parallel)
     
     def list_virtual_networks(self, args):
         self.azure_ops.list_virtual_networks(args.resource_group, args.name)
@@ -1439,8 +2829,12 @@ class arg_parse:
         self.azure_ops.list_public_ip(args.resource_group)
     
     def list_vm_ip(self, args):
-        self.azure_ops.list_vm_public_ip(args.resource_group, args.name)
-        self.azure_ops.list_vm_private_ip(args.resource_group, args.name)
+        nics = self.azure_ops.get_nics_by_name(args.resource_group, args.name)
+        if self.azure_ops.output == 'jsonl':
+            write_record(vm_ip_info(args.name, self.azure_ops.get_vm_public_ips(nics), self.azure_ops.get_vm_private_ips(nics)))
+            return
+        self.azure_ops.print_vm_public_ip(nics)
+        self.azure_ops.print_vm_private_ip(nics)
 
     def delete_resource_group(self, args):
         self.azure_ops.delete_resource_group(args.name)
@@ -1487,7 +2881,7 @@ class arg_parse:
     def create_network_interface(self, args):
         self.azure_ops.create_nic(args.resource_group, args.vnet, args.subnet, args.location, args.name)
     
-    def create_virtual_machine(self, args):
+    def check_image_arguments(self, args):
         # for creating vms, publisher/offer/sku conflict with customized image
         if args.image: 
             if self.parsed_args.publisher or self.parsed_args.offer or self.parsed_args.sku:
@@ -1501,22 +2895,38 @@ class arg_parse:
                     raise ValueError('Please use the same storage account where your customized image is.')
             else:
                 raise ValueError('Invalid image url provided.')
-                
+
+    def create_virtual_machine(self, args):
+        self.check_image_arguments(args)
         self.azure_ops.create_vm(args.resource_group, args.storage_account, args.location, args.vm_size, args.name, args.vnet, args.subnet, args.ssh_key, args.publisher, args.offer, 
                 args.sku, args.image, args.username, args.password, args.public_ip, args.static_ip)
     
+    def create_fleet(self, args):
+        self.check_image_arguments(args)
+        self.azure_ops.create_fleet(args.resource_group, args.storage_account, args.location, args.vm_size, args.name_pattern, args.count, 
+                args.vnet, args.subnet, args.ssh_key, args.publisher, args.offer, args.sku, args.image, args.username, args.password, 
+                args.public_ip, args.static_ip, args.first_index, args.parallel)
+    
     def create_public_ip(self, args):
         self.azure_ops.create_public_ip(args.resource_group, args.name, args.static)
         self.azure_ops.list_vm_public_ip(args.resource_group, args.name)
     
+    def power_virtual_machines(self, args, command):
+        if not args.name and not args.tag:
+            raise ValueError('Please specify vm names or a tag.')
+        vmnames = self.azure_ops.select_vms(args.resource_group, args.name, args.tag)
+        if not vmnames:
+            raise ValueError('No vm matches the given names or tag.')
+        self.azure_ops.power_vms(args.resource_group, vmnames, command, args.parallel)
+
     def start_virtual_machine(self, args):
-        self.azure_ops.start_vm(args.resource_group, args.name)
+        self.power_virtual_machines(args, 'start')
     
     def stop_virtual_machine(self, args):
-        self.azure_ops.deallocate_vm(args.resource_group, args.name)
+        self.power_virtual_machines(args, 'stop')
     
     def restart_virtual_machine(self, args):
-        self.azure_ops.restart_vm(args.resource_group, args.name)
+        self.power_virtual_machines(args, 'restart')
     
     def resize_virtual_machine(self, args):
         self.azure_ops.resize_vm(args.resource_group, args.name, args.vm_size)
@@ -1525,7 +2935,7 @@ class arg_parse:
         self.azure_ops.list_data_disks(args.resource_group, args.name)
     
     def list_vhds(self, args):
-        self.azure_ops.list_vhds(args.resource_group, args.storage_account, args.container, args.managed)
+        self.azure_ops.list_vhds(args.resource_group, args.storage_account, args.container, args.managed, args.parallel)
 
     def attach_disk_to_vm(self, args):
         self.azure_ops.attach_data_disk(args.resource_group, args.name, args.disk_name, args.disk_size, args.existing)
@@ -1533,9 +2943,18 @@ class arg_parse:
     def detach_disk_from_vm(self, args):
         self.azure_ops.detach_data_disk(args.resource_group, args.name, args.disk_name)
 
+    def wait_operations(self, args):
+        if not self.azure_ops.wait_operations(args.ids, args.timeout, args.parallel):
+            raise ValueError('Some operations did not succeed.')
+
+    def operation_status(self, args):
+        if not self.azure_ops.operation_status(args.ids, args.parallel):
+            raise ValueError('Some operations did not succeed.')
+
 if __name__ == '__main__':
     try:
         ops = arg_parse()
         ops.run_cmd()
     except Exception as e:
         logger.error('{}'.format(e))
+        sys.exit(1)
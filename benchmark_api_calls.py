@@ -0,0 +1,73 @@
+import sys, os, argparse
+import requests
+
+# Count the ARM round trips made by the read-only lookups of a command,
+# before and after the lookup caches. Runs against a real subscription using
+# the same AZURE_* environment variables as azure_operations.py, and never
+# creates or deletes anything. Every HTTP request sent through requests is
+# counted, so paging is included.
+
+module_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, module_dir)
+from azure_operations import azure_operations
+
+http_requests = [0]
+session_send = requests.Session.send
+
+def counting_send(session, request, **kwargs):
+    http_requests[0] += 1
+    return session_send(session, request, **kwargs)
+
+requests.Session.send = counting_send
+
+def count_calls(func, *args):
+    http_requests[0] = 0
+    func(*args)
+    return http_requests[0]
+
+# lookups as done before the vnet index: a list_all scan per vnet lookup and
+# a subnets.get per subnet lookup
+def legacy_get_vnet_by_location(azure_ops, location, vnet_name):
+    for vnet in azure_ops.network_client.virtual_networks.list_all():
+        if vnet.location == location and vnet.name == vnet_name:
+            return vnet
+
+def legacy_get_subnet_by_vnet(azure_ops, location, vnet_name, subnet_name):
+    vnet_obj = legacy_get_vnet_by_location(azure_ops, location, vnet_name)
+    if vnet_obj:
+        return azure_ops.network_client.subnets.get(vnet_obj.id.split('/')[4], vnet_name, subnet_name)
+
+def create_vm_lookups_before(azure_ops, args):
+    subnets = [subnet.strip() for subnet in args.subnet.split(',')]
+    legacy_get_vnet_by_location(azure_ops, args.location, args.vnet)
+    # subnet validation, then one more lookup per nic in create_nic
+    for subnet in subnets + subnets:
+        legacy_get_subnet_by_vnet(azure_ops, args.location, args.vnet, subnet)
+
+def create_vm_lookups_after(azure_ops, args):
+    subnets = [subnet.strip() for subnet in args.subnet.split(',')]
+    azure_ops.invalidate_vnet_index()
+    azure_ops.get_vnet_by_location(args.location, args.vnet)
+    for subnet in subnets + subnets:
+        azure_ops.get_subnet_by_vnet(args.location, args.vnet, subnet)
+
+# scenario -> (before, after)
+scenarios = {
+    'create_vm' : (create_vm_lookups_before, create_vm_lookups_after)
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenario', choices=sorted(scenarios), help='command to measure')
+    parser.add_argument('-l', '--location', help='location of the vnet')
+    parser.add_argument('-v', '--vnet', help='vnet used by the vm')
+    parser.add_argument('-e', '--subnet', help="use ',' to separate multiple subnets")
+    parsed_args = parser.parse_args()
+
+    azure_ops = azure_operations(None, None, None)
+    before, after = scenarios[parsed_args.scenario]
+    # build the clients first so that only the lookups are counted
+    count_calls(after, azure_ops, parsed_args)
+
+    print('{}: {} API calls before, {} after'.format(parsed_args.scenario,
+            count_calls(before, azure_ops, parsed_args), count_calls(after, azure_ops, parsed_args)))
@@ -0,0 +1,85 @@
+import sys, os, argparse, subprocess, time
+
+# Measure the start-up cost of azure_operations.py per subcommand.
+# Each sample runs in a fresh interpreter: import the module, then import and
+# build the management clients the subcommand touches. 'eager' builds all of
+# them along with the model and storage modules the module used to import at
+# import time, which is what every invocation used to pay for. The AAD token
+# round trip is excluded as it is the same for both.
+
+module_dir = os.path.dirname(os.path.realpath(__file__))
+
+# subcommand -> management clients used by it
+subcommand_clients = {
+    'list subscription' : ['subscription_client'],
+    'list resource_group' : ['resource_client'],
+    'list storage_account' : ['storage_client'],
+    'list container' : ['storage_client'],
+    'list vm' : ['compute_client', 'network_client', 'storage_client'],
+    'list vnet' : ['network_client'],
+    'list subnet' : ['network_client'],
+    'list nic' : ['network_client'],
+    'list public_ip' : ['network_client'],
+    'list vm_state' : ['compute_client'],
+    'list vm_size' : ['compute_client'],
+    'list vm_ip' : ['compute_client', 'network_client'],
+    'list vm_disk' : ['compute_client', 'storage_client'],
+    'list vhd' : ['compute_client', 'storage_client'],
+    'create vm' : ['resource_client', 'compute_client', 'network_client', 'storage_client'],
+    'delete vm' : ['compute_client', 'network_client', 'storage_client'],
+    'start vm' : ['compute_client'],
+    'stop vm' : ['compute_client'],
+    'restart vm' : ['compute_client'],
+    'resize vm' : ['compute_client'],
+    'attach disk' : ['compute_client'],
+    'detach disk' : ['compute_client']
+}
+
+# modules imported at import time before the clients were built lazily
+eager_imports = [
+    'azure.common.credentials',
+    'azure.mgmt.compute.models',
+    'azure.mgmt.network.models',
+    'azure.mgmt.storage.models',
+    'azure.storage.blob.baseblobservice'
+]
+
+child_code = '''
+import sys, importlib
+sys.path.insert(0, {module_dir!r})
+import azure_operations
+from msrest.authentication import BasicTokenAuthentication
+for module_name in {imports!r}:
+    importlib.import_module(module_name)
+credentials = BasicTokenAuthentication({{'access_token' : 'benchmark'}})
+for name in {clients!r}:
+    module_name, class_name = azure_operations.lazy_clients[name]
+    client_class = getattr(importlib.import_module(module_name), class_name)
+    if name == 'subscription_client':
+        client_class(credentials)
+    else:
+        client_class(credentials, '00000000-0000-0000-0000-000000000000')
+'''
+
+def run_once(clients, imports):
+    code = child_code.format(module_dir = module_dir, clients = clients, imports = imports)
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code])
+    return time.time() - start
+
+def median_ms(clients, runs, imports = ()):
+    samples = sorted(run_once(clients, list(imports)) for i in range(runs))
+    return samples[len(samples) // 2] * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=5, help='samples per subcommand')
+    parser.add_argument('subcommands', nargs='*', help="e.g. 'list vm_state', defaults to all")
+    parsed_args = parser.parse_args()
+
+    subcommands = parsed_args.subcommands or sorted(subcommand_clients)
+    eager = median_ms(sorted(set(sum(subcommand_clients.values(), []))), parsed_args.runs, eager_imports)
+    print('{:<24}{:>12}{:>12}{:>10}'.format('subcommand', 'eager(ms)', 'lazy(ms)', 'saved'))
+    for subcommand in subcommands:
+        lazy = median_ms(subcommand_clients[subcommand], parsed_args.runs)
+        print('{:<24}{:>12.1f}{:>12.1f}{:>9.0f}%'.format(subcommand, eager, lazy, (eager - lazy) * 100 / eager))
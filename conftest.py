@@ -0,0 +1,3 @@
+# test_azure_ops.py is a manual script run against a live subscription with
+# its credentials filled in, not a unit test
+collect_ignore = ['test_azure_ops.py']
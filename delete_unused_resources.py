@@ -1,4 +1,5 @@
-import sys, os, subprocess, re, argparse, logging
+import sys, os, subprocess, re, argparse, logging, time, threading
+from collections import namedtuple
 
 # check whether azure_operations.py exist
 module_path = os.path.realpath(__file__)
@@ -8,6 +9,7 @@ if not os.path.exists(azure_module_path):
     raise SystemError('No azure_operations.py found')
 
 from azure_operations import *
+from azure.mgmt.storage.models import Kind
 
 vm_whitelist = []
 container_whitelist = ['ddvevhds', 'templates', 'ddveimgs']
@@ -23,11 +25,195 @@ logger.setLevel(logging.INFO)
 # sh.setFormatter(logging.Formatter(fmt = '%(message)s'))
 # logger.addHandler(sh)
 
-class delete_op:
+class log_buffer(logging.Filter):
+    # holds back the log records of a thread while it sweeps a resource group
+    # and releases them in one block, so that groups swept concurrently do
+    # not interleave
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def start(self):
+        self.local.records = []
+
+    def flush(self):
+        records, self.local.records = self.local.records, None
+        with output_lock:
+            for record in records:
+                logger.handle(record)
+
+    def share(self):
+        # the workers a sweeping thread starts log into its buffer; a call
+        # run on the sweeping thread itself keeps its buffer as it is
+        records = getattr(self.local, 'records', None)
+        def run(func, item):
+            previous = getattr(self.local, 'records', None)
+            if records is None or previous is records:
+                return func(item)
+            self.local.records = records
+            try:
+                return func(item)
+            finally:
+                self.local.records = previous
+        return run
+
+group_logs = log_buffer()
+logger.addFilter(group_logs)
+
+# a resource of the reference graph; refs are the lower-cased ids it uses
+graph_node = namedtuple('graph_node', ['kind', 'id', 'resource_group', 'name', 'refs', 'details'])
+
+# orphans are deleted in this order, users before what they use
+orphan_waves = [['vm'], ['nic'], ['public_ip', 'managed_disk', 'vhd']]
+
+class reference_graph:
+    # the vms, nics, public ips, managed disks and vhd blobs of a subscription
+    # keyed by lower-cased id (the blob url for vhds), each with the ids it
+    # references; whatever no kept resource reaches is an orphan, so the nic
+    # of a stopped vm takes its public ip along with it
     def __init__(self):
-        self.azure_ops = azure_operations(client_id = os.environ['AZURE_CLIENT_ID'],
-                secret_key = os.environ['AZURE_SECRET_KEY'],
-                tenant_id = os.environ['AZURE_TENANT_ID'])
+        self.nodes = {}
+        self.roots = set()
+        self.lock = threading.Lock()
+
+    def add(self, kind, resource_id, resource_group, name, refs = (), root = False, **details):
+        node = graph_node(kind, resource_id.lower(), resource_group, name, [ref.lower() for ref in refs if ref], details)
+        with self.lock:
+            self.nodes[node.id] = node
+            if root:
+                self.roots.add(node.id)
+        return node
+
+    def find_orphans(self):
+        # (node, why it is unused) of every node no root reaches
+        live = set()
+        pending = list(self.roots)
+        while pending:
+            resource_id = pending.pop()
+            if resource_id in live or resource_id not in self.nodes:
+                continue
+            live.add(resource_id)
+            pending.extend(self.nodes[resource_id].refs)
+
+        referrers = {}
+        for node in self.nodes.values():
+            for ref in node.refs:
+                referrers.setdefault(ref, []).append(node)
+
+        orphans = []
+        for resource_id, node in sorted(self.nodes.items()):
+            if resource_id in live:
+                continue
+            users = referrers.get(resource_id)
+            if users:
+                reason = 'only used by unused {} {}'.format(users[0].kind, users[0].name)
+            else:
+                reason = node.details.get('reason', 'not used')
+            orphans.append((node, reason))
+        return orphans
+
+class sweep_checkpoint:
+    # progress of the vhd sweep of a --delete run per storage account and
+    # container, including the listing marker of the next page, so that a
+    # rerun of the same scope after a crash or timeout resumes where it
+    # stopped; the file is removed once a run's vhd sweep completes
+    max_age = 24 * 3600
+
+    def __init__(self, path, scope):
+        # scope is what the run sweeps, e.g. its subscription and group
+        self.path = path
+        self.scope = scope
+        saved = load_json_file(path)
+        self.stale = bool(saved) and (saved.get('scope') != scope or 
+                saved.get('created_at', 0) + self.max_age < time.time())
+        if saved and not self.stale:
+            self.created_at = saved['created_at']
+            self.state = saved['accounts']
+        else:
+            self.created_at = time.time()
+            self.state = {}
+        self.lock = threading.Lock()
+
+    def save(self):
+        dump_json_file(self.path, {'created_at' : self.created_at, 'scope' : self.scope, 'accounts' : self.state})
+
+    def account_state(self, subscription_id, storage_account):
+        key = '{}/{}'.format(subscription_id, storage_account)
+        return self.state.setdefault(key, {'done' : False, 'containers' : {}})
+
+    def account_done(self, subscription_id, storage_account):
+        with self.lock:
+            return self.account_state(subscription_id, storage_account)['done']
+
+    def container(self, subscription_id, storage_account, container):
+        # (done, marker) of a container
+        with self.lock:
+            state = self.account_state(subscription_id, storage_account)['containers'].get(container, {})
+            return state.get('done', False), state.get('marker')
+
+    def save_container(self, subscription_id, storage_account, container, marker = None, done = False):
+        with self.lock:
+            self.account_state(subscription_id, storage_account)['containers'][container] = {'marker' : marker, 'done' : done}
+            self.save()
+
+    def save_account(self, subscription_id, storage_account):
+        # a finished account only needs its flag
+        with self.lock:
+            self.account_state(subscription_id, storage_account).update({'done' : True, 'containers' : {}})
+            self.save()
+
+    def resumed(self):
+        return bool(self.state)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class delete_op:
+    def __init__(self, azure_ops = None, checkpoint = None):
+        if azure_ops is None:
+            azure_ops = azure_operations(client_id = os.environ['AZURE_CLIENT_ID'],
+                    secret_key = os.environ['AZURE_SECRET_KEY'],
+                    tenant_id = os.environ['AZURE_TENANT_ID'])
+        self.azure_ops = azure_ops
+        # workers of the sweep log into the buffer of their resource group
+        azure_ops.worker_context = group_logs.share
+        # (resource group, vm name) -> state of every vm of the subscription,
+        # listed once for all resource groups
+        self.vm_states = None
+        self.lock = threading.Lock()
+        # resources found by a dry run, see plan_resource
+        self.plan = []
+        # sweep_checkpoint of a --delete run
+        self.checkpoint = checkpoint
+        # resource groups whose sweep failed, and of those the ones whose
+        # vhd sweep failed, which keep the checkpoint
+        self.failures = 0
+        self.vhd_failures = 0
+        # (resource group, vm name) of vms whose state could not be read,
+        # they are neither deleted nor planned
+        self.unknown_vms = []
+
+    def plan_resource(self, kind, resource_group, name, resource_id, **seen):
+        # seen holds what apply_resource checks again before deleting: the
+        # etag, lease or state the resource had when it was found
+        entry = dict(seen, type = kind, subscription_id = self.azure_ops.subscription_id, resource_group = resource_group, 
+                     name = name, id = resource_id)
+        with self.lock:
+            self.plan.append(entry)
+
+    def get_vm_states(self, resource_group):
+        with self.lock:
+            if self.vm_states is None:
+                self.vm_states = self.azure_ops.get_vm_states(failed = self.unknown_vms)
+        return sorted((name, state) for (rg, name), state in self.vm_states.items() if rg == resource_group.lower())
 
     # delete unused nics
     def delete_unused_nics(self, resource_group, delete = False):
@@ -38,32 +224,37 @@ class delete_op:
             if not attached_vm:
                 if not delete:
                     logger.info('Unused NIC: {}'.format(name))
+                    self.plan_resource('nic', resource_group, name, nic.id, etag = nic.etag)
                 else:
                     self.azure_ops.delete_nic(resource_group, name)
                     logger.info('NIC {} successfully deleted.'.format(name))
     
     def delete_unused_vms(self, resource_group, delete = False):
         
-        for vm_ref in self.azure_ops.compute_client.virtual_machines.list(resource_group):
-            vm = self.azure_ops.get_vm(resource_group, vm_ref.name)
-
-            state = vm.instance_view.statuses[0].display_status
-            # VM may not be successfully deployed in below case
-            if state == 'Provisioning succeeded':
-                state = vm.instance_view.statuses[1].display_status
-
+        vm_states = self.get_vm_states(resource_group)
+        for rg, vm_name in self.unknown_vms:
+            if rg == resource_group.lower():
+                logger.error('VM {} skipped, its state is unknown.'.format(vm_name))
+        for vm_name, state in vm_states:
             if 'running' in state:
                 continue
-            if '-lr' in vm.name or '-longrun' in vm.name:
+            if '-lr' in vm_name or '-longrun' in vm_name:
                 continue
-            if vm.name in vm_whitelist:
+            if vm_name in vm_whitelist:
                 continue
 
             if not delete:
-                logger.info('Unused VM: {}'.format(vm.name))
+                logger.info('Unused VM: {}'.format(vm_name))
+                vm_id = '/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}'.format(
+                        self.azure_ops.subscription_id, resource_group, vm_name)
+                self.plan_resource('vm', resource_group, vm_name, vm_id, state = state)
             else:
-                self.azure_ops.delete_vm(resource_group, vm.name)
-                logger.info('VM {} successfully deleted.'.format(vm.name))
+                try:
+                    self.azure_ops.delete_vm(resource_group, vm_name)
+                except ValueError as e:
+                    logger.error('{}'.format(e))
+                    continue
+                logger.info('VM {} successfully deleted.'.format(vm_name))
     
     def delete_unused_vhds(self, resource_group, delete = False):
 
@@ -75,6 +266,8 @@ class delete_op:
                 continue
             if not delete:
                 logger.info('Unused Disk: {}'.format(disk_name))
+                self.plan_resource('managed_disk', resource_group, disk_name, managed_disk_ref.id, 
+                        etag = getattr(managed_disk_ref, 'etag', None))
             else:
                 self.azure_ops.compute_client.disks.delete(resource_group, disk_name)
                 logger.info('Managed disk {} successfully deleted.'.format(disk_name))
@@ -86,41 +279,98 @@ class delete_op:
             if storage_account.kind == Kind.blob_storage:
                 logger.debug('Listing VHD operations will neglect Blob storage account {}.'.format(storage_account.name))
                 continue
+            self.sweep_storage_account(resource_group, storage_account.name, delete)
 
-            # get storage account keys
-            storage_account_keys = self.azure_ops.storage_client.storage_accounts.list_keys(resource_group, storage_account.name)
-            storage_account_keys_map = {v.key_name: v.value for v in storage_account_keys.keys}
-            storage_account_primary_key = storage_account_keys_map['key1']
+    def sweep_storage_account(self, resource_group, storage_account, delete = False):
+        subscription_id = self.azure_ops.subscription_id
+        if self.checkpoint and self.checkpoint.account_done(subscription_id, storage_account):
+            logger.info('Storage account {} already swept.'.format(storage_account))
+            return
 
-            blob_service = BaseBlobService(account_name = storage_account.name ,account_key = storage_account_primary_key)
-            for container_ref in blob_service.list_containers():
-                container = container_ref.name
-                if container in container_whitelist:
+        blob_service = self.azure_ops.get_blob_service(storage_account, resource_group)
+        for container_ref in blob_service.list_containers():
+            container = container_ref.name
+            if container in container_whitelist:
+                continue
+            marker = None
+            if self.checkpoint:
+                done, marker = self.checkpoint.container(subscription_id, storage_account, container)
+                if done:
                     continue
-                elif re.search('[0-9a-z]{16}-[0-9a-z]{16}-[cdm]0', container):
-                    if delete:
-                        blob_service.delete_container(container_name = container)
-                        logger.info('Storage container {} successfully deleted.'.format(container))
-                    else:
-                        logger.error('Wrong Usage: {}/{}'.format(storage_account.name, container))
-                elif 'bootdiagnostics-' in container:
-                    if delete:
-                        blob_service.delete_container(container_name = container)
-                        logger.info('Storage container {} successfully deleted.'.format(container))
-                    else:
-                        logger.info('Unused Container: {}/{}'.format(storage_account.name, container))
+
+            if re.search('[0-9a-z]{16}-[0-9a-z]{16}-[cdm]0', container):
+                if delete:
+                    blob_service.delete_container(container_name = container)
+                    logger.info('Storage container {} successfully deleted.'.format(container))
                 else:
-                    blobs = blob_service.list_blobs(container_name = container)
-                    for blob in blobs:
-                        if re.search(r'\.vhd', blob.name):
-                            if blob.properties.lease.status == 'unlocked' and blob.properties.lease.state == 'available':
-                                if blob.name in vhd_whitelist:
-                                    continue
-                                if delete:
-                                    delete_ops.azure_ops.delete_blob(resource_group, storage_account.name, container, blob.name)
-                                    logger.info('Unmanaged disk {} successfully deleted.'.format(disk_name))
-                                else:
-                                    logger.info('Unused VHD: {}/{}/{}'.format(storage_account.name, container, blob.name))
+                    logger.error('Wrong Usage: {}/{}'.format(storage_account, container))
+                    self.plan_container(resource_group, blob_service, container_ref)
+            elif 'bootdiagnostics-' in container:
+                if delete:
+                    blob_service.delete_container(container_name = container)
+                    logger.info('Storage container {} successfully deleted.'.format(container))
+                else:
+                    logger.info('Unused Container: {}/{}'.format(storage_account, container))
+                    self.plan_container(resource_group, blob_service, container_ref)
+            else:
+                self.sweep_container(resource_group, blob_service, storage_account, container, marker, delete)
+
+            if self.checkpoint:
+                self.checkpoint.save_container(subscription_id, storage_account, container, done = True)
+
+        if self.checkpoint:
+            self.checkpoint.save_account(subscription_id, storage_account)
+
+    def sweep_container(self, resource_group, blob_service, storage_account, container, marker = None, delete = False):
+        # marker resumes the listing of a checkpointed container
+        if marker:
+            logger.info('Resuming container {}/{}.'.format(storage_account, container))
+        deleted = False
+        for blobs in self.azure_ops.list_blob_pages(blob_service, container, marker):
+            for blob in blobs:
+                if re.search(r'\.vhd', blob.name):
+                    if blob.properties.lease.status == 'unlocked' and blob.properties.lease.state == 'available':
+                        if blob.name in vhd_whitelist:
+                            continue
+                        if delete:
+                            self.azure_ops.delete_blob(resource_group, storage_account, container, blob.name, 
+                                    remove_empty_container = False)
+                            deleted = True
+                            logger.info('Unmanaged disk {} successfully deleted.'.format(blob.name))
+                        else:
+                            logger.info('Unused VHD: {}/{}/{}'.format(storage_account, container, blob.name))
+                            self.plan_resource('vhd', resource_group, blob.name, 
+                                    blob_service.make_blob_url(container, blob.name), storage_account = storage_account, 
+                                    container = container, etag = blob.properties.etag, 
+                                    lease_status = blob.properties.lease.status, lease_state = blob.properties.lease.state)
+            # the page is done, a rerun continues with the next one
+            if self.checkpoint and blobs.next_marker:
+                self.checkpoint.save_container(self.azure_ops.subscription_id, storage_account, container, blobs.next_marker)
+        # check once per container rather than after every delete; a resumed
+        # container may have had its deletes before the checkpoint
+        if deleted or marker:
+            self.azure_ops.delete_container_if_empty(storage_account, container)
+
+    def plan_container(self, resource_group, blob_service, container_ref):
+        # the container etag does not change with its blobs, so they are
+        # recorded as well
+        blob_count, last_modified = self.container_contents(blob_service, container_ref.name)
+        self.plan_resource('container', resource_group, container_ref.name, 
+                'https://{}/{}'.format(blob_service.primary_endpoint, container_ref.name), 
+                storage_account = blob_service.account_name, etag = container_ref.properties.etag, 
+                blob_count = blob_count, last_modified = last_modified)
+
+    def container_contents(self, blob_service, container):
+        # (number of blobs, latest modification time) of a container
+        blob_count = 0
+        last_modified = None
+        for blobs in self.azure_ops.list_blob_pages(blob_service, container):
+            for blob in blobs:
+                blob_count += 1
+                modified = str(blob.properties.last_modified)
+                if last_modified is None or modified > last_modified:
+                    last_modified = modified
+        return blob_count, last_modified
 
     def delete_unused_public_ips(self, resource_group, delete = False):
 
@@ -131,35 +381,371 @@ class delete_op:
                 continue
             if not delete:
                 logger.info('Unused public ip: {}'.format(public_ip_name))
+                self.plan_resource('public_ip', resource_group, public_ip_name, public_ip.id, etag = public_ip.etag)
             else:
                 self.azure_ops.delete_public_ip(resource_group, public_ip_name)
                 logger.info('Public ip {} successfully deleted.'.format(public_ip_name))
     
-    def delete_unused_resources(self, resource_group = None, delete = False):
-        if not resource_group:
-            for resource_group in self.azure_ops.resource_client.resource_groups.list():
-                rg_name = resource_group.name
-                
-                # list unused vms
-                self.delete_unused_vms(rg_name, delete)
-                # list unused vhds
-                self.delete_unused_vhds(rg_name, delete)
-                # list unused nics
-                self.delete_unused_nics(rg_name, delete)
-                # list unused public ips
-                self.delete_unused_public_ips(rg_name, delete)
-
-                logger.info('')
+    def build_reference_graph(self, parallel = 4):
+        # lists each type of resource once for the whole subscription rather
+        # than once per resource group
+        graph = reference_graph()
+        compute_client = self.azure_ops.compute_client
+        network_client = self.azure_ops.network_client
+        vms, nics, public_ips, disks, storage_accounts, vm_states = self.azure_ops.call_concurrently([
+                lambda: list(compute_client.virtual_machines.list_all()),
+                lambda: list(network_client.network_interfaces.list_all()),
+                lambda: list(network_client.public_ip_addresses.list_all()),
+                lambda: list(compute_client.disks.list()),
+                lambda: list(self.azure_ops.storage_client.storage_accounts.list()),
+                lambda: self.azure_ops.get_vm_states(failed = self.unknown_vms)])
+        with self.lock:
+            self.vm_states = vm_states
+
+        # attachments are judged by graph membership: vmss instances and their
+        # nics are not listed, so whatever is attached to something outside
+        # the graph is kept
+        vm_ids = set()
+        # vhd url -> id of the vm using it
+        vhd_users = {}
+        for vm in vms:
+            resource_group = vm.id.split('/')[4]
+            refs = [nic_ref.id for nic_ref in vm.network_profile.network_interfaces]
+            for disk in [vm.storage_profile.os_disk] + list(vm.storage_profile.data_disks or []):
+                if disk.managed_disk:
+                    refs.append(disk.managed_disk.id)
+                if disk.vhd:
+                    refs.append(disk.vhd.uri)
+                    vhd_users[disk.vhd.uri.lower()] = vm.id.lower()
+            # a vm whose state could not be read is kept
+            state = vm_states.get((resource_group.lower(), vm.name))
+            kept = state is None or 'running' in state or '-lr' in vm.name or '-longrun' in vm.name or vm.name in vm_whitelist
+            graph.add('vm', vm.id, resource_group, vm.name, refs, kept, state = state, reason = 'state {}'.format(state))
+            vm_ids.add(vm.id.lower())
+
+        nic_ids = set()
+        for nic in nics:
+            refs = [ip_config.public_ip_address.id for ip_config in nic.ip_configurations or [] if ip_config.public_ip_address]
+            attached = nic.virtual_machine.id.lower() if nic.virtual_machine else None
+            # nics of private endpoints and the like are not ours to judge
+            kept = (attached is not None and attached not in vm_ids) or getattr(nic, 'private_endpoint', None) is not None
+            graph.add('nic', nic.id, nic.id.split('/')[4], nic.name, refs, kept, etag = nic.etag, attached = attached, 
+                    reason = 'not attached')
+            nic_ids.add(nic.id.lower())
+
+        for public_ip in public_ips:
+            attached = None
+            if public_ip.ip_configuration:
+                # the nic, load balancer or gateway of the ip configuration
+                attached = public_ip.ip_configuration.id.lower().split('/ipconfigurations/')[0]
+            # an unassociated ip that still holds an address, e.g. a static
+            # one, is kept as the default sweep keeps it; one used by an
+            # unused nic goes along with the nic
+            if attached is None:
+                kept = bool(public_ip.ip_address)
+            else:
+                kept = attached not in nic_ids
+            graph.add('public_ip', public_ip.id, public_ip.id.split('/')[4], public_ip.name, (), kept, 
+                    etag = public_ip.etag, attached = attached, reason = 'not associated')
+
+        for disk in disks:
+            attached = disk.managed_by.lower() if disk.managed_by else None
+            kept = attached is not None and attached not in vm_ids
+            graph.add('managed_disk', disk.id, disk.id.split('/')[4], disk.name, (), kept, 
+                    etag = getattr(disk, 'etag', None), attached = attached, reason = 'not attached')
+
+        def list_vhds(storage_account):
+            resource_group = storage_account.id.split('/')[4]
+            blob_service = self.azure_ops.get_blob_service(storage_account.name, resource_group)
+            for container_ref in blob_service.list_containers():
+                container = container_ref.name
+                for blobs in self.azure_ops.list_blob_pages(blob_service, container):
+                    for blob in blobs:
+                        if not re.search(r'\.vhd', blob.name):
+                            continue
+                        url = blob_service.make_blob_url(container, blob.name)
+                        lease = blob.properties.lease
+                        leased = lease.status != 'unlocked' or lease.state != 'available'
+                        user = vhd_users.get(url.lower())
+                        # a lease no vm of the subscription explains is kept
+                        kept = container in container_whitelist or blob.name in vhd_whitelist or (leased and user is None)
+                        graph.add('vhd', url, resource_group, blob.name, (), kept, storage_account = storage_account.name, 
+                                container = container, etag = blob.properties.etag, lease_status = lease.status, 
+                                lease_state = lease.state, attached = user if leased else None, reason = 'not used by any VM')
+
+        storage_accounts = [account for account in storage_accounts if account.kind != Kind.blob_storage]
+        for storage_account, result, error in run_concurrently(list_vhds, storage_accounts, parallel):
+            if error:
+                # its vhds are unknown, so are the vms using them
+                raise ValueError('Failed to list VHDs of storage account {}: {}'.format(storage_account.name, error))
+        return graph
+
+    def delete_orphan(self, node):
+        resource_group = node.resource_group
+        if node.kind == 'vm':
+            # its nics and disks are orphans of their own
+            self.azure_ops.compute_client.virtual_machines.delete(resource_group, node.name).wait()
+        elif node.kind == 'nic':
+            self.azure_ops.network_client.network_interfaces.delete(resource_group, node.name).wait()
+        elif node.kind == 'public_ip':
+            self.azure_ops.network_client.public_ip_addresses.delete(resource_group, node.name).wait()
+        elif node.kind == 'managed_disk':
+            self.azure_ops.compute_client.disks.delete(resource_group, node.name).wait()
+        elif node.kind == 'vhd':
+            self.azure_ops.delete_blob(resource_group, node.details['storage_account'], node.details['container'], node.name, 
+                    remove_empty_container = False)
+
+    def plan_orphan(self, node):
+        details = dict(node.details)
+        details.pop('reason')
+        self.plan_resource(node.kind, node.resource_group, node.name, node.id, attached_to = details.pop('attached', None), 
+                **details)
+
+    def delete_orphans(self, resource_group = None, delete = False, parallel = 4, subscription_name = None):
+        # single pass alternative to the per type rules: one reference graph
+        # of the subscription, orphans found by walking it; returns the
+        # number of resource groups holding orphans
+        graph = self.build_reference_graph(parallel)
+        orphans = [(node, reason) for node, reason in graph.find_orphans() 
+                   if not resource_group or node.resource_group.lower() == resource_group.lower()]
+
+        group_logs.start()
+        try:
+            logger.info('')
+            logger.info('Subscription: {}'.format(subscription_name or self.azure_ops.subscription_id))
+            logger.info('{} resources listed, {} orphaned'.format(len(graph.nodes), len(orphans)))
+            for node, reason in sorted(orphans, key = lambda orphan: (orphan[0].resource_group.lower(), orphan[0].kind)):
+                logger.info('Orphaned {}: {}/{} ({})'.format(node.kind, node.resource_group, node.name, reason))
+                if not delete:
+                    self.plan_orphan(node)
+        finally:
+            group_logs.flush()
+
+        if delete:
+            touched_containers = set()
+            # ids of orphans that were not deleted, the resources they use are kept
+            not_deleted = set()
+            for kinds in orphan_waves:
+                wave = []
+                for node, reason in orphans:
+                    if node.kind not in kinds:
+                        continue
+                    if node.details.get('attached') in not_deleted:
+                        logger.info('{} {} kept, {} was not deleted.'.format(node.kind, node.name, 
+                                node.details['attached'].split('/')[-1]))
+                        not_deleted.add(node.id)
+                        continue
+                    wave.append(node)
+                for node, result, error in run_concurrently(self.delete_orphan, wave, parallel):
+                    if error:
+                        logger.error('Failed to delete {} {}/{}: {}'.format(node.kind, node.resource_group, node.name, error))
+                        not_deleted.add(node.id)
+                        with self.lock:
+                            self.failures += 1
+                    else:
+                        logger.info('{} {} successfully deleted.'.format(node.kind, node.name))
+                        if node.kind == 'vhd':
+                            touched_containers.add((node.details['storage_account'], node.details['container']))
+            for storage_account, container in touched_containers:
+                self.azure_ops.delete_container_if_empty(storage_account, container)
+
+        return len(set(node.resource_group.lower() for node, reason in orphans))
+
+    def apply_resource(self, entry):
+        # deletes a resource of a plan if it is still as the dry run saw it;
+        # returns None once deleted, otherwise why it was skipped
+        try:
+            return self.apply_planned_resource(entry)
+        except Exception as e:
+            # gone since the plan, e.g. a nic of a vm deleted before it
+            if getattr(e, 'status_code', None) == 404:
+                return 'no longer exists'
+            raise
+
+    def apply_planned_resource(self, entry):
+        resource_group = entry['resource_group']
+        name = entry['name']
+        kind = entry['type']
+        if kind == 'vm':
+            vm = self.azure_ops.get_vm(resource_group, name)
+            if vm is None:
+                return 'no longer exists'
+            state = self.azure_ops.get_instance_view_state(vm.instance_view)
+            if 'running' in state:
+                return 'state is now {}'.format(state)
+            # only the vm itself: its nics, ips and disks are deleted by their
+            # own entries of the plan, each checked again in a later wave
+            self.azure_ops.compute_client.virtual_machines.delete(resource_group, name).wait()
+        elif kind == 'managed_disk':
+            disk = self.azure_ops.compute_client.disks.get(resource_group, name)
+            reason = self.check_attachment(entry, disk.managed_by, getattr(disk, 'etag', None))
+            if reason:
+                return reason
+            self.azure_ops.compute_client.disks.delete(resource_group, name).wait()
+        elif kind == 'container':
+            blob_service = self.azure_ops.get_blob_service(entry['storage_account'], resource_group)
+            container = blob_service.get_container_properties(container_name = name)
+            if container.properties.etag != entry['etag']:
+                return 'changed since the plan'
+            if self.container_contents(blob_service, name) != (entry.get('blob_count'), entry.get('last_modified')):
+                return 'blobs changed since the plan'
+            blob_service.delete_container(container_name = name)
+        elif kind == 'vhd':
+            blob_service = self.azure_ops.get_blob_service(entry['storage_account'], resource_group)
+            blob = blob_service.get_blob_properties(container_name = entry['container'], blob_name = name)
+            if blob.properties.lease.status != 'unlocked' or blob.properties.lease.state != 'available':
+                return 'now leased'
+            if not entry.get('attached_to') and blob.properties.etag != entry['etag']:
+                return 'changed since the plan'
+            self.azure_ops.delete_blob(resource_group, entry['storage_account'], entry['container'], name, 
+                    remove_empty_container = False)
+        elif kind == 'nic':
+            nic = self.azure_ops.network_client.network_interfaces.get(resource_group, name)
+            reason = self.check_attachment(entry, nic.virtual_machine.id if nic.virtual_machine else None, nic.etag)
+            if reason:
+                return reason
+            self.azure_ops.delete_nic(resource_group, name)
+        elif kind == 'public_ip':
+            public_ip = self.azure_ops.network_client.public_ip_addresses.get(resource_group, name)
+            if 'attached_to' in entry:
+                # found by the reference graph, in use only through its nic
+                attached = public_ip.ip_configuration.id.lower().split('/ipconfigurations/')[0] if public_ip.ip_configuration else None
+                reason = self.check_attachment(entry, attached, public_ip.etag)
+                if reason:
+                    return reason
+            elif public_ip.ip_address:
+                return 'now in use'
+            elif public_ip.etag != entry['etag']:
+                return 'changed since the plan'
+            self.azure_ops.delete_public_ip(resource_group, name)
         else:
+            return 'unknown resource type {}'.format(kind)
+        return None
+
+    def check_attachment(self, entry, attached, etag):
+        # the per type rules plan only detached resources; the reference
+        # graph also plans those attached to an orphan, which apply_plan
+        # deletes first and so detaches them
+        if attached and attached.lower() != entry.get('attached_to'):
+            return 'now attached'
+        if attached:
+            return 'still attached to {}'.format(attached.split('/')[-1])
+        # an attachment going away changes the etag
+        if not entry.get('attached_to') and etag != entry['etag']:
+            return 'changed since the plan'
+
+    def sweep_resource_group(self, resource_group, delete = False, title = None):
+        # the logs of a group are released together once it is done
+        start_time = time.time()
+        group_logs.start()
+        try:
+            logger.info('')
+            logger.info('Resource group: {}'.format(title or resource_group))
             # list unused vms
             self.delete_unused_vms(resource_group, delete)
             # list unused vhds
-            self.delete_unused_vhds(resource_group, delete)
+            try:
+                self.delete_unused_vhds(resource_group, delete)
+            except Exception:
+                with self.lock:
+                    self.vhd_failures += 1
+                raise
             # list unused nics
             self.delete_unused_nics(resource_group, delete)
             # list unused public ips
             self.delete_unused_public_ips(resource_group, delete)
+        except Exception as e:
+            logger.error('Failed to sweep resource group {}: {}'.format(resource_group, e))
+            with self.lock:
+                self.failures += 1
+        finally:
+            group_logs.flush()
+        return time.time() - start_time
+
+    def delete_unused_resources(self, resource_group = None, delete = False, parallel = 1, subscription_name = None):
+        # returns the number of resource groups swept
+        if resource_group:
+            resource_groups = [resource_group]
+            # one group needs only its own vms listed
+            with self.lock:
+                self.vm_states = self.azure_ops.get_vm_states(resource_group, failed = self.unknown_vms)
+        else:
+            resource_groups = [rg.name for rg in self.azure_ops.resource_client.resource_groups.list()]
+
+        def sweep(rg_name):
+            title = '{} ({})'.format(rg_name, subscription_name) if subscription_name else rg_name
+            return self.sweep_resource_group(rg_name, delete, title)
+
+        for rg_name, seconds, error in run_concurrently(sweep, resource_groups, parallel):
+            if error:
+                logger.error('Failed to sweep resource group {}: {}'.format(rg_name, error))
+        return len(resource_groups)
+
+def apply_plan(azure_ops, path, parallel):
+    # deletes the resources of a plan concurrently, each one checked again
+    # with a single lookup instead of scanning the subscriptions
+    plan = load_json_file(path)
+    if 'resources' not in plan:
+        raise ValueError('{} is not a plan of unused resources.'.format(path))
+    resources = plan['resources']
+
+    delete_ops = {}
+    lock = threading.Lock()
+    def get_delete_op(subscription_id):
+        with lock:
+            if subscription_id not in delete_ops:
+                delete_ops[subscription_id] = delete_op(azure_ops.for_subscription(subscription_id))
+            return delete_ops[subscription_id]
+
+    def apply(index):
+        entry = resources[index]
+        return get_delete_op(entry['subscription_id']).apply_resource(entry)
+
+    # users before what they use, as a vm or nic may hold the others
+    waves = [[index for index, entry in enumerate(resources) if entry['type'] in kinds] for kinds in orphan_waves]
+    waves[0] += [index for index, entry in enumerate(resources) if not any(entry['type'] in kinds for kinds in orphan_waves)]
+    results = []
+    # ids of planned resources that were not deleted, what they use is kept
+    not_deleted = set()
+    for wave in waves:
+        pending = []
+        for index in sorted(wave):
+            parent = resources[index].get('attached_to')
+            if parent in not_deleted:
+                results.append((index, '{} was not deleted'.format(parent.split('/')[-1]), None))
+                not_deleted.add(resources[index]['id'].lower())
+            else:
+                pending.append(index)
+        for index, reason, error in run_concurrently(apply, pending, parallel):
+            if error or (reason and reason != 'no longer exists'):
+                not_deleted.add(resources[index]['id'].lower())
+            results.append((index, reason, error))
+
+    deleted = skipped = failed = 0
+    touched_containers = set()
+    for index, reason, error in results:
+        entry = resources[index]
+        title = '{} {}/{}'.format(entry['type'], entry['resource_group'], entry['name'])
+        if error:
+            failed += 1
+            logger.error('{}: failed: {}'.format(title, error))
+        elif reason:
+            skipped += 1
+            logger.info('{}: skipped, {}'.format(title, reason))
+        else:
+            deleted += 1
+            logger.info('{}: deleted'.format(title))
+            if entry['type'] == 'vhd':
+                touched_containers.add((entry['subscription_id'], entry['storage_account'], entry['container']))
+
+    # check once per container rather than after every delete
+    for subscription_id, storage_account, container in touched_containers:
+        try:
+            get_delete_op(subscription_id).azure_ops.delete_container_if_empty(storage_account, container)
+        except Exception as e:
+            logger.error('Failed to remove empty container {}/{}: {}'.format(storage_account, container, e))
 
+    logger.info('{} deleted, {} skipped, {} failed of {} planned resources'.format(deleted, skipped, failed, len(resources)))
 
 if __name__ == '__main__':
 
@@ -167,6 +753,15 @@ if __name__ == '__main__':
     parser.add_argument('-S', '--subscription', help='delete resources from this subscription')
     parser.add_argument('-r', '--resource_group', help='delete resources from this group')
     parser.add_argument('--delete', action='store_true', help='delete resources from this group')
+    parser.add_argument('--parallel', type=int, default=4, help='number of subscriptions, and of resource groups per subscription, swept concurrently; '
+            'number of resources deleted concurrently by --apply')
+    parser.add_argument('--plan', default='unused_resources_plan.json', help='a dry run writes the resources found to this file')
+    parser.add_argument('--apply', metavar='PLAN', help='delete the resources of a plan written by a dry run, without scanning again')
+    parser.add_argument('--graph', action='store_true', 
+            help='find orphans with one reference graph per subscription instead of the per type rules')
+    parser.add_argument('--checkpoint', 
+            help='progress of the vhd sweep of a --delete run, a rerun of the same scope within a day resumes from it '
+            '(default: vhd_sweep.json in the cache directory)')
     parsed_args = parser.parse_args()
 
     # First check whether environmental variables are set
@@ -177,24 +772,62 @@ if __name__ == '__main__':
     except:
         raise SystemError("Please set environmental variables for Service Principal first.")
 
-    delete_ops = delete_op()
+    azure_ops = delete_op().azure_ops
+
+    if parsed_args.apply:
+        apply_plan(azure_ops, parsed_args.apply, parsed_args.parallel)
+        sys.exit(0)
+
     # Get all subscriptions
     subscription_map = {}
-    for subscription in delete_ops.azure_ops.subscription_client.subscriptions.list():
+    for subscription in azure_ops.subscription_client.subscriptions.list():
         subscription_map[subscription.subscription_id] = subscription.display_name
 
     if not parsed_args.subscription:
-        for (sub_id, sub_name) in subscription_map.items(): 
-            # Subscription for Azure Marketplace 
-            if str(sub_id) == '1919bdd0-d66c-4699-8c08-a134883a985a':
-                continue
-            os.environ['AZURE_SUBSCRIPTION_ID'] = str(sub_id)
-            logger.info('')
-            logger.info('Subscription: {} - {}'.format(sub_id, sub_name))
-            delete_ops.azure_ops.init_clients(str(sub_id))
-            delete_ops.delete_unused_resources(parsed_args.resource_group, parsed_args.delete)
+        # Subscription for Azure Marketplace 
+        subscriptions = [str(sub_id) for sub_id in sorted(subscription_map) if str(sub_id) != '1919bdd0-d66c-4699-8c08-a134883a985a']
     else:
-        os.environ['AZURE_SUBSCRIPTION_ID'] = parsed_args.subscription
-        logger.info('Subscription: {} - {}'.format(parsed_args.subscription, subscription_map[parsed_args.subscription]))
-        delete_ops.azure_ops.init_clients(parsed_args.subscription)
-        delete_ops.delete_unused_resources(parsed_args.resource_group, parsed_args.delete)
+        subscriptions = [parsed_args.subscription]
+
+    # only deleting runs are checkpointed, a dry run has to see everything for
+    # its plan; a --graph run leaves the checkpoint of the per type rules alone
+    checkpoint = None
+    if parsed_args.delete and not parsed_args.graph:
+        checkpoint_path = parsed_args.checkpoint or os.path.join(cache_dir(), 'vhd_sweep.json')
+        checkpoint = sweep_checkpoint(checkpoint_path, {'subscription' : parsed_args.subscription, 
+                'resource_group' : parsed_args.resource_group})
+        if checkpoint.stale:
+            logger.info('Ignoring the VHD sweep checkpoint {}, it is stale or of another scope'.format(checkpoint_path))
+        elif checkpoint.resumed():
+            logger.info('Resuming the VHD sweep from {}'.format(checkpoint_path))
+
+    # every subscription gets its own clients, see azure_operations.for_subscription
+    def sweep_subscription(sub_id):
+        start_time = time.time()
+        delete_ops = delete_op(azure_ops.for_subscription(sub_id), checkpoint)
+        sweep = delete_ops.delete_orphans if parsed_args.graph else delete_ops.delete_unused_resources
+        resource_groups = sweep(parsed_args.resource_group, parsed_args.delete, parsed_args.parallel,
+                '{} - {}'.format(sub_id, subscription_map[sub_id]))
+        return resource_groups, time.time() - start_time, delete_ops.plan, delete_ops.vhd_failures, len(delete_ops.unknown_vms)
+
+    results = list(run_concurrently(sweep_subscription, subscriptions, parsed_args.parallel))
+    logger.info('')
+    logger.info('Subscription timings:')
+    for sub_id, result, error in results:
+        if error:
+            logger.error('{} - {}: failed: {}'.format(sub_id, subscription_map[sub_id], error))
+        else:
+            logger.info('{} - {}: {} resource groups in {:.0f}s'.format(sub_id, subscription_map[sub_id], result[0], result[1]))
+            if result[4]:
+                logger.error('{} - {}: {} VMs skipped, their state is unknown'.format(sub_id, subscription_map[sub_id], result[4]))
+
+    # the next run starts from scratch unless its vhd sweep was cut short
+    if checkpoint and not any(error or result[3] for sub_id, result, error in results):
+        checkpoint.clear()
+
+    if not parsed_args.delete:
+        resources = [entry for sub_id, result, error in results if result for entry in result[2]]
+        dump_json_file(parsed_args.plan, {'created_at' : time.time(), 'resources' : resources})
+        logger.info('')
+        logger.info('Plan of {} resources written to {}, delete them with --apply {}'.format(len(resources), parsed_args.plan, 
+                parsed_args.plan))
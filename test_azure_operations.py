@@ -0,0 +1,309 @@
+import sys, os, json, shutil, tempfile, threading, types, unittest
+
+# offline tests of azure_operations helpers that need no Azure login; the
+# compute sdk is only needed for Plan at deploy time
+try:
+    import azure.mgmt.compute.models
+except ImportError:
+    for name in ['azure', 'azure.mgmt', 'azure.mgmt.compute', 'azure.mgmt.compute.models']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules['azure.mgmt.compute.models'].Plan = lambda **attributes: attributes
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import azure_operations
+from azure_operations import token_bucket, request_throttle, token_cache, run_concurrently
+
+class stub(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+def offline_azure_ops():
+    # an azure_operations without login, its clients are set by the test
+    azure_ops = azure_operations.azure_operations.__new__(azure_operations.azure_operations)
+    azure_ops.lock = threading.RLock()
+    azure_ops.worker_context = None
+    azure_ops.no_wait = False
+    azure_ops.output = 'text'
+    azure_ops.subscription_id = 'sub'
+    return azure_ops
+
+class token_bucket_test(unittest.TestCase):
+    def setUp(self):
+        # a frozen clock and recorded sleeps
+        self.now = 1000.0
+        self.slept = []
+        self.time, self.sleep = azure_operations.time.time, azure_operations.time.sleep
+        azure_operations.time.time = lambda: self.now
+        azure_operations.time.sleep = self.slept.append
+
+    def tearDown(self):
+        azure_operations.time.time, azure_operations.time.sleep = self.time, self.sleep
+
+    def test_burst_then_rate(self):
+        bucket = token_bucket(2, 2)
+        self.assertEqual([bucket.acquire() for i in range(3)], [0, 0, 0.5])
+        self.assertEqual(self.slept, [0.5])
+
+    def test_concurrent_pauses_overlap(self):
+        bucket = token_bucket(2, 10)
+        for i in range(5):
+            bucket.pause(10)
+        self.assertEqual(bucket.tokens, -20)
+        # the next request waits out the pause once
+        self.assertEqual(bucket.acquire(), 10.5)
+
+    def test_shorter_pause_keeps_the_longer_one(self):
+        bucket = token_bucket(2, 10)
+        bucket.pause(10)
+        bucket.pause(1)
+        self.assertEqual(bucket.tokens, -20)
+
+    def test_pause_wears_off(self):
+        bucket = token_bucket(2, 10)
+        bucket.pause(10)
+        self.now += 10.5
+        self.assertEqual(bucket.acquire(), 0)
+
+    def test_throttled_blob_retry_waits_in_the_bucket_only(self):
+        throttle = request_throttle()
+        retry = throttle.storage_retry('account', lambda retry_context: 3)
+        throttled = stub(count = 0, response = stub(status = 503, headers = {'Retry-After' : '10'}))
+        self.assertEqual(retry(throttled), 0)
+        self.assertTrue(throttle.bucket('account').tokens <= -10 * throttle.rate)
+        failed = stub(count = 0, response = stub(status = 500, headers = {}))
+        self.assertEqual(retry(failed), 3)
+
+class poll_operation_test(unittest.TestCase):
+    def setUp(self):
+        # the poll's GET answers with self.responses in turn
+        self.responses = []
+        self.throttled_credentials = azure_operations.throttled_credentials
+        session = stub(get = lambda url, timeout: self.responses.pop(0))
+        azure_operations.throttled_credentials = lambda credentials, key: stub(signed_session = lambda: session)
+        self.azure_ops = offline_azure_ops()
+        self.azure_ops.credentials = None
+
+    def tearDown(self):
+        azure_operations.throttled_credentials = self.throttled_credentials
+
+    def respond(self, status_code, body = None, headers = None):
+        self.responses.append(stub(status_code = status_code, headers = headers or {},
+                content = json.dumps(body) if body is not None else '', json = lambda: body))
+
+    def poll(self, kind, method = 'PUT', entry = None):
+        entry = entry or {'id' : 'op', 'kind' : kind, 'url' : 'https://management/op', 'method' : method}
+        return self.azure_ops.poll_operation(entry)
+
+    def test_async_status(self):
+        self.respond(200, {'status' : 'InProgress'}, {'Retry-After' : '5'})
+        self.assertEqual(self.poll('async'), ('InProgress', None, 5))
+        self.respond(200, {'status' : 'Failed', 'error' : {'message' : 'quota'}})
+        self.assertEqual(self.poll('async'), ('Failed', 'quota', 0))
+
+    def test_location_status(self):
+        self.respond(202)
+        self.assertEqual(self.poll('location'), ('InProgress', None, 0))
+        self.respond(200, {})
+        self.assertEqual(self.poll('location'), ('Succeeded', None, 0))
+
+    def test_location_client_error_fails(self):
+        self.respond(409, {'error' : {'message' : 'conflict'}})
+        self.assertEqual(self.poll('location'), ('Failed', 'conflict', 0))
+        self.respond(400)
+        self.assertEqual(self.poll('location'), ('Failed', 'HTTP 400', 0))
+
+    def test_deleted_resource_is_gone(self):
+        self.respond(404)
+        self.assertEqual(self.poll('location', 'DELETE')[0], 'Succeeded')
+
+    def test_async_client_error_raises(self):
+        self.respond(403, {'error' : {'message' : 'forbidden'}})
+        self.assertRaises(ValueError, self.poll, 'async')
+
+    def test_server_errors_fail_after_a_bound(self):
+        entry = {'id' : 'op', 'kind' : 'location', 'url' : 'https://management/op', 'method' : 'PUT'}
+        statuses = []
+        for i in range(azure_operations.max_poll_server_errors):
+            self.respond(500, {'error' : {'message' : 'internal'}})
+            statuses.append(self.poll('location', entry = entry)[:2])
+        self.assertEqual(statuses[:-1], [('InProgress', None)] * (azure_operations.max_poll_server_errors - 1))
+        self.assertEqual(statuses[-1], ('Failed', 'internal'))
+
+    def test_success_resets_the_server_errors(self):
+        entry = {'id' : 'op', 'kind' : 'location', 'url' : 'https://management/op', 'method' : 'PUT'}
+        for status_code in [500] * (azure_operations.max_poll_server_errors - 1) + [202, 500]:
+            self.respond(status_code)
+            status = self.poll('location', entry = entry)[0]
+        self.assertEqual(status, 'InProgress')
+
+class get_vm_states_test(unittest.TestCase):
+    def azure_ops(self, listed, fetched):
+        # listed vms come from the group listing, fetched ones from a get per vm
+        azure_ops = offline_azure_ops()
+        azure_ops.gets = []
+        azure_ops.lists = []
+        def get(resource_group, vmname, expand):
+            azure_ops.gets.append(vmname)
+            return fetched[vmname]
+        def list_vms(resource_group, **kwargs):
+            azure_ops.lists.append(resource_group)
+            return listed
+        azure_ops.compute_client = stub(virtual_machines = stub(list = list_vms, get = get),
+                disks = stub(list_by_resource_group = lambda resource_group: []))
+        azure_ops.network_client = stub(network_interfaces = stub(list = lambda resource_group: []),
+                public_ip_addresses = stub(list = lambda resource_group: []))
+        return azure_ops
+
+    def vm(self, name, state = None):
+        statuses = [stub(display_status = 'Provisioning succeeded'), stub(display_status = state)] if state else None
+        return stub(id = '/subscriptions/sub/resourceGroups/RG/providers/Microsoft.Compute/virtualMachines/' + name,
+                name = name, instance_view = stub(statuses = statuses) if state else None)
+
+    def test_listed_instance_views_are_used(self):
+        azure_ops = self.azure_ops([self.vm('vm1', 'VM running')], {})
+        self.assertEqual(azure_ops.get_vm_states('RG'), {('rg', 'vm1') : 'VM running'})
+        self.assertEqual(azure_ops.gets, [])
+
+    def test_dropped_expand_falls_back_to_each_vm(self):
+        azure_ops = self.azure_ops([self.vm('vm1'), self.vm('vm2')],
+                {'vm1' : self.vm('vm1', 'VM running'), 'vm2' : self.vm('vm2', 'VM deallocated')})
+        self.assertEqual(azure_ops.get_vm_states('RG'), {('rg', 'vm1') : 'VM running', ('rg', 'vm2') : 'VM deallocated'})
+        self.assertEqual(sorted(azure_ops.gets), ['vm1', 'vm2'])
+
+    def test_snapshot_lists_the_vms_once(self):
+        azure_ops = self.azure_ops([self.vm('vm1', 'VM running'), self.vm('vm2')], {'vm2' : self.vm('vm2', 'VM stopped')})
+        snapshot = azure_operations.resource_group_snapshot(azure_ops, 'RG')
+        self.assertEqual(snapshot.states, {'vm1' : 'VM running', 'vm2' : 'VM stopped'})
+        self.assertEqual(azure_ops.lists, ['RG'])
+
+    def test_unreadable_state_is_reported(self):
+        failed = []
+        azure_ops = self.azure_ops([self.vm('vm1')], {'vm1' : self.vm('vm1')})
+        self.assertEqual(azure_ops.get_vm_states('RG', failed = failed), {})
+        self.assertEqual(failed, [('rg', 'vm1')])
+
+class run_concurrently_test(unittest.TestCase):
+    def test_results_keep_the_order_of_items(self):
+        def square(item):
+            if item == 3:
+                raise ValueError('three')
+            return item * item
+        results = list(run_concurrently(square, range(5), 3))
+        self.assertEqual([(item, result) for item, result, error in results], [(0, 0), (1, 1), (2, 4), (3, None), (4, 16)])
+        self.assertEqual([str(error) for item, result, error in results if error], ['three'])
+
+    def test_single_item_runs_inline(self):
+        threads = [item() for item, result, error in run_concurrently(lambda func: func(), 
+                [threading.current_thread], 10)]
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_context_is_made_in_the_calling_thread(self):
+        made_in = []
+        def context():
+            made_in.append(threading.current_thread())
+            return lambda func, item: ('in context', func(item))
+        results = [result for item, result, error in run_concurrently(lambda item: item, [1, 2], 2, context = context)]
+        self.assertEqual(results, [('in context', 1), ('in context', 2)])
+        self.assertEqual(made_in, [threading.current_thread()])
+
+class token_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = token_cache(os.path.join(self.dir, 'tokens.json'))
+        self.logins = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def login(self):
+        self.logins.append(threading.current_thread())
+        return 'azure', stub(token = {'access_token' : 'token{}'.format(len(self.logins)), 'expires_in' : 3600})
+
+    def test_concurrent_fetches_log_in_once(self):
+        tokens = []
+        threads = [threading.Thread(target = lambda: tokens.append(self.cache.fetch('tenant', 'client', self.login)[1]))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.logins), 1)
+        self.assertEqual(set(token['access_token'] for token in tokens), set(['token1']))
+
+    def test_token_near_expiry_is_refreshed(self):
+        self.cache.fetch('tenant', 'client', self.login)
+        entries = azure_operations.load_json_file(self.cache.path)
+        for entry in entries.values():
+            entry['expires_at'] = azure_operations.time.time() + token_cache.refresh_margin - 1
+        azure_operations.dump_json_file(self.cache.path, entries)
+        cloud, token, expires_at = self.cache.fetch('tenant', 'client', self.login)
+        self.assertEqual((cloud, token['access_token']), ('azure', 'token2'))
+
+class attach_data_disks_test(unittest.TestCase):
+    def setUp(self):
+        self.created = []
+        self.updates = []
+        self.vm = stub(name = 'vm1', storage_profile = stub(os_disk = stub(managed_disk = stub()),
+                data_disks = [stub(lun = 0), stub(lun = 2)]))
+        self.azure_ops = offline_azure_ops()
+        self.azure_ops.get_vm = lambda resource_group, vmname: self.vm
+        def managed_data_disk(resource_group, vm, disk_name, disk_size, lun, existing):
+            self.created.append(disk_name)
+            return stub(name = disk_name, lun = lun, size = disk_size)
+        self.azure_ops.managed_data_disk = managed_data_disk
+        def create_or_update(resource_group, vmname, vm):
+            self.updates.append([disk.lun for disk in vm.storage_profile.data_disks])
+            return stub(result = lambda: vm)
+        self.azure_ops.compute_client = stub(virtual_machines = stub(create_or_update = create_or_update))
+
+    def test_free_luns_are_taken_in_order(self):
+        self.azure_ops.attach_data_disks('rg', 'vm1', [('d1', '10', None), ('d2', 5000, None), ('d3', 0, None)])
+        self.assertEqual(self.updates, [[0, 2, 1, 3, 4]])
+        self.assertEqual([disk.size for disk in self.vm.storage_profile.data_disks[2:]], [10, 4095, 1])
+
+    def test_bad_size_fails_before_any_disk_is_created(self):
+        self.assertRaises(ValueError, self.azure_ops.attach_data_disks, 'rg', 'vm1', [('d1', '10', None), ('d2', 'big', None)])
+        self.assertEqual(self.created, [])
+
+    def test_too_many_disks_fail_before_any_disk_is_created(self):
+        self.vm.storage_profile.data_disks = [stub(lun = lun) for lun in range(99)]
+        self.assertRaises(ValueError, self.azure_ops.attach_data_disks, 'rg', 'vm1', [('d1', 1, None), ('d2', 1, None)])
+        self.assertEqual(self.created, [])
+
+class deploy_vm_test(unittest.TestCase):
+    def setUp(self):
+        self.deleted = []
+        self.azure_ops = offline_azure_ops()
+        self.azure_ops.create_nic = lambda resource_group, vnet, subnet, location, nic_name: stub(id = nic_name)
+        self.azure_ops.delete_nic = lambda resource_group, nic_name: self.deleted.append(nic_name)
+        self.azure_ops.create_vm_parameters = lambda **parameters: stub(plan = None)
+        def create_or_update(resource_group, vmname, parameters):
+            raise ValueError('quota exceeded')
+        self.azure_ops.compute_client = stub(virtual_machines = stub(create_or_update = create_or_update))
+
+    def deploy(self, existing_nics):
+        return self.azure_ops.deploy_vm('rg', None, 'westus', 'Standard_D2', 'vm-001', 'vnet', 'sub1,sub2', 
+                password = 'secret', validated = True, existing_nics = existing_nics)
+
+    def test_failed_create_removes_only_the_nics_it_made(self):
+        try:
+            self.deploy({'vm-001-nic1' : stub(id = 'vm-001-nic1')})
+        except ValueError as e:
+            self.assertTrue('quota exceeded' in str(e))
+        else:
+            self.fail('deploy_vm did not fail')
+        self.assertEqual(self.deleted, ['vm-001-nic2'])
+
+    def test_failed_cleanup_does_not_hide_the_error(self):
+        def delete_nic(resource_group, nic_name):
+            raise ValueError('nic busy')
+        self.azure_ops.delete_nic = delete_nic
+        try:
+            self.deploy({})
+        except ValueError as e:
+            self.assertTrue('quota exceeded' in str(e))
+        else:
+            self.fail('deploy_vm did not fail')
+
+if __name__ == '__main__':
+    unittest.main()
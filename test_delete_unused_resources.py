@@ -0,0 +1,387 @@
+import sys, os, json, shutil, tempfile, types, logging, unittest
+
+# offline tests of the cleanup logic with stubbed clients; the storage sdk is
+# only needed for Kind at import time
+try:
+    import azure.mgmt.storage.models
+except ImportError:
+    for name in ['azure', 'azure.mgmt', 'azure.mgmt.storage', 'azure.mgmt.storage.models']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules['azure.mgmt.storage.models'].Kind = type('Kind', (), {'blob_storage' : 'BlobStorage'})
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from delete_unused_resources import reference_graph, delete_op, apply_plan, sweep_checkpoint, log_buffer, logger
+from azure_operations import run_concurrently
+
+class stub(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class not_found(Exception):
+    status_code = 404
+
+def resource_id(kind, resource_group, name):
+    return '/subscriptions/sub/resourceGroups/{}/providers/{}/{}'.format(resource_group, kind, name)
+
+def vm_id(name):
+    return resource_id('Microsoft.Compute/virtualMachines', 'rg', name)
+
+def nic_id(name):
+    return resource_id('Microsoft.Network/networkInterfaces', 'rg', name)
+
+def ip_id(name):
+    return resource_id('Microsoft.Network/publicIPAddresses', 'rg', name)
+
+def disk_id(name):
+    return resource_id('Microsoft.Compute/disks', 'rg', name)
+
+class fake_azure_ops(object):
+    # the parts of azure_operations the cleanup uses, backed by lists
+    subscription_id = 'sub'
+    worker_context = None
+
+    def __init__(self, vms = (), nics = (), public_ips = (), disks = (), states = None):
+        self.compute_client = stub(
+                virtual_machines = stub(list_all = lambda: list(vms)),
+                disks = stub(list = lambda: list(disks), list_by_resource_group = lambda resource_group: list(disks)))
+        self.network_client = stub(
+                network_interfaces = stub(list_all = lambda: list(nics), list = lambda resource_group: list(nics)),
+                public_ip_addresses = stub(list_all = lambda: list(public_ips),
+                    list = lambda resource_group: list(public_ips)))
+        self.storage_client = stub(storage_accounts = stub(list = lambda: [], list_by_resource_group = lambda resource_group: []))
+        self.states = states or {}
+
+    def get_vm_states(self, resource_group = None, failed = None):
+        # one worker per vm, as azure_operations.get_vm_states
+        def get_state(item):
+            logger.debug('State of VM {}'.format(item[1]))
+            return self.states[item]
+        return dict((item, state) for item, state, error in
+                    run_concurrently(get_state, sorted(self.states), 10, context = self.worker_context))
+
+    def call_concurrently(self, funcs):
+        return [func() for func in funcs]
+
+class captured_logs(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def make_vm(name, nics = (), managed_disks = ()):
+    return stub(id = vm_id(name), name = name,
+            network_profile = stub(network_interfaces = [stub(id = nic_id(nic)) for nic in nics]),
+            storage_profile = stub(os_disk = stub(managed_disk = None, vhd = None),
+                data_disks = [stub(managed_disk = stub(id = disk_id(disk)), vhd = None) for disk in managed_disks]))
+
+def make_nic(name, vm = None, public_ip = None):
+    return stub(id = nic_id(name), name = name, etag = 'n', virtual_machine = stub(id = vm_id(vm)) if vm else None,
+            ip_configurations = [stub(public_ip_address = stub(id = ip_id(public_ip)) if public_ip else None)])
+
+def make_public_ip(name, attached_to = None, ip_address = None):
+    return stub(id = ip_id(name), name = name, etag = 'p', ip_address = ip_address,
+            ip_configuration = stub(id = attached_to + '/ipConfigurations/ipconfig1') if attached_to else None)
+
+def make_disk(name, managed_by = None):
+    return stub(id = disk_id(name), name = name, etag = 'd', managed_by = managed_by)
+
+class find_orphans_test(unittest.TestCase):
+    def orphans(self, graph):
+        return dict((node.name, reason) for node, reason in graph.find_orphans())
+
+    def test_unreached_chain_is_orphaned(self):
+        graph = reference_graph()
+        graph.add('vm', vm_id('running'), 'rg', 'running', [nic_id('nic1')], True)
+        graph.add('vm', vm_id('stopped'), 'rg', 'stopped', [nic_id('nic2')], reason = 'state stopped')
+        graph.add('nic', nic_id('nic1'), 'rg', 'nic1', [ip_id('ip1')])
+        graph.add('nic', nic_id('nic2'), 'rg', 'nic2', [ip_id('ip2')])
+        graph.add('public_ip', ip_id('ip1'), 'rg', 'ip1')
+        graph.add('public_ip', ip_id('ip2'), 'rg', 'ip2')
+        self.assertEqual(self.orphans(graph), {
+            'stopped' : 'state stopped',
+            'nic2' : 'only used by unused vm stopped',
+            'ip2' : 'only used by unused nic nic2'})
+
+    def test_ids_are_compared_lower_cased(self):
+        graph = reference_graph()
+        graph.add('vm', vm_id('vm1'), 'rg', 'vm1', [disk_id('DISK1').upper()], True)
+        graph.add('managed_disk', disk_id('disk1'), 'rg', 'disk1')
+        self.assertEqual(self.orphans(graph), {})
+
+    def test_references_outside_the_graph_are_ignored(self):
+        graph = reference_graph()
+        graph.add('vm', vm_id('vm1'), 'rg', 'vm1', [nic_id('elsewhere')], True)
+        graph.add('nic', nic_id('nic1'), 'rg', 'nic1', reason = 'not attached')
+        self.assertEqual(self.orphans(graph), {'nic1' : 'not attached'})
+
+class build_reference_graph_test(unittest.TestCase):
+    def orphans(self, azure_ops):
+        graph = delete_op(azure_ops).build_reference_graph()
+        return sorted(node.name for node, reason in graph.find_orphans())
+
+    def test_resources_of_a_stopped_vm_are_orphaned(self):
+        azure_ops = fake_azure_ops(
+                vms = [make_vm('vm1', ['nic1'], ['disk1'])],
+                nics = [make_nic('nic1', 'vm1', 'ip1')],
+                public_ips = [make_public_ip('ip1', nic_id('nic1'), '10.0.0.1')],
+                disks = [make_disk('disk1', vm_id('vm1'))],
+                states = {('rg', 'vm1') : 'PowerState/deallocated'})
+        self.assertEqual(self.orphans(azure_ops), ['disk1', 'ip1', 'nic1', 'vm1'])
+
+    def test_running_vm_keeps_its_resources(self):
+        azure_ops = fake_azure_ops(
+                vms = [make_vm('vm1', ['nic1'], ['disk1'])],
+                nics = [make_nic('nic1', 'vm1', 'ip1')],
+                public_ips = [make_public_ip('ip1', nic_id('nic1'))],
+                disks = [make_disk('disk1', vm_id('vm1'))],
+                states = {('rg', 'vm1') : 'PowerState/running'})
+        self.assertEqual(self.orphans(azure_ops), [])
+
+    def test_vm_without_state_is_kept(self):
+        azure_ops = fake_azure_ops(vms = [make_vm('vm1', ['nic1'])], nics = [make_nic('nic1', 'vm1')])
+        self.assertEqual(self.orphans(azure_ops), [])
+
+    def test_resources_attached_outside_the_graph_are_kept(self):
+        vmss_instance = resource_id('Microsoft.Compute/virtualMachineScaleSets', 'rg', 'ss/virtualMachines/0')
+        vmss_nic = resource_id('Microsoft.Compute/virtualMachineScaleSets', 'rg', 'ss/virtualMachines/0/networkInterfaces/n')
+        load_balancer = resource_id('Microsoft.Network/loadBalancers', 'rg', 'lb')
+        azure_ops = fake_azure_ops(
+                public_ips = [make_public_ip('vmss_ip', vmss_nic), make_public_ip('lb_ip', load_balancer),
+                              make_public_ip('static_ip', ip_address = '10.0.0.1'), make_public_ip('free_ip')],
+                disks = [make_disk('vmss_disk', vmss_instance), make_disk('free_disk')])
+        self.assertEqual(self.orphans(azure_ops), ['free_disk', 'free_ip'])
+
+class log_buffer_test(unittest.TestCase):
+    def setUp(self):
+        self.logs = captured_logs()
+        self.buffer = log_buffer()
+        logger.addHandler(self.logs)
+        logger.addFilter(self.buffer)
+
+    def tearDown(self):
+        logger.removeFilter(self.buffer)
+        logger.removeHandler(self.logs)
+
+    def test_records_are_held_until_flushed(self):
+        self.buffer.start()
+        logger.info('first')
+        logger.info('second')
+        self.assertEqual(self.logs.messages, [])
+        self.buffer.flush()
+        self.assertEqual(self.logs.messages, ['first', 'second'])
+        logger.info('unbuffered')
+        self.assertEqual(self.logs.messages[-1], 'unbuffered')
+
+    def test_workers_log_into_the_buffer_of_their_caller(self):
+        self.buffer.start()
+        logger.info('before')
+        for item, result, error in run_concurrently(lambda item: logger.info('worker {}'.format(item)), [1, 2, 3], 3,
+                context = self.buffer.share):
+            self.assertEqual(error, None)
+        self.assertEqual(self.logs.messages, [])
+        self.buffer.flush()
+        self.assertEqual(self.logs.messages[0], 'before')
+        self.assertEqual(sorted(self.logs.messages[1:]), ['worker 1', 'worker 2', 'worker 3'])
+
+    def test_inline_call_keeps_the_buffer(self):
+        self.buffer.start()
+        logger.info('before')
+        list(run_concurrently(lambda item: logger.info('inline'), [1], 10, context = self.buffer.share))
+        logger.info('after')
+        self.buffer.flush()
+        self.assertEqual(self.logs.messages, ['before', 'inline', 'after'])
+
+class sweep_resource_group_test(unittest.TestCase):
+    def setUp(self):
+        self.logs = captured_logs()
+        logger.addHandler(self.logs)
+
+    def tearDown(self):
+        logger.removeHandler(self.logs)
+
+    def sweep(self, states):
+        delete_ops = delete_op(fake_azure_ops(states = states))
+        delete_ops.sweep_resource_group('rg')
+        self.assertEqual(delete_ops.failures, 0)
+        return self.logs.messages
+
+    def test_group_with_one_vm(self):
+        # a single item runs on the sweeping thread itself
+        self.assertEqual(self.sweep({('rg', 'vm1') : 'PowerState/deallocated'}), 
+                ['', 'Resource group: rg', 'Unused VM: vm1'])
+
+    def test_group_with_several_vms(self):
+        states = dict((('rg', 'vm{}'.format(index)), 'PowerState/deallocated') for index in range(3))
+        self.assertEqual(self.sweep(states), ['', 'Resource group: rg', 'Unused VM: vm0', 'Unused VM: vm1', 'Unused VM: vm2'])
+
+class blob_page(list):
+    def __init__(self, blobs, next_marker = None):
+        list.__init__(self, blobs)
+        self.next_marker = next_marker
+
+def make_blob(name):
+    return stub(name = name, properties = stub(etag = 'b', lease = stub(status = 'unlocked', state = 'available')))
+
+class sweep_checkpoint_test(unittest.TestCase):
+    scope = {'subscription' : None, 'resource_group' : 'rg'}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'vhd_sweep.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def sweep(self, checkpoint, pages, fail_after = None):
+        # deletes the vhds of container c1 of account sa1 page by page,
+        # failing once fail_after blobs are deleted
+        deleted = []
+        markers = []
+        def list_blob_pages(blob_service, container, marker = None):
+            markers.append(marker)
+            start = [page.next_marker for page in pages].index(marker) + 1 if marker else 0
+            return iter(pages[start:])
+        def delete_blob(resource_group, storage_account, container, blob_name, remove_empty_container = True):
+            if fail_after is not None and len(deleted) == fail_after:
+                raise IOError('connection reset')
+            deleted.append(blob_name)
+        azure_ops = fake_azure_ops()
+        azure_ops.get_blob_service = lambda storage_account, resource_group = None: stub(
+                list_containers = lambda: [stub(name = 'c1')])
+        azure_ops.list_blob_pages = list_blob_pages
+        azure_ops.delete_blob = delete_blob
+        azure_ops.delete_container_if_empty = lambda storage_account, container: None
+        try:
+            delete_op(azure_ops, checkpoint).sweep_storage_account('rg', 'sa1', True)
+        except IOError:
+            pass
+        return deleted, markers
+
+    def test_rerun_resumes_at_the_next_page(self):
+        pages = [blob_page([make_blob('a.vhd')], '2'), blob_page([make_blob('b.vhd')])]
+        checkpoint = sweep_checkpoint(self.path, self.scope)
+        self.assertEqual(self.sweep(checkpoint, pages, fail_after = 1), (['a.vhd'], [None]))
+
+        checkpoint = sweep_checkpoint(self.path, self.scope)
+        self.assertFalse(checkpoint.stale)
+        self.assertTrue(checkpoint.resumed())
+        self.assertEqual(self.sweep(checkpoint, pages), (['b.vhd'], ['2']))
+        self.assertTrue(checkpoint.account_done('sub', 'sa1'))
+
+        # a finished account is skipped
+        self.assertEqual(self.sweep(sweep_checkpoint(self.path, self.scope), pages), ([], []))
+
+    def test_checkpoint_of_another_scope_is_ignored(self):
+        checkpoint = sweep_checkpoint(self.path, self.scope)
+        checkpoint.save_account('sub', 'sa1')
+        checkpoint = sweep_checkpoint(self.path, {'subscription' : None, 'resource_group' : 'other'})
+        self.assertTrue(checkpoint.stale)
+        self.assertFalse(checkpoint.account_done('sub', 'sa1'))
+
+    def test_old_checkpoint_is_ignored(self):
+        checkpoint = sweep_checkpoint(self.path, self.scope)
+        checkpoint.created_at -= sweep_checkpoint.max_age + 1
+        checkpoint.save_account('sub', 'sa1')
+        self.assertTrue(sweep_checkpoint(self.path, self.scope).stale)
+
+class apply_test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def apply(self, azure_ops, resources):
+        path = os.path.join(self.directory, 'plan.json')
+        with open(path, 'w') as f:
+            json.dump({'resources' : resources}, f)
+        azure_ops.for_subscription = lambda subscription_id: azure_ops
+        apply_plan(azure_ops, path, 1)
+
+    def test_apply_resource_skip_reasons(self):
+        azure_ops = fake_azure_ops()
+        def get_nic(resource_group, name):
+            if name == 'gone':
+                raise not_found()
+            return make_nic(name, 'vm1' if name == 'attached' else None)
+        azure_ops.network_client.network_interfaces.get = get_nic
+        azure_ops.network_client.public_ip_addresses.get = lambda resource_group, name: stub(ip_address = '1.2.3.4')
+        apply_resource = delete_op(azure_ops).apply_resource
+        def nic_entry(name, etag = 'n'):
+            return {'type' : 'nic', 'resource_group' : 'rg', 'name' : name, 'etag' : etag}
+        self.assertEqual(apply_resource(nic_entry('gone')), 'no longer exists')
+        self.assertEqual(apply_resource(nic_entry('attached')), 'now attached')
+        self.assertEqual(apply_resource(nic_entry('nic1', 'old')), 'changed since the plan')
+        self.assertEqual(apply_resource({'type' : 'public_ip', 'resource_group' : 'rg', 'name' : 'ip1', 'etag' : 'p'}),
+                'now in use')
+        self.assertEqual(apply_resource({'type' : 'lb', 'resource_group' : 'rg', 'name' : 'lb1'}),
+                'unknown resource type lb')
+
+    def test_container_with_new_blobs_is_kept(self):
+        deleted = []
+        blobs = [stub(properties = stub(last_modified = '2026-01-01'))]
+        blob_service = stub(get_container_properties = lambda container_name: stub(properties = stub(etag = 'c')),
+                delete_container = lambda container_name: deleted.append(container_name))
+        azure_ops = fake_azure_ops()
+        azure_ops.get_blob_service = lambda storage_account, resource_group = None: blob_service
+        azure_ops.list_blob_pages = lambda blob_service, container: [list(blobs)]
+        apply_resource = delete_op(azure_ops).apply_resource
+        entry = {'type' : 'container', 'resource_group' : 'rg', 'name' : 'bootdiagnostics-x', 'storage_account' : 'sa',
+                 'etag' : 'c', 'blob_count' : 1, 'last_modified' : '2026-01-01'}
+        blobs.append(stub(properties = stub(last_modified = '2026-02-01')))
+        self.assertEqual(apply_resource(entry), 'blobs changed since the plan')
+        blobs.pop()
+        self.assertEqual(apply_resource(entry), None)
+        self.assertEqual(deleted, ['bootdiagnostics-x'])
+
+    def test_check_attachment(self):
+        check = delete_op(fake_azure_ops()).check_attachment
+        planned = {'etag' : 'e'}
+        self.assertEqual(check(planned, None, 'e'), None)
+        self.assertEqual(check(planned, None, 'f'), 'changed since the plan')
+        self.assertEqual(check(planned, vm_id('vm1'), 'e'), 'now attached')
+        graph_planned = {'etag' : 'e', 'attached_to' : vm_id('vm1').lower()}
+        # detached by the delete of its parent, which changes the etag
+        self.assertEqual(check(graph_planned, None, 'f'), None)
+        self.assertEqual(check(graph_planned, vm_id('vm1'), 'e'), 'still attached to vm1')
+        self.assertEqual(check(graph_planned, vm_id('vm2'), 'e'), 'now attached')
+
+    def test_children_of_a_skipped_vm_are_kept(self):
+        lookups = []
+        def get_nic(resource_group, name):
+            lookups.append(name)
+            return make_nic(name, 'vm1')
+        azure_ops = fake_azure_ops()
+        azure_ops.get_vm = lambda resource_group, name: stub(instance_view = 'PowerState/running')
+        azure_ops.get_instance_view_state = lambda instance_view: instance_view
+        azure_ops.network_client.network_interfaces.get = get_nic
+        self.apply(azure_ops, [
+            {'type' : 'nic', 'subscription_id' : 'sub', 'resource_group' : 'rg', 'name' : 'nic1', 'id' : nic_id('nic1'),
+             'etag' : 'n', 'attached_to' : vm_id('vm1').lower()},
+            {'type' : 'vm', 'subscription_id' : 'sub', 'resource_group' : 'rg', 'name' : 'vm1', 'id' : vm_id('vm1'),
+             'state' : 'PowerState/deallocated', 'attached_to' : None}])
+        self.assertEqual(lookups, [])
+
+    def test_children_of_a_deleted_vm_are_deleted(self):
+        deleted = []
+        azure_ops = fake_azure_ops()
+        azure_ops.get_vm = lambda resource_group, name: stub(instance_view = 'PowerState/deallocated')
+        azure_ops.get_instance_view_state = lambda instance_view: instance_view
+        def delete_vm(resource_group, name):
+            deleted.append(name)
+            return stub(wait = lambda: None)
+        # the vm object only, delete_vm would take along what the plan left out
+        azure_ops.compute_client.virtual_machines.delete = delete_vm
+        azure_ops.network_client.network_interfaces.get = lambda resource_group, name: make_nic(name)
+        azure_ops.delete_nic = lambda resource_group, name: deleted.append(name)
+        self.apply(azure_ops, [
+            {'type' : 'nic', 'subscription_id' : 'sub', 'resource_group' : 'rg', 'name' : 'nic1', 'id' : nic_id('nic1'),
+             'etag' : 'n', 'attached_to' : vm_id('vm1').lower()},
+            {'type' : 'vm', 'subscription_id' : 'sub', 'resource_group' : 'rg', 'name' : 'vm1', 'id' : vm_id('vm1'),
+             'state' : 'PowerState/deallocated', 'attached_to' : None}])
+        self.assertEqual(deleted, ['vm1', 'nic1'])
+
+if __name__ == '__main__':
+    unittest.main()